@@ -0,0 +1,80 @@
+﻿import json
+import logging
+import re
+from typing import List, Optional, Tuple
+
+from .ai_extractor import AI_SYSTEM_PROMPT
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKEN_BUDGET = 6000
+DEFAULT_MAX_BATCH_ITEMS = 200
+
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+# 粗略估算系数：中文约 0.6 token/字，其他字符约 0.3 token/字符
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+# 每次请求的消息封装开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 20
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    cjk = len(CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return int(cjk * CJK_TOKENS_PER_CHAR + other * OTHER_TOKENS_PER_CHAR) + 1
+
+
+PROMPT_TOKENS = estimate_tokens(AI_SYSTEM_PROMPT) + MESSAGE_OVERHEAD_TOKENS
+
+
+def item_tokens(item_id: int, text: str) -> int:
+    """估算单个条目的输入 ({"id","text"}) 与预期输出 ({"id","value"}) token 数之和"""
+    payload = json.dumps({"id": item_id, "text": text}, ensure_ascii=False)
+    expected_output = json.dumps({"id": item_id, "value": text}, ensure_ascii=False)
+    return estimate_tokens(payload) + estimate_tokens(expected_output)
+
+
+def get_packing_settings() -> Tuple[int, int]:
+    """读取 token 预算与每批条目上限；未配置 MAX_BATCH_ITEMS 时沿用旧设置 BATCH_SIZE 作为条目上限"""
+    token_budget = int(AI_CONFIG.get("TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+    max_items = int(AI_CONFIG.get("MAX_BATCH_ITEMS", AI_CONFIG.get("BATCH_SIZE", DEFAULT_MAX_BATCH_ITEMS)))
+    return token_budget, max_items
+
+
+def pack_batches(texts: List[str], token_budget: Optional[int] = None, max_items: Optional[int] = None) -> List[List[str]]:
+    """按 token 预算贪心装箱：每批不超过预算（含系统提示词）且不超过条目上限
+
+    单个条目超出预算时独立成批。
+    """
+    default_budget, default_max_items = get_packing_settings()
+    token_budget = token_budget or default_budget
+    max_items = max_items or default_max_items
+
+    batches: List[List[str]] = []
+    current: List[str] = []
+    used = PROMPT_TOKENS
+
+    for text in texts:
+        cost = item_tokens(len(current), text)
+        if current and (used + cost > token_budget or len(current) >= max_items):
+            batches.append(current)
+            current = []
+            used = PROMPT_TOKENS
+            cost = item_tokens(0, text)
+        current.append(text)
+        used += cost
+
+    if current:
+        batches.append(current)
+
+    logger.info(
+        "按token预算分批: 条目 %s, 批次 %s, 预算 %s, 条目上限 %s",
+        len(texts),
+        len(batches),
+        token_budget,
+        max_items,
+    )
+    return batches
@@ -0,0 +1,251 @@
+﻿import csv
+import hashlib
+import io
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .ai_extractor import AI_SYSTEM_PROMPT, resolve_model
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "ai_cache.sqlite3"
+DEFAULT_MAX_ENTRIES = 500000
+DEFAULT_TTL_DAYS = 180
+SQLITE_MAX_PARAMS = 500
+# 淘汰按写入量/时间摊销执行：累计写入达到条数或距上次淘汰超过秒数时才扫描，容量最多超出 EVICT_EVERY_WRITES 条
+EVICT_EVERY_WRITES = 1000
+EVICT_INTERVAL_SECONDS = 60.0
+
+PROMPT_HASH = hashlib.sha256(AI_SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_text(text: str) -> str:
+    """缓存键的文本规范化：去除首尾空白并合并连续空白"""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class AICache:
+    """基于 SQLite (WAL) 的持久化 AI 提取缓存，可跨会话、跨进程共享
+
+    键为 (规范化文本, 模型, 提示词哈希)，支持按条数的 LRU 淘汰和按时间的 TTL 过期。
+    过期条目在读取时即被过滤；物理删除按写入量摊销执行（见 EVICT_EVERY_WRITES），关闭时补做一次。
+    get_many / set_many / 导入导出可按调用指定模型（多个会话共享同一缓存、各自选择模型）。
+    同时保留 dict 风格接口（使用构造时的 model 或设置中的 MODEL），可直接作为 ai_extract_batch 的 cache 参数。
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        model: Optional[str] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: Optional[float] = DEFAULT_TTL_DAYS * 86400,
+    ):
+        self.path = path
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+        self.last_evicted = time.time()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ai_cache (
+                text TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                PRIMARY KEY (text, model, prompt_hash)
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_last_used ON ai_cache (last_used_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_created ON ai_cache (created_at)")
+        logger.info("AI缓存已打开: %s", path)
+
+    @classmethod
+    def from_settings(cls) -> "AICache":
+        ttl_days = AI_CONFIG.get("CACHE_TTL_DAYS", DEFAULT_TTL_DAYS)
+        return cls(
+            path=AI_CONFIG.get("CACHE_PATH", DEFAULT_CACHE_PATH),
+            max_entries=int(AI_CONFIG.get("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            ttl_seconds=float(ttl_days) * 86400 if ttl_days else None,
+        )
+
+    def _scope(self, model: Optional[str] = None) -> Tuple[str, str]:
+        return resolve_model(model or self.model), PROMPT_HASH
+
+    def get_many(self, texts: Iterable[str], model: Optional[str] = None) -> Dict[str, str]:
+        """批量读取，每批次一次查询；返回命中的 {原始文本: 结果}"""
+        keys: Dict[str, List[str]] = {}
+        for text in texts:
+            keys.setdefault(normalize_text(text), []).append(text)
+        if not keys:
+            return {}
+
+        model, prompt_hash = self._scope(model)
+        now = time.time()
+        min_created = now - self.ttl_seconds if self.ttl_seconds else 0
+        found: Dict[str, str] = {}
+        normalized = list(keys)
+
+        with self.lock:
+            for start in range(0, len(normalized), SQLITE_MAX_PARAMS):
+                chunk = normalized[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT text, value FROM ai_cache WHERE model = ? AND prompt_hash = ? "
+                    f"AND created_at >= ? AND text IN ({placeholders})",
+                    [model, prompt_hash, min_created, *chunk],
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                # 命中的 last_used_at 在一个事务中按块更新
+                hits = list(found)
+                self.conn.execute("BEGIN")
+                try:
+                    for start in range(0, len(hits), SQLITE_MAX_PARAMS):
+                        chunk = hits[start:start + SQLITE_MAX_PARAMS]
+                        placeholders = ",".join("?" * len(chunk))
+                        self.conn.execute(
+                            f"UPDATE ai_cache SET last_used_at = ? WHERE model = ? AND prompt_hash = ? "
+                            f"AND text IN ({placeholders})",
+                            [now, model, prompt_hash, *chunk],
+                        )
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+
+        return {text: value for key, value in found.items() for text in keys[key]}
+
+    def set_many(self, mapping: Dict[str, str], model: Optional[str] = None) -> None:
+        """批量写入，累计写入量或时间达到阈值时执行淘汰"""
+        if not mapping:
+            return
+
+        model, prompt_hash = self._scope(model)
+        now = time.time()
+        rows = [(normalize_text(text), model, prompt_hash, value, now, now) for text, value in mapping.items()]
+
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO ai_cache (text, model, prompt_hash, value, created_at, last_used_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.pending_writes += len(rows)
+            due = self.pending_writes >= EVICT_EVERY_WRITES or now - self.last_evicted >= EVICT_INTERVAL_SECONDS
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """删除过期条目，并在超出容量时淘汰最久未使用的条目，返回删除条数"""
+        removed = 0
+        with self.lock:
+            self.pending_writes = 0
+            self.last_evicted = time.time()
+            if self.ttl_seconds:
+                cursor = self.conn.execute(
+                    "DELETE FROM ai_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+                )
+                removed += cursor.rowcount
+            if self.max_entries:
+                (count,) = self.conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()
+                excess = count - self.max_entries
+                if excess > 0:
+                    cursor = self.conn.execute(
+                        "DELETE FROM ai_cache WHERE rowid IN "
+                        "(SELECT rowid FROM ai_cache ORDER BY last_used_at LIMIT ?)",
+                        (excess,),
+                    )
+                    removed += cursor.rowcount
+        if removed:
+            logger.info("AI缓存淘汰 %s 条", removed)
+        return removed
+
+    def close(self) -> None:
+        if self.pending_writes:
+            self.evict()
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()
+        return count
+
+    def __contains__(self, text: object) -> bool:
+        return isinstance(text, str) and text in self.get_many([text])
+
+    def __getitem__(self, text: str) -> str:
+        found = self.get_many([text])
+        if text not in found:
+            raise KeyError(text)
+        return found[text]
+
+    def __setitem__(self, text: str, value: str) -> None:
+        self.set_many({text: value})
+
+    def import_mappings(self, data: bytes, file_format: str, model: Optional[str] = None) -> int:
+        """从 CSV (text,value 两列) 或 JSONL ({"text","value"}) 导入映射，返回导入条数"""
+        content = data.decode("utf-8-sig")
+        mapping: Dict[str, str] = {}
+
+        if file_format == "csv":
+            for row in csv.reader(io.StringIO(content)):
+                if len(row) >= 2 and row[0].strip() and row[1].strip() and row[0] != "text":
+                    mapping[row[0]] = row[1]
+        elif file_format == "jsonl":
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("text") and record.get("value"):
+                    mapping[str(record["text"])] = str(record["value"])
+        else:
+            raise ValueError(f"不支持的格式: {file_format}")
+
+        self.set_many(mapping, model=model)
+        logger.info("AI缓存导入 %s 条 (%s)", len(mapping), file_format)
+        return len(mapping)
+
+    def export_mappings(self, file_format: str, model: Optional[str] = None) -> bytes:
+        """按指定模型（默认当前模型）和提示词导出全部映射为 CSV 或 JSONL"""
+        model, prompt_hash = self._scope(model)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT text, value FROM ai_cache WHERE model = ? AND prompt_hash = ? ORDER BY text",
+                (model, prompt_hash),
+            ).fetchall()
+
+        output = io.StringIO()
+        if file_format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(["text", "value"])
+            writer.writerows(rows)
+        elif file_format == "jsonl":
+            for text, value in rows:
+                output.write(json.dumps({"text": text, "value": value}, ensure_ascii=False) + "\n")
+        else:
+            raise ValueError(f"不支持的格式: {file_format}")
+
+        logger.info("AI缓存导出 %s 条 (%s)", len(rows), file_format)
+        return output.getvalue().encode("utf-8")
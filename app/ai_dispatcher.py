@@ -0,0 +1,273 @@
+﻿import logging
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .ai_extractor import ai_extract_batch
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_REQUESTS_PER_MINUTE = 60
+# 旧版按批次 sleep 的间隔设置，已由 REQUESTS_PER_MINUTE 限流取代
+DEPRECATED_SLEEP_KEY = "SLEEP_TIME"
+# 等待批次完成时回调 on_idle 的最长间隔（秒），用于流式逐条进度和取消检查
+IDLE_INTERVAL = 1.0
+
+
+class RateLimiter:
+    """令牌桶限流器：按每分钟请求数匀速发放令牌，允许不超过 burst 的突发"""
+
+    def __init__(self, requests_per_minute: float, burst: Optional[int] = None):
+        self.rate = requests_per_minute / 60.0 if requests_per_minute and requests_per_minute > 0 else 0.0
+        self.capacity = float(burst if burst and burst > 0 else 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """阻塞直到获得一个令牌，返回等待秒数"""
+        if not self.rate:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class LatencyTracker:
+    """记录每批次请求耗时，用于观察 p50/p95 并调整 token 预算"""
+
+    def __init__(self):
+        self.samples: List[float] = []
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct: float) -> float:
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        rank = max(0, min(len(samples) - 1, math.ceil(pct / 100.0 * len(samples)) - 1))
+        return samples[rank]
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            count = len(self.samples)
+            longest = max(self.samples) if self.samples else 0.0
+            total = sum(self.samples)
+        return {
+            "batches": count,
+            "total": total,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": longest,
+        }
+
+
+_sleep_time_warned = False
+
+
+def get_dispatch_settings() -> Tuple[int, float]:
+    """读取并发与限流配置，settings 中未配置时使用默认值"""
+    global _sleep_time_warned
+    if DEPRECATED_SLEEP_KEY in AI_CONFIG and not _sleep_time_warned:
+        _sleep_time_warned = True
+        logger.warning(
+            "设置项 SLEEP_TIME 已不再生效：批次并发请求，间隔由 REQUESTS_PER_MINUTE（当前 %s）和 MAX_IN_FLIGHT 控制",
+            AI_CONFIG.get("REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE),
+        )
+    max_in_flight = int(AI_CONFIG.get("MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT))
+    requests_per_minute = float(AI_CONFIG.get("REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE))
+    return max(1, max_in_flight), requests_per_minute
+
+
+class SharedDispatcher:
+    """多个运行（如批量处理的多个工作簿）共享的AI调度
+
+    所有运行合计不超过 max_in_flight 个并发请求、共用一个限流器；同一文本正在被某个运行请求时，
+    其他运行等待其结果而不重复请求。
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None, requests_per_minute: Optional[float] = None):
+        default_in_flight, default_rpm = get_dispatch_settings()
+        self.max_in_flight = max(1, max_in_flight or default_in_flight)
+        self.requests_per_minute = default_rpm if requests_per_minute is None else requests_per_minute
+        self.limiter = RateLimiter(self.requests_per_minute, burst=self.max_in_flight)
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        # {文本: (完成事件, 请求方)}
+        self.inflight: Dict[str, Tuple[threading.Event, object]] = {}
+        self.results: Dict[str, str] = {}
+        self.failures: Dict[str, str] = {}
+
+    def claim(self, texts: Iterable[str], owner: object) -> Tuple[List[str], List[str]]:
+        """登记要请求的文本，返回 (由 owner 请求的文本, 已有结果或正由其他运行请求的文本)"""
+        own: List[str] = []
+        shared: List[str] = []
+        with self.lock:
+            for text in texts:
+                if text in self.results or text in self.inflight:
+                    shared.append(text)
+                else:
+                    self.inflight[text] = (threading.Event(), owner)
+                    self.failures.pop(text, None)
+                    own.append(text)
+        return own, shared
+
+    def publish(self, mapping: Dict[str, str], failures: Dict[str, str]) -> None:
+        """一个批次完成：记录结果（失败的文本只记录失败原因）并唤醒等待者"""
+        with self.lock:
+            self.results.update((text, value) for text, value in mapping.items() if text not in failures)
+            self.failures.update(failures)
+            for text in mapping:
+                entry = self.inflight.pop(text, None)
+                if entry is not None:
+                    entry[0].set()
+
+    def release(self, texts: Iterable[str], owner: object) -> None:
+        """owner 未完成的登记（取消或异常）全部撤销，等待者会自行请求这些文本"""
+        with self.lock:
+            for text in texts:
+                entry = self.inflight.get(text)
+                if entry is not None and entry[1] is owner:
+                    del self.inflight[text]
+                    entry[0].set()
+
+    def collect(
+        self, texts: List[str], on_idle: Optional[Callable[[], None]] = None
+    ) -> Tuple[Dict[str, str], Dict[str, str], List[str]]:
+        """等待 claim 返回的共享文本，返回 (结果, 失败原因, 请求方中途放弃、需要自行请求的文本)"""
+        for text in texts:
+            with self.lock:
+                entry = self.inflight.get(text)
+            if entry is None:
+                continue
+            while not entry[0].wait(IDLE_INTERVAL if on_idle else None):
+                on_idle()
+        results: Dict[str, str] = {}
+        failures: Dict[str, str] = {}
+        orphans: List[str] = []
+        with self.lock:
+            for text in texts:
+                if text in self.results:
+                    results[text] = self.results[text]
+                elif text in self.failures:
+                    failures[text] = self.failures[text]
+                else:
+                    orphans.append(text)
+        return results, failures, orphans
+
+
+def dispatch_batches(
+    batches: Sequence[Tuple[List[object], List[object]]],
+    column_name: str = "未知列",
+    cache: Optional[Dict[str, str]] = None,
+    max_in_flight: Optional[int] = None,
+    requests_per_minute: Optional[float] = None,
+    latency: Optional[LatencyTracker] = None,
+    failures: Optional[Dict[str, str]] = None,
+    metrics=None,
+    on_item: Optional[Callable[[str, str], None]] = None,
+    on_idle: Optional[Callable[[], None]] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    model: Optional[str] = None,
+) -> Iterator[Tuple[int, List[object], List[str]]]:
+    """并发执行 ai_extract_batch，按完成顺序产出 (批次序号, 行索引, 提取结果)
+
+    batches 中每个元素为 (行索引列表, 待提取值列表)。metrics 为 RunMetrics 时记录排队等待与请求指标。
+    on_item 透传给 ai_extract_batch（流式逐条结果，工作线程中调用）；on_idle 在调用方线程中
+    每次等待返回后调用（至少每 IDLE_INTERVAL 秒一次），抛出异常时取消排队中的批次并结束。
+    提供 dispatcher 时使用其共享的并发上限与限流器（忽略 max_in_flight / requests_per_minute）。
+    限流按HTTP请求计：批次内的重试、补请求和拆批请求同样要先取得令牌。model 透传给 ai_extract_batch。
+    """
+    if dispatcher is not None:
+        max_in_flight, requests_per_minute = dispatcher.max_in_flight, dispatcher.requests_per_minute
+    else:
+        default_in_flight, default_rpm = get_dispatch_settings()
+        max_in_flight = max(1, max_in_flight or default_in_flight)
+        requests_per_minute = default_rpm if requests_per_minute is None else requests_per_minute
+
+    if cache is None:
+        cache = {}
+
+    if not batches:
+        return
+
+    limiter = dispatcher.limiter if dispatcher is not None else RateLimiter(requests_per_minute, burst=max_in_flight)
+    logger.info(
+        "AI并发调度 - 列名: %s, 批次数: %s, 最大并发: %s, 每分钟请求上限: %s",
+        column_name,
+        len(batches),
+        max_in_flight,
+        requests_per_minute or "不限",
+    )
+
+    def acquire():
+        waited = limiter.acquire()
+        if waited:
+            logger.info("限流等待 %.2f秒", waited)
+            if metrics is not None:
+                metrics.record_rate_limit_wait(waited)
+        return waited
+
+    def request(values, submitted):
+        start_time = time.time()
+        if metrics is not None:
+            metrics.record_queue_wait(start_time - submitted)
+        extracted = ai_extract_batch(
+            values,
+            column_name,
+            cache=cache,
+            failures=failures,
+            metrics=metrics,
+            on_item=on_item,
+            acquire=acquire,
+            model=model,
+        )
+        if latency is not None:
+            latency.record(time.time() - start_time)
+        return extracted
+
+    def run(values, submitted):
+        if dispatcher is None:
+            return request(values, submitted)
+        with dispatcher.slots:
+            return request(values, submitted)
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="ai-dispatch")
+    try:
+        pending = {}
+        next_batch = 0
+
+        while next_batch < len(batches) or pending:
+            while next_batch < len(batches) and len(pending) < max_in_flight:
+                _, values = batches[next_batch]
+                pending[executor.submit(run, values, time.time())] = next_batch
+                next_batch += 1
+
+            done, _ = wait(pending, timeout=IDLE_INTERVAL if on_idle else None, return_when=FIRST_COMPLETED)
+            if on_idle is not None:
+                on_idle()
+            for future in done:
+                batch_idx = pending.pop(future)
+                row_indices, _ = batches[batch_idx]
+                yield batch_idx, row_indices, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -2,7 +2,7 @@
 import logging
 import re
 import time
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 from openai import OpenAI
 
@@ -49,6 +49,21 @@ AI_SYSTEM_PROMPT = """你是一个具备多年医药行业经验的医药专家
 
 UNCERTAIN_TOKENS = {"n/a", "na", "null", "none"}
 
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1.0
+
+RESULTS_START = re.compile(r'"results"\s*:\s*\[')
+
+def resolve_model(model: Optional[str] = None) -> str:
+    """本次运行使用的模型：未指定时取设置中的 MODEL"""
+    return model or AI_CONFIG["MODEL"]
+
+
+# 流式模式下每条结果到达时的回调 (id, 原始结果值)
+ItemCallback = Optional[Callable[[int, object], None]]
+# 每次发出HTTP请求前调用（如限流器取令牌），阻塞直到允许请求
+AcquireCallback = Optional[Callable[[], object]]
+
 
 def _strip_code_fences(text: str) -> str:
     cleaned = text.strip()
@@ -75,6 +90,91 @@ def _extract_json(content: str) -> Optional[object]:
     return None
 
 
+def _collect_items(results_list: object, id_to_value: Dict[int, object]) -> None:
+    if not isinstance(results_list, list):
+        return
+    for item in results_list:
+        if not isinstance(item, dict) or "value" not in item:
+            continue
+        item_id = item.get("id")
+        if isinstance(item_id, str) and item_id.isdigit():
+            item_id = int(item_id)
+        if isinstance(item_id, int):
+            id_to_value[item_id] = item.get("value")
+
+
+def _salvage_items(content: str) -> Dict[int, object]:
+    """从截断或格式错误的响应中尽可能抢救完整的 {"id","value"} 对象"""
+    decoder = json.JSONDecoder()
+    id_to_value: Dict[int, object] = {}
+    pos = content.find("{")
+    while pos != -1:
+        try:
+            obj, end = decoder.raw_decode(content, pos)
+        except json.JSONDecodeError:
+            pos = content.find("{", pos + 1)
+            continue
+        if isinstance(obj, dict) and "results" in obj:
+            _collect_items(obj.get("results"), id_to_value)
+        elif isinstance(obj, dict):
+            _collect_items([obj], id_to_value)
+        pos = content.find("{", end)
+    return id_to_value
+
+
+def _parse_results(content: str) -> Dict[int, object]:
+    """解析AI响应为 {id: value}；整体解析失败时退化为逐对象抢救"""
+    data = _extract_json(content) if content else None
+    results_list = data.get("results") if isinstance(data, dict) else data
+
+    id_to_value: Dict[int, object] = {}
+    if isinstance(results_list, list):
+        _collect_items(results_list, id_to_value)
+    elif content:
+        id_to_value = _salvage_items(_strip_code_fences(content))
+        logger.warning("AI返回JSON不完整, 抢救出 %s 条结果", len(id_to_value))
+    return id_to_value
+
+
+class StreamingResultsParser:
+    """增量解析流式返回的 {"results":[{"id","value"},...]}：results 中每个对象一闭合就产出
+
+    遇到无法增量解析的内容时停止，由完整响应的 _parse_results 兜底。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos: Optional[int] = None
+        self.done = False
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, chunk: str) -> List[Tuple[int, object]]:
+        """追加一段内容，返回新闭合的 [(id, value)]"""
+        self.buffer += chunk
+        if self.pos is None:
+            match = RESULTS_START.search(self.buffer)
+            if not match:
+                return []
+            self.pos = match.end()
+
+        items: Dict[int, object] = {}
+        while not self.done:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos >= len(self.buffer):
+                break
+            if self.buffer[self.pos] != "{":
+                self.done = True
+                break
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                break
+            self.pos = end
+            _collect_items([obj], items)
+        return list(items.items())
+
+
 def _normalize_result(raw_value: object, original: str) -> str:
     if raw_value is None:
         return original
@@ -93,8 +193,39 @@ def _normalize_result(raw_value: object, original: str) -> str:
     return text
 
 
-def ai_extract_batch(values: List[object], column_name: str = "未知列", cache: Optional[Dict[str, str]] = None) -> List[str]:
-    """使用AI提取药物成分（单批次），带缓存和JSON协议"""
+def _cache_lookup(cache, texts: List[str], model: Optional[str] = None) -> Dict[str, str]:
+    """批量查询缓存：持久化缓存按模型一次查询整批，普通 dict 逐项查找"""
+    unique_texts = list(dict.fromkeys(texts))
+    if hasattr(cache, "get_many"):
+        return cache.get_many(unique_texts, model=model)
+    return {text: cache[text] for text in unique_texts if text in cache}
+
+
+def _cache_store(cache, mapping: Dict[str, str], model: Optional[str] = None) -> None:
+    if hasattr(cache, "set_many"):
+        cache.set_many(mapping, model=model)
+    else:
+        cache.update(mapping)
+
+
+def ai_extract_batch(
+    values: List[object],
+    column_name: str = "未知列",
+    cache: Optional[Dict[str, str]] = None,
+    failures: Optional[Dict[str, str]] = None,
+    metrics=None,
+    on_item: Optional[Callable[[str, str], None]] = None,
+    acquire: AcquireCallback = None,
+    model: Optional[str] = None,
+) -> List[str]:
+    """使用AI提取药物成分（单批次），带缓存和JSON协议
+
+    永久失败的条目保留原文、不写入缓存，并记录到 failures {文本: 原因}。
+    metrics 为 RunMetrics 时记录每次请求的耗时、token 用量和重试次数。
+    STREAM 开启时每条结果一到达就回调 on_item(文本, 结果)（在工作线程中调用）；缓存在批次结束时一次写入。
+    acquire 在每次HTTP请求（含重试和拆批）之前调用，用于限流。
+    model 为提交任务时确定的模型，请求和缓存键都使用它（未指定时取设置中的 MODEL）。
+    """
     logger.info("AI提取批次 - 列名: %s, 数据量: %s", column_name, len(values))
 
     if cache is None:
@@ -110,9 +241,12 @@ def ai_extract_batch(values: List[object], column_name: str = "未知列", cache
     cache_hits = 0
     empty_count = 0
 
+    model = resolve_model(model)
+    cached = _cache_lookup(cache, orig, model)
+
     for idx, text in enumerate(orig):
-        if text in cache:
-            results[idx] = cache[text]
+        if text in cached:
+            results[idx] = cached[text]
             cache_hits += 1
             continue
         if not text.strip():
@@ -136,77 +270,234 @@ def ai_extract_batch(values: List[object], column_name: str = "未知列", cache
         logger.info("批次处理完成, 全部命中缓存")
         return [r if r is not None else "" for r in results]
 
-    items = []
-    id_to_text: Dict[int, str] = {}
-    for item_id, text in enumerate(pending_map.keys()):
-        items.append({"id": item_id, "text": text})
-        id_to_text[item_id] = text
-
-    user_content = json.dumps({"items": items}, ensure_ascii=False)
+    id_to_text: Dict[int, str] = dict(enumerate(pending_map.keys()))
 
     try:
-        client = OpenAI(api_key=AI_CONFIG["API_KEY"], base_url=AI_CONFIG["BASE_URL"])
+        # 重试由 _extract_with_retry 统一负责，关闭客户端自带的重试以免叠加
+        client = OpenAI(api_key=AI_CONFIG["API_KEY"], base_url=AI_CONFIG["BASE_URL"], max_retries=0)
         logger.info("OpenAI客户端初始化成功")
     except Exception as e:
         logger.error("OpenAI客户端初始化失败: %s", str(e))
         raise
 
-    try:
-        logger.info("开始调用AI API")
-        start_time = time.time()
-
-        resp = client.chat.completions.create(
-            model=AI_CONFIG["MODEL"],
-            messages=[
-                {"role": "system", "content": AI_SYSTEM_PROMPT},
-                {"role": "user", "content": user_content},
-            ],
-            response_format={"type": "json_object"},
-            stream=False,
-            temperature=AI_CONFIG["TEMPERATURE"],
-        )
-
-        elapsed_time = time.time() - start_time
-        logger.info("AI API调用成功, 耗时: %.2f秒", elapsed_time)
+    def emit_item(item_id: int, raw_value: object) -> None:
+        text = id_to_text[item_id]
+        on_item(text, _normalize_result(raw_value, text))
 
-        content = resp.choices[0].message.content if resp and resp.choices else ""
-        data = _extract_json(content) if content else None
-
-        if data is None:
-            raise ValueError("AI返回不是有效JSON")
+    resolved, failed = _extract_with_retry(
+        client, id_to_text, metrics, emit_item if on_item is not None else None, acquire, model
+    )
 
-        if isinstance(data, dict):
-            results_list = data.get("results")
-        else:
-            results_list = data
-
-        id_to_value: Dict[int, object] = {}
-        if isinstance(results_list, list):
-            for item in results_list:
-                if not isinstance(item, dict):
-                    continue
-                item_id = item.get("id")
-                if isinstance(item_id, str) and item_id.isdigit():
-                    item_id = int(item_id)
-                if isinstance(item_id, int):
-                    id_to_value[item_id] = item.get("value")
+    new_entries: Dict[str, str] = {}
+    for item_id, text in id_to_text.items():
+        if item_id in resolved:
+            normalized = _normalize_result(resolved[item_id], text)
+            new_entries[text] = normalized
         else:
-            raise ValueError("AI返回JSON结构不正确")
+            normalized = text
+            if failures is not None:
+                failures[text] = failed[item_id]
+        for idx in pending_map[text]:
+            results[idx] = normalized
+    _cache_store(cache, new_entries, model)
+
+    if failed:
+        logger.error("AI提取永久失败 %s 条, 已保留原文且不写入缓存", len(failed))
+    logger.info("批次处理完成, 结果数: %s", len(orig))
+    return [r if r is not None else "" for r in results]
+
+
+def _stream_content(
+    stream,
+    items: Dict[int, str],
+    on_item: ItemCallback,
+    start_time: float,
+    metrics=None,
+    streamed: Optional[Dict[int, object]] = None,
+):
+    """消费流式响应，边接收边解析；返回 (完整内容, 已产出的 {id: value}, usage)
+
+    已产出的条目同时写入传入的 streamed，流中途异常时调用方仍可取得这部分结果。
+    """
+    parser = StreamingResultsParser()
+    parts: List[str] = []
+    if streamed is None:
+        streamed = {}
+    usage = None
+
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not parts:
+            first_token = time.time() - start_time
+            logger.info("AI流式响应首字节耗时: %.2f秒", first_token)
+            if metrics is not None:
+                metrics.record_first_token(first_token)
+        parts.append(delta)
+        for item_id, value in parser.feed(delta):
+            if item_id in items and item_id not in streamed:
+                streamed[item_id] = value
+                if on_item is not None:
+                    on_item(item_id, value)
+
+    return "".join(parts), streamed, usage
+
+
+def _request_items(
+    client: OpenAI,
+    items: Dict[int, str],
+    metrics=None,
+    on_item: ItemCallback = None,
+    partial: Optional[Dict[int, object]] = None,
+    model: Optional[str] = None,
+) -> Dict[int, object]:
+    """发送一次请求，返回解析出的 {id: value}（可能只有部分）；请求异常向上抛出
+
+    STREAM 开启时以流式请求，每条结果一解析出来就回调 on_item 并记入 partial（异常时保留）。
+    """
+    user_content = json.dumps(
+        {"items": [{"id": item_id, "text": text} for item_id, text in items.items()]},
+        ensure_ascii=False,
+    )
 
-        for item_id, text in id_to_text.items():
-            raw_value = id_to_value.get(item_id)
-            normalized = _normalize_result(raw_value, text)
-            cache[text] = normalized
-            for idx in pending_map[text]:
-                results[idx] = normalized
+    logger.info("开始调用AI API, 条目数: %s", len(items))
+    start_time = time.time()
+
+    stream = bool(AI_CONFIG.get("STREAM", False))
+    request = dict(
+        model=resolve_model(model),
+        messages=[
+            {"role": "system", "content": AI_SYSTEM_PROMPT},
+            {"role": "user", "content": user_content},
+        ],
+        response_format={"type": "json_object"},
+        stream=stream,
+        temperature=AI_CONFIG["TEMPERATURE"],
+    )
 
-        logger.info("批次处理完成, 结果数: %s", len(orig))
-        return [r if r is not None else "" for r in results]
+    streamed: Dict[int, object] = partial if partial is not None else {}
+    if stream:
+        response = client.chat.completions.create(stream_options={"include_usage": True}, **request)
+        content, streamed, usage = _stream_content(response, items, on_item, start_time, metrics, streamed)
+    else:
+        resp = client.chat.completions.create(**request)
+        content = resp.choices[0].message.content if resp and resp.choices else ""
+        usage = getattr(resp, "usage", None)
+
+    elapsed_time = time.time() - start_time
+    if usage is not None:
+        logger.info(
+            "AI API调用成功, 耗时: %.2f秒, token: 输入 %s / 输出 %s",
+            elapsed_time,
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+        )
+    else:
+        logger.info("AI API调用成功, 耗时: %.2f秒", elapsed_time)
+    if metrics is not None:
+        metrics.record_request(elapsed_time, usage)
+
+    if streamed and len(streamed) == len(items):
+        return streamed
+    id_to_value = _parse_results(content or "")
+    id_to_value.update(streamed)
+    return {item_id: value for item_id, value in id_to_value.items() if item_id in items}
+
+
+# 这些状态码与批次内容无关（鉴权、权限、限流），拆批也不会成功
+UNSPLITTABLE_STATUS_CODES = (401, 403, 429)
+
+
+def _splittable_error(error: Exception) -> bool:
+    """接口返回了与请求内容相关的错误（如请求体过大、某条数据导致的 4xx/5xx），拆小批次可能成功；
+    连接失败、超时等没有状态码的错误不拆批"""
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and status_code not in UNSPLITTABLE_STATUS_CODES
+
+
+def _extract_with_retry(
+    client: OpenAI,
+    id_to_text: Dict[int, str],
+    metrics=None,
+    on_item: ItemCallback = None,
+    acquire: AcquireCallback = None,
+    model: Optional[str] = None,
+) -> Tuple[Dict[int, object], Dict[int, str]]:
+    """只重试缺失的 id：指数退避，响应反复不完整或反复返回与内容相关的错误时二分拆批
+
+    每次请求（包括退避之后的重试）之前都先调用 acquire。返回 (已解析的 {id: value}, 永久失败的 {id: 原因})。
+    """
+    max_retries = int(AI_CONFIG.get("MAX_RETRIES", DEFAULT_MAX_RETRIES))
+    backoff = float(AI_CONFIG.get("RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF))
+
+    resolved: Dict[int, object] = {}
+    failed: Dict[int, str] = {}
+    stack: List[List[int]] = [list(id_to_text)]
+    requests_made = 0
+
+    while stack:
+        ids = stack.pop()
+        attempt = 0
+        request_error = False
+        splittable = False
+        reason = ""
+
+        while ids and attempt < max_retries:
+            if attempt:
+                delay = backoff * (2 ** (attempt - 1))
+                logger.info("等待 %.1f秒 后重试 %s 条 (第 %s 次)", delay, len(ids), attempt + 1)
+                time.sleep(delay)
+            if acquire is not None:
+                acquire()
+
+            # 首次请求之后的每次请求（重试缺失 id、退避重试、二分拆批）都计为重试
+            if metrics is not None and requests_made:
+                metrics.incr("ai_retries")
+            requests_made += 1
+            partial: Dict[int, object] = {}
+            try:
+                got = _request_items(
+                    client, {item_id: id_to_text[item_id] for item_id in ids}, metrics, on_item, partial, model
+                )
+                request_error = False
+            except Exception as e:
+                logger.error("AI API调用失败: %s", str(e), exc_info=True)
+                if metrics is not None:
+                    metrics.incr("ai_request_errors")
+                # 流中途断开时，已解析并回调过的条目仍然有效
+                got = partial
+                if got:
+                    logger.warning("流式响应中断, 保留已收到的 %s/%s 条", len(got), len(ids))
+                request_error = True
+                splittable = _splittable_error(e)
+                reason = f"请求失败: {str(e)}"
+
+            resolved.update(got)
+            remaining = [item_id for item_id in ids if item_id not in got]
+            if got and remaining:
+                logger.warning("AI返回缺少 %s/%s 条, 仅重试缺失部分", len(remaining), len(ids))
+                attempt = 0
+            else:
+                attempt += 1
+                if not request_error and remaining:
+                    reason = "AI返回中缺少该条结果"
+            ids = remaining
+
+        if not ids:
+            continue
+        if (not request_error or splittable) and len(ids) > 1:
+            middle = len(ids) // 2
+            logger.warning(
+                "批次反复%s, 二分拆分为 %s + %s 条", "请求失败" if request_error else "不完整", middle, len(ids) - middle
+            )
+            stack.extend([ids[middle:], ids[:middle]])
+        else:
+            for item_id in ids:
+                failed[item_id] = reason
 
-    except Exception as e:
-        logger.error("AI API调用失败: %s", str(e), exc_info=True)
-        logger.info("使用原始数据作为后备")
-        for text, indices in pending_map.items():
-            for idx in indices:
-                results[idx] = text
-        return [r if r is not None else "" for r in results]
+    return resolved, failed
@@ -0,0 +1,276 @@
+﻿import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .ai_batching import get_packing_settings, pack_batches
+from .ai_dispatcher import LatencyTracker, dispatch_batches
+from .ai_extractor import _cache_lookup
+from .drug_lexicon import get_lexicon
+from .metrics import RunMetrics
+from .rules import collect_ai_tasks
+
+logger = logging.getLogger(__name__)
+
+
+def task_text(value: object) -> str:
+    """与 ai_extract_batch 一致的文本转换"""
+    return str(value) if value is not None else ""
+
+
+def _request_count(size: int, batch_size: int) -> int:
+    return (size + batch_size - 1) // batch_size
+
+
+@dataclass
+class AIPlan:
+    """全部工作表、变量的 AI 提取计划：全局唯一文本及其引用位置"""
+
+    texts: List[str] = field(default_factory=list)
+    references: Dict[str, List[Tuple[str, str, object]]] = field(default_factory=dict)
+    group_sizes: List[int] = field(default_factory=list)
+    task_count: int = 0
+
+    def add(self, sheet_name: str, var_name: str, row_idx: object, value: object) -> None:
+        text = task_text(value)
+        if not text.strip():
+            return
+        if text not in self.references:
+            self.references[text] = []
+            self.texts.append(text)
+        self.references[text].append((sheet_name, var_name, row_idx))
+
+    def summary(self, stats: Dict[str, object], batch_size: Optional[int] = None) -> Dict[str, object]:
+        """统计去重效果：按原先“每变量每列按固定条数分批”估算的请求数与实际HTTP请求数（含重试）对比
+
+        batch_size 未指定时取当前的每批条目上限（MAX_BATCH_ITEMS，未设置时为 BATCH_SIZE）。
+        """
+        if batch_size is None:
+            batch_size = get_packing_settings()[1]
+        requests_before = sum(_request_count(size, batch_size) for size in self.group_sizes)
+        requests_after = int(stats.get("requests", 0))
+        return {
+            "tasks": self.task_count,
+            "unique_texts": len(self.texts),
+            "requests_before": requests_before,
+            "requests_saved": max(0, requests_before - requests_after),
+            **stats,
+        }
+
+
+def group_tasks_by_column(tasks: List[Tuple[object, int, str, object]]) -> Dict[str, List[Tuple[object, object]]]:
+    """按源列分组 [(行索引, 原始值)]，列顺序为首次出现顺序"""
+    col_groups: Dict[str, List[Tuple[object, object]]] = {}
+    for row_idx, _, source_col, value in tasks:
+        col_groups.setdefault(source_col, []).append((row_idx, value))
+    return col_groups
+
+
+def plan_ai_work(
+    sheet_frames: Dict[str, pd.DataFrame],
+    sheet_variables: Dict[str, dict],
+    row_masks: Optional[Dict[Tuple[str, str], np.ndarray]] = None,
+    compiled_rules: Optional[Dict[str, Dict[str, list]]] = None,
+) -> AIPlan:
+    """扫描所有选中工作表和变量，汇总全局唯一的待提取文本
+
+    row_masks 为 {(工作表, 变量): 需要计算的行掩码}，未列出的变量扫描全部行。
+    compiled_rules 为 {工作表: {变量: [CompiledRule]}}，提供时不再重复编译。
+    """
+    plan = AIPlan()
+    row_masks = row_masks or {}
+    compiled_rules = compiled_rules or {}
+
+    for sheet_name, df in sheet_frames.items():
+        for var_name, var_config in sheet_variables.get(sheet_name, {}).items():
+            rules = var_config.get("rules", [])
+            if not any(r.get("extract_type") == "AI提取" for r in rules):
+                continue
+
+            mask = row_masks.get((sheet_name, var_name))
+            target = df if mask is None else df[mask]
+            if target.empty:
+                continue
+            tasks = collect_ai_tasks(target, compiled_rules.get(sheet_name, {}).get(var_name, rules))
+            plan.task_count += len(tasks)
+            for tasks_in_col in group_tasks_by_column(tasks).values():
+                plan.group_sizes.append(len(tasks_in_col))
+                for row_idx, value in tasks_in_col:
+                    plan.add(sheet_name, var_name, row_idx, value)
+
+    logger.info(
+        "AI提取计划: 任务数 %s, 全局唯一文本 %s",
+        plan.task_count,
+        len(plan.texts),
+    )
+    return plan
+
+
+def execute_texts(
+    texts: List[str],
+    cache,
+    column_name: str = "全局",
+    on_batch: Optional[Callable[[int, int], None]] = None,
+    metrics=None,
+    on_items: Optional[Callable[[int, int], None]] = None,
+    on_idle: Optional[Callable[[], None]] = None,
+    checkpoint=None,
+    dispatcher=None,
+    model: Optional[str] = None,
+) -> Tuple[Dict[str, str], Dict[str, object]]:
+    """只对未命中缓存且本地词表无法确定的唯一文本发起请求（按 token 预算分批），返回 ({文本: 结果}, 统计)
+
+    流式模式下结果逐条写入返回的字典；on_items(已返回条数, 待请求条数) 在等待批次期间有新结果时调用。
+    on_idle 在等待批次期间定时调用（可抛出异常以中止，如取消任务）。
+    checkpoint 为 CheckpointRun 时先复用上次中断运行已完成的结果，每个批次完成后立即记录。
+    dispatcher 为 SharedDispatcher 时与其他运行共享并发与限流，其他运行正在请求的文本直接等待其结果。
+    model 为本次运行的模型（提交时确定），请求与缓存都使用它。
+    统计中 requests 为实际发出的HTTP请求数（含重试、补请求和拆批），batches 为分批数。
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    requests_start = metrics.request_count()
+    text_results: Dict[str, str] = {}
+    resumed_batches = 0
+    if checkpoint is not None:
+        text_results = checkpoint.load(texts)
+        if text_results:
+            resumed_batches = checkpoint.batches()
+            logger.info("断点续跑: 复用 %s 条结果（上次完成 %s 批）", len(text_results), resumed_batches)
+    resumed_count = len(text_results)
+
+    lookup_texts = [text for text in texts if text not in text_results]
+    text_results.update(_cache_lookup(cache, lookup_texts, model))
+    cached_count = len(text_results) - resumed_count
+    metrics.incr("checkpoint_hits", resumed_count)
+    metrics.incr("cache_lookups", len(lookup_texts))
+    metrics.incr("cache_hits", cached_count)
+    pending = [text for text in texts if text not in text_results]
+
+    local_count = 0
+    lexicon = get_lexicon()
+    if lexicon is not None and pending:
+        local_results, pending = lexicon.resolve_many(pending)
+        local_count = len(local_results)
+        text_results.update(local_results)
+        metrics.incr("local_hits", local_count)
+        logger.info(
+            "本地预提取: %s/%s 条 (%.1f%%), 剩余 %s 条交给AI",
+            local_count,
+            local_count + len(pending),
+            100.0 * local_count / (local_count + len(pending)),
+            len(pending),
+        )
+
+    owner = object()
+    shared_texts: List[str] = []
+    if dispatcher is not None and pending:
+        pending, shared_texts = dispatcher.claim(pending, owner)
+        if shared_texts:
+            logger.info("共享调度: %s 条文本已由其他运行请求，等待其结果", len(shared_texts))
+
+    batches = [(batch, batch) for batch in pack_batches(pending)] if pending else []
+    latency = LatencyTracker()
+    failures: Dict[str, str] = {}
+    completed = 0
+    total_batches = len(batches)
+
+    streamed: List[str] = []
+    reported = [0]
+
+    def on_item(text: str, value: str) -> None:
+        text_results[text] = value
+        streamed.append(text)
+
+    def idle() -> None:
+        if on_idle is not None:
+            on_idle()
+        if on_items is not None and len(streamed) != reported[0]:
+            reported[0] = len(streamed)
+            on_items(reported[0], len(pending))
+
+    def run(run_batches) -> None:
+        nonlocal completed
+        for _, batch_texts, extracted in dispatch_batches(
+            run_batches,
+            column_name,
+            cache=cache,
+            latency=latency,
+            failures=failures,
+            metrics=metrics,
+            on_item=on_item,
+            on_idle=idle if on_items is not None or on_idle is not None else None,
+            dispatcher=dispatcher,
+            model=model,
+        ):
+            mapping = dict(zip(batch_texts, extracted))
+            text_results.update(mapping)
+            if dispatcher is not None:
+                dispatcher.publish(mapping, {text: failures[text] for text in mapping if text in failures})
+            if checkpoint is not None:
+                checkpoint.record({text: value for text, value in mapping.items() if text not in failures})
+            completed += 1
+            if on_batch is not None:
+                on_batch(completed, total_batches)
+
+    shared_count = 0
+    try:
+        run(batches)
+        if shared_texts:
+            shared_results, shared_failures, orphans = dispatcher.collect(shared_texts, on_idle)
+            shared_count = len(shared_results)
+            text_results.update(shared_results)
+            text_results.update((text, text) for text in shared_failures)
+            failures.update(shared_failures)
+            if checkpoint is not None:
+                checkpoint.record(shared_results)
+            metrics.incr("shared_hits", shared_count)
+            if orphans:
+                # 原请求方已放弃（取消或异常），自行请求
+                orphan_batches = [(batch, batch) for batch in pack_batches(orphans)]
+                total_batches += len(orphan_batches)
+                batches.extend(orphan_batches)
+                run(orphan_batches)
+    finally:
+        if dispatcher is not None:
+            dispatcher.release(pending, owner)
+
+    latency_summary = latency.summary()
+    stats = {
+        "cached": cached_count,
+        "resumed": resumed_count,
+        "resumed_batches": resumed_batches,
+        "shared": shared_count,
+        "local": local_count,
+        "local_ratio": local_count / (len(lookup_texts) - cached_count) if len(lookup_texts) > cached_count else 0.0,
+        "requests": metrics.request_count() - requests_start,
+        "batches": len(batches),
+        "latency_p50": latency_summary["p50"],
+        "latency_p95": latency_summary["p95"],
+        "latency_p99": latency_summary["p99"],
+        "latency_max": latency_summary["max"],
+        "failed": len(failures),
+        "failures": failures,
+    }
+    if failures:
+        logger.error("AI提取失败 %s 条（保留原文）", len(failures))
+    if batches:
+        logger.info(
+            "AI批次耗时: p50 %.2f秒, p95 %.2f秒, 最大 %.2f秒",
+            stats["latency_p50"],
+            stats["latency_p95"],
+            stats["latency_max"],
+        )
+    return text_results, stats
+
+
+def resolve_ai_results(tasks: List[Tuple[object, int, str, object]], text_results: Dict[str, str]) -> Dict[object, str]:
+    """将文本级结果回填到行：{行索引: AI结果}，多列冲突时以后处理的列为准"""
+    ai_results: Dict[object, str] = {}
+    for tasks_in_col in group_tasks_by_column(tasks).values():
+        for row_idx, value in tasks_in_col:
+            text = task_text(value)
+            ai_results[row_idx] = text_results.get(text, text) if text.strip() else text
+    return ai_results
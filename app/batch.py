@@ -0,0 +1,215 @@
+﻿"""批量处理：同一配置处理一个目录或一组工作簿
+
+多个工作簿并发处理（有界线程池），共享同一个AI缓存、AI调度（并发上限/限流/进行中文本去重）、
+规则进程池和断点库：不同中心工作簿中重复出现的名称只提取一次。
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+from .ai_cache import AICache
+from .ai_dispatcher import SharedDispatcher
+from .checkpoint import CheckpointStore
+from .parallel import RulePool
+from .pipeline import output_name, run_pipeline
+from .settings import AI_CONFIG
+from .writers import FORMAT_XLSX, WRITER_STYLED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_WORKERS = 4
+WORKBOOK_EXTENSIONS = (".xlsx", ".xlsm", ".xls")
+SUMMARY_FILE_NAME = "batch_summary.json"
+
+STATUS_OK = "ok"
+STATUS_PARTIAL = "partial"
+STATUS_ERROR = "error"
+
+
+def find_workbooks(inputs: List[str]) -> List[str]:
+    """展开输入：目录取其中的工作簿（不递归，跳过 Excel 临时文件 ~$* 和已处理的 *_processed* 输出），文件原样保留"""
+    paths: List[str] = []
+    for item in inputs:
+        if not os.path.isdir(item):
+            paths.append(item)
+            continue
+        for name in sorted(os.listdir(item)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in WORKBOOK_EXTENSIONS or name.startswith("~$") or "_processed" in stem:
+                continue
+            paths.append(os.path.join(item, name))
+    return list(dict.fromkeys(paths))
+
+
+def output_paths(inputs: List[str], output_dir: Optional[str], file_format: str = FORMAT_XLSX) -> Dict[str, str]:
+    """每个输入的输出路径：未指定 output_dir 时写在输入旁；输出目录中的同名文件加序号区分"""
+    outputs: Dict[str, str] = {}
+    used = set()
+    for path in inputs:
+        name = output_name(os.path.basename(path), file_format)
+        target = os.path.join(output_dir if output_dir else os.path.dirname(path), name)
+        stem, ext = os.path.splitext(target)
+        index = 2
+        while target in used:
+            target = f"{stem}_{index}{ext}"
+            index += 1
+        used.add(target)
+        outputs[path] = target
+    return outputs
+
+
+def _file_entry(path: str, output_path: str, summary: Dict[str, object]) -> Dict[str, object]:
+    """单个工作簿的汇总条目"""
+    ai_summary = summary.get("ai") or {}
+    return {
+        "input": path,
+        "output": output_path,
+        "status": STATUS_PARTIAL if summary["failures"] else STATUS_OK,
+        "elapsed": summary.get("elapsed", 0.0),
+        "sheets": len(summary["sheets"]),
+        "rows": sum(sheet["rows"] for sheet in summary["sheets"].values()),
+        "ai_unique_texts": ai_summary.get("unique_texts", 0),
+        "ai_cached": ai_summary.get("cached", 0),
+        "ai_shared": ai_summary.get("shared", 0),
+        "ai_local": ai_summary.get("local", 0),
+        "ai_requests": ai_summary.get("requests", 0),
+        "resumed": (summary.get("resume") or {}).get("texts", 0),
+        "missing_columns": summary.get("missing_columns", []),
+        "failures": summary["failures"],
+    }
+
+
+def run_batch(
+    inputs: List[str],
+    sheet_variables: Dict[str, dict],
+    output_dir: Optional[str] = None,
+    sheet_names: Optional[List[str]] = None,
+    writer: str = WRITER_STYLED,
+    file_format: str = FORMAT_XLSX,
+    workers: Optional[int] = None,
+    batch_workers: Optional[int] = None,
+    resume: bool = True,
+    summary_path: Optional[str] = None,
+    progress: Optional[Callable[[int, int, Dict[str, object]], None]] = None,
+    compiled_rules: Optional[Dict[str, Dict[str, list]]] = None,
+) -> Dict[str, object]:
+    """用同一配置处理多个工作簿，返回 JSON 可序列化的汇总
+
+    inputs 可包含目录（见 find_workbooks）。同时处理的工作簿数取 batch_workers，
+    未指定时取设置 BATCH_WORKERS。单个工作簿失败不影响其他工作簿，记录在汇总中。
+    summary_path 未指定且提供 output_dir 时，汇总写入 output_dir/batch_summary.json。
+    progress(已完成数, 总数, 该文件条目) 在每个工作簿结束时调用。
+    compiled_rules 为该配置已编译的规则，所有工作簿共用（见 process_workbook）。
+    """
+    start_time = time.time()
+    paths = find_workbooks(inputs)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    outputs = output_paths(paths, output_dir, file_format)
+    if batch_workers is None:
+        batch_workers = int(AI_CONFIG.get("BATCH_WORKERS", DEFAULT_BATCH_WORKERS))
+    batch_workers = max(1, min(batch_workers, len(paths) or 1))
+    logger.info("批量处理开始: %s 个工作簿, 同时处理 %s 个", len(paths), batch_workers)
+
+    cache = AICache.from_settings()
+    pool = RulePool.from_settings(workers)
+    checkpoints = CheckpointStore.from_settings() if resume else None
+    dispatcher = SharedDispatcher()
+    entries: Dict[str, Dict[str, object]] = {}
+
+    def process(path: str) -> Dict[str, object]:
+        file_start = time.time()
+        try:
+            summary = run_pipeline(
+                path,
+                sheet_variables,
+                outputs[path],
+                sheet_names=sheet_names,
+                cache=cache,
+                writer=writer,
+                file_format=file_format,
+                resume=resume,
+                pool=pool,
+                checkpoints=checkpoints,
+                dispatcher=dispatcher,
+                compiled_rules=compiled_rules,
+            )
+            return _file_entry(path, outputs[path], summary)
+        except Exception as e:
+            logger.error("工作簿处理失败: %s: %s", path, str(e), exc_info=True)
+            return {
+                "input": path,
+                "output": None,
+                "status": STATUS_ERROR,
+                "elapsed": round(time.time() - file_start, 3),
+                "error": str(e),
+            }
+
+    executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="batch")
+    try:
+        futures = {executor.submit(process, path): path for path in paths}
+        for future in as_completed(futures):
+            entry = future.result()
+            entries[futures[future]] = entry
+            done = len(entries)
+            logger.info("批量进度 %s/%s: %s (%s)", done, len(paths), entry["input"], entry["status"])
+            if progress is not None:
+                progress(done, len(paths), entry)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if pool is not None:
+            pool.shutdown()
+        if checkpoints is not None:
+            checkpoints.close()
+        cache.close()
+
+    files = [entries[path] for path in paths if path in entries]
+    counts = {
+        status: sum(1 for entry in files if entry["status"] == status)
+        for status in (STATUS_OK, STATUS_PARTIAL, STATUS_ERROR)
+    }
+    if files and counts[STATUS_ERROR] == len(files):
+        status = STATUS_ERROR
+    elif counts[STATUS_ERROR] or counts[STATUS_PARTIAL]:
+        status = STATUS_PARTIAL
+    else:
+        status = STATUS_OK
+    processed = [entry for entry in files if entry["status"] != STATUS_ERROR]
+    batch_summary = {
+        "status": status,
+        "files": files,
+        "totals": {
+            "files": len(files),
+            "ok": counts[STATUS_OK],
+            "partial": counts[STATUS_PARTIAL],
+            "failed": counts[STATUS_ERROR],
+            "rows": sum(entry["rows"] for entry in processed),
+            "ai_unique_texts": sum(entry["ai_unique_texts"] for entry in processed),
+            "ai_cached": sum(entry["ai_cached"] for entry in processed),
+            "ai_shared": sum(entry["ai_shared"] for entry in processed),
+            "ai_requests": sum(entry["ai_requests"] for entry in processed),
+            "ai_failures": len({text for entry in processed for text in entry["failures"]}),
+        },
+        "batch_workers": batch_workers,
+        "elapsed": round(time.time() - start_time, 3),
+    }
+    logger.info(
+        "批量处理完成: 成功 %s, 部分失败 %s, 失败 %s; AI请求 %s 次, 跨工作簿共享 %s 条, 用时 %.1f秒",
+        counts[STATUS_OK],
+        counts[STATUS_PARTIAL],
+        counts[STATUS_ERROR],
+        batch_summary["totals"]["ai_requests"],
+        batch_summary["totals"]["ai_shared"],
+        batch_summary["elapsed"],
+    )
+
+    if summary_path is None and output_dir:
+        summary_path = os.path.join(output_dir, SUMMARY_FILE_NAME)
+    if summary_path:
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(batch_summary, f, ensure_ascii=False, indent=2)
+        batch_summary["summary_path"] = summary_path
+    return batch_summary
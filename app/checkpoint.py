@@ -0,0 +1,195 @@
+﻿import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from .ai_cache import PROMPT_HASH
+from .ai_extractor import resolve_model
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_PATH = "ai_checkpoints.sqlite3"
+DEFAULT_CHECKPOINT_TTL_DAYS = 7
+SQLITE_MAX_PARAMS = 500
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def source_fingerprint(source) -> Optional[str]:
+    """输入工作簿内容的哈希：CachedWorkbook 直接用登记时的哈希，路径按文件内容计算；无法确定时为 None"""
+    if hasattr(source, "key"):
+        return source.key
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    if hasattr(source, "getvalue"):
+        digest.update(source.getvalue())
+        return digest.hexdigest()
+    return None
+
+
+def run_key(
+    input_hash: str, sheet_variables: Dict[str, dict], sheet_names: List[str], model: Optional[str] = None
+) -> str:
+    """断点键：输入内容哈希 + 选中工作表的规则配置 + 模型 + 提示词哈希"""
+    config = {name: sheet_variables.get(name, {}) for name in sheet_names}
+    payload = json.dumps(
+        [input_hash, config, resolve_model(model), PROMPT_HASH], ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class CheckpointStore:
+    """AI提取断点：每个批次完成后立即落盘（SQLite WAL，synchronous=FULL）
+
+    以 (输入文件, 配置) 为键；进程崩溃、取消或接口故障后重新运行同一文件和配置时，
+    已完成批次的结果直接复用，只请求剩余部分。运行完整结束后删除对应断点。
+    """
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH, ttl_seconds: Optional[float] = DEFAULT_CHECKPOINT_TTL_DAYS * 86400):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ai_checkpoint (
+                run_key TEXT NOT NULL,
+                text TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (run_key, text)
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ai_checkpoint_runs (
+                run_key TEXT PRIMARY KEY,
+                batches INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.expire()
+        logger.info("AI断点已打开: %s", path)
+
+    @classmethod
+    def from_settings(cls) -> Optional["CheckpointStore"]:
+        """按 CHECKPOINT_PATH / CHECKPOINT_TTL_DAYS 创建；CHECKPOINT_PATH 设为空时不启用断点"""
+        path = AI_CONFIG.get("CHECKPOINT_PATH", DEFAULT_CHECKPOINT_PATH)
+        if not path:
+            return None
+        ttl_days = AI_CONFIG.get("CHECKPOINT_TTL_DAYS", DEFAULT_CHECKPOINT_TTL_DAYS)
+        return cls(path, float(ttl_days) * 86400 if ttl_days else None)
+
+    def open_run(
+        self, source, sheet_variables: Dict[str, dict], sheet_names: List[str], model: Optional[str] = None
+    ) -> Optional["CheckpointRun"]:
+        """返回本次运行（按 model 区分）的断点；无法计算输入哈希时返回 None"""
+        input_hash = source_fingerprint(source)
+        if input_hash is None:
+            logger.warning("无法确定输入文件哈希，本次运行不记录断点")
+            return None
+        return CheckpointRun(self, run_key(input_hash, sheet_variables, sheet_names, model))
+
+    def expire(self) -> int:
+        """删除超过保留期的断点，返回删除的运行数"""
+        if not self.ttl_seconds:
+            return 0
+        with self.lock:
+            keys = [
+                key for (key,) in self.conn.execute(
+                    "SELECT run_key FROM ai_checkpoint_runs WHERE updated_at < ?", (time.time() - self.ttl_seconds,)
+                ).fetchall()
+            ]
+        for key in keys:
+            self.clear(key)
+        if keys:
+            logger.info("AI断点过期清理 %s 个", len(keys))
+        return len(keys)
+
+    def load(self, key: str, texts: Iterable[str]) -> Dict[str, str]:
+        texts = list(dict.fromkeys(texts))
+        found: Dict[str, str] = {}
+        with self.lock:
+            for start in range(0, len(texts), SQLITE_MAX_PARAMS):
+                chunk = texts[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT text, value FROM ai_checkpoint WHERE run_key = ? AND text IN ({placeholders})",
+                    [key, *chunk],
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def batches(self, key: str) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT batches FROM ai_checkpoint_runs WHERE run_key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def record(self, key: str, mapping: Dict[str, str]) -> None:
+        """在一个事务中写入一个已完成批次的结果"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO ai_checkpoint (run_key, text, value) VALUES (?, ?, ?)",
+                    [(key, text, value) for text, value in mapping.items()],
+                )
+                self.conn.execute(
+                    "INSERT INTO ai_checkpoint_runs (run_key, batches, updated_at) VALUES (?, 1, ?) "
+                    "ON CONFLICT(run_key) DO UPDATE SET batches = batches + 1, updated_at = excluded.updated_at",
+                    (key, time.time()),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def clear(self, key: str) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM ai_checkpoint WHERE run_key = ?", (key,))
+                self.conn.execute("DELETE FROM ai_checkpoint_runs WHERE run_key = ?", (key,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class CheckpointRun:
+    """一次运行（输入文件 + 配置）的断点句柄，供 execute_texts 读写"""
+
+    def __init__(self, store: CheckpointStore, key: str):
+        self.store = store
+        self.key = key
+
+    def load(self, texts: Iterable[str]) -> Dict[str, str]:
+        """上次中断运行中已完成的结果 {文本: 结果}"""
+        return self.store.load(self.key, texts)
+
+    def batches(self) -> int:
+        """上次中断运行已完成的批次数"""
+        return self.store.batches(self.key)
+
+    def record(self, mapping: Dict[str, str]) -> None:
+        if mapping:
+            self.store.record(self.key, mapping)
+
+    def complete(self) -> None:
+        """运行完整结束（无AI失败）后删除断点"""
+        self.store.clear(self.key)
+        logger.info("AI断点已清除: %s", self.key[:12])
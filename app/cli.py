@@ -0,0 +1,174 @@
+﻿"""命令行入口：无界面运行已保存的配置
+
+用法:
+    python -m app.cli 输入.xlsx --config 配置名 [--output 输出.xlsx] [--sheet CM --sheet AE] [--format parquet]
+
+批量模式（多个输入或输入为目录时）:
+    python -m app.cli 目录或多个工作簿 --config 配置名 [--output 输出目录] [--batch-workers 4]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from .batch import STATUS_OK, find_workbooks, run_batch
+from .config_store import get_compiled_rules, get_sheet_variables
+from .pipeline import output_name, run_pipeline
+from .rules import RuleCompileError, validate_sheet_variables
+from .writers import FORMAT_LABELS, FORMAT_XLSX, WRITER_LABELS, WRITER_STYLED
+
+logger = logging.getLogger(__name__)
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_AI_FAILURES = 3
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="医学编码数据预处理器 - 无界面批处理")
+    parser.add_argument("input", nargs="+", help="输入 Excel 工作簿；给出多个文件或目录时进入批量模式")
+    parser.add_argument("--config", required=True, help="excel_processor_configs.json 中的配置名")
+    parser.add_argument(
+        "--output",
+        help="输出路径，默认在输入文件旁生成 *_processed.xlsx；非 xlsx 格式可指定目录或 .zip；批量模式下为输出目录",
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FORMAT_LABELS),
+        default=FORMAT_XLSX,
+        dest="file_format",
+        help="输出格式: xlsx / parquet / parquet_dataset / feather / csv",
+    )
+    parser.add_argument("--sheet", action="append", dest="sheets", help="只处理指定工作表，可重复；默认全部")
+    parser.add_argument(
+        "--writer",
+        choices=list(WRITER_LABELS),
+        default=WRITER_STYLED,
+        help="xlsx 写出方式: styled=xlsxwriter 带样式, openpyxl=openpyxl 只写模式带样式, plain=无样式",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="非AI规则计算的进程数，默认取设置 RULE_WORKERS（未设置时为 1，不启用进程池）",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_false",
+        dest="resume",
+        help="不使用AI断点：不复用上次中断运行的结果，也不记录本次断点",
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        help="批量模式下同时处理的工作簿数，默认取设置 BATCH_WORKERS（未设置时为 4）",
+    )
+    parser.add_argument(
+        "--report",
+        help="将运行报告（含分阶段耗时、token、缓存指标）另存为 JSON 文件；批量模式下默认写入输出目录（--output）的 batch_summary.json",
+    )
+    parser.add_argument("--log-level", default="INFO", help="日志级别，日志输出到 stderr")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        stream=sys.stderr,
+    )
+
+    sheet_variables = get_sheet_variables(args.config)
+    if sheet_variables is None:
+        print(json.dumps({"status": "error", "error": f"配置不存在: {args.config}"}, ensure_ascii=False))
+        return EXIT_USAGE
+
+    # 编译结果按配置文件版本缓存；整个配置有无效规则时交给流水线只校验选中的工作表
+    compiled_rules, rule_errors = get_compiled_rules(args.config)
+    if rule_errors:
+        compiled_rules = None
+
+    if len(args.input) > 1 or os.path.isdir(args.input[0]):
+        return run_batch_mode(args, sheet_variables, compiled_rules)
+
+    input_path = args.input[0]
+    output_path = args.output or os.path.join(
+        os.path.dirname(input_path), output_name(os.path.basename(input_path), args.file_format)
+    )
+
+    try:
+        summary = run_pipeline(
+            input_path,
+            sheet_variables,
+            output_path,
+            sheet_names=args.sheets,
+            writer=args.writer,
+            file_format=args.file_format,
+            workers=args.workers,
+            resume=args.resume,
+            compiled_rules=compiled_rules,
+        )
+    except RuleCompileError as e:
+        print(json.dumps({"status": "error", "error": f"规则配置错误: {str(e)}"}, ensure_ascii=False))
+        return EXIT_USAGE
+    except Exception as e:
+        logger.error("处理失败: %s", str(e), exc_info=True)
+        print(json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False))
+        return EXIT_FAILED
+
+    summary["config"] = args.config
+    summary["status"] = "partial" if summary["failures"] else "ok"
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return EXIT_AI_FAILURES if summary["failures"] else EXIT_OK
+
+
+def run_batch_mode(args, sheet_variables, compiled_rules=None):
+    """批量模式：共享AI缓存与调度处理全部输入，输出汇总；有工作簿失败时退出码为 1"""
+    inputs = find_workbooks(args.input)
+    if not inputs:
+        print(json.dumps({"status": "error", "error": "没有找到要处理的工作簿"}, ensure_ascii=False))
+        return EXIT_USAGE
+
+    # 规则对所有工作簿相同，运行前校验一次
+    rule_errors = validate_sheet_variables(
+        {name: sheet_variables[name] for name in args.sheets if name in sheet_variables}
+        if args.sheets else sheet_variables
+    )
+    if rule_errors:
+        print(json.dumps({"status": "error", "error": "规则配置错误: " + "; ".join(rule_errors)}, ensure_ascii=False))
+        return EXIT_USAGE
+
+    try:
+        summary = run_batch(
+            inputs,
+            sheet_variables,
+            output_dir=args.output,
+            sheet_names=args.sheets,
+            writer=args.writer,
+            file_format=args.file_format,
+            workers=args.workers,
+            batch_workers=args.batch_workers,
+            resume=args.resume,
+            summary_path=args.report,
+            compiled_rules=compiled_rules,
+        )
+    except Exception as e:
+        logger.error("批量处理失败: %s", str(e), exc_info=True)
+        print(json.dumps({"status": "error", "error": str(e)}, ensure_ascii=False))
+        return EXIT_FAILED
+
+    summary["config"] = args.config
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if summary["totals"]["failed"]:
+        return EXIT_FAILED
+    return EXIT_OK if summary["status"] == STATUS_OK else EXIT_AI_FAILURES
+
+
+if __name__ == "__main__":
+    sys.exit(main())
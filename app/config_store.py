@@ -1,32 +1,171 @@
-﻿import json
+﻿import copy
+import json
 import logging
+import os
+import stat
+import tempfile
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
 
 import streamlit as st
 
+from .rules import compile_sheet_variables
+from .settings import AI_CONFIG
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+    import msvcrt
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONFIG_PATH = "excel_processor_configs.json"
 
-def load_all_configs():
-    logger.info("尝试加载所有配置")
-    try:
-        with open("excel_processor_configs.json", "r", encoding="utf-8") as f:
-            configs = json.load(f)
+_UNLOADED = object()
+
+
+@contextmanager
+def _file_lock(path: str):
+    """跨进程互斥锁（旁路 .lock 文件），保护读-改-写"""
+    with open(path + ".lock", "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ConfigStore:
+    """配置文件的进程内缓存：按文件 (inode, mtime, 大小) 判断是否需要重新解析
+
+    写入时持有文件锁并基于磁盘上的最新内容修改，写临时文件后原子替换，多用户同时保存不会互相覆盖。
+    每个配置的规则编译结果（CompiledRule 列表与校验错误）按文件版本缓存。
+    """
+
+    def __init__(self, path: str = DEFAULT_CONFIG_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.configs: Dict[str, dict] = {}
+        self.version: object = _UNLOADED
+        # {配置名: (文件版本, {工作表: {变量: [CompiledRule]}}, 错误列表)}
+        self.compiled_cache: Dict[str, Tuple[object, Dict[str, Dict[str, list]], List[str]]] = {}
+
+    def _file_version(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                configs = json.load(f)
             logger.info("配置加载成功: 共 %s 个配置", len(configs))
             return configs
-    except FileNotFoundError:
-        logger.warning("配置文件不存在，返回空配置")
-        return {}
-    except Exception as e:
-        logger.error("配置加载失败: %s", str(e), exc_info=True)
-        return {}
+        except FileNotFoundError:
+            logger.warning("配置文件不存在，返回空配置")
+            return {}
 
+    def _write(self, configs: Dict[str, dict]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".configs-", suffix=".tmp", dir=directory)
+        try:
+            # mkstemp 创建的文件权限为 0600，沿用原文件权限
+            try:
+                os.chmod(temp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+            except FileNotFoundError:
+                os.chmod(temp_path, 0o644)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(configs, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
-def save_all_configs(all_configs):
-    logger.info("尝试保存配置: 共 %s 个", len(all_configs))
+    def load_all(self) -> Dict[str, dict]:
+        """全部配置（只读，修改前请先 copy）；文件未变化时直接返回缓存"""
+        version = self._file_version()
+        with self.lock:
+            if version != self.version:
+                try:
+                    self.configs = self._read()
+                except Exception as e:
+                    logger.error("配置加载失败: %s", str(e), exc_info=True)
+                    self.configs = {}
+                self.version = version
+                self.compiled_cache.clear()
+            return self.configs
+
+    def get_sheet_variables(self, config_name: str) -> Optional[Dict[str, dict]]:
+        """配置的 sheet_variables 副本，不存在时返回 None"""
+        config = self.load_all().get(config_name)
+        return copy.deepcopy(config["sheet_variables"]) if config is not None else None
+
+    def compiled_rules(self, config_name: str) -> Tuple[Dict[str, Dict[str, list]], List[str]]:
+        """配置的编译结果 ({工作表: {变量: [CompiledRule]}}, 错误列表)，同一文件版本内只编译一次（只读，勿修改）"""
+        configs = self.load_all()
+        with self.lock:
+            cached = self.compiled_cache.get(config_name)
+            if cached is not None and cached[0] == self.version:
+                return cached[1], cached[2]
+            version = self.version
+        config = configs.get(config_name)
+        compiled, errors = compile_sheet_variables(config["sheet_variables"]) if config is not None else ({}, [])
+        with self.lock:
+            if self.version == version:
+                self.compiled_cache[config_name] = (version, compiled, errors)
+        return compiled, errors
+
+    def rule_errors(self, config_name: str) -> List[str]:
+        """配置的规则校验结果，同一文件版本内只编译一次"""
+        return self.compiled_rules(config_name)[1]
+
+    def update(self, mutate: Callable[[Dict[str, dict]], None]) -> None:
+        """在文件锁内读取磁盘上的最新配置，调用 mutate 修改后原子写回"""
+        with self.lock, _file_lock(self.path):
+            configs = self._read()
+            mutate(configs)
+            self._write(configs)
+            self.configs = configs
+            self.version = self._file_version()
+            self.compiled_cache.clear()
+
+
+_default_store: Optional[ConfigStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_config_store() -> ConfigStore:
+    """进程内共享的配置存储，路径取 settings 中的 CONFIG_PATH"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ConfigStore(AI_CONFIG.get("CONFIG_PATH", DEFAULT_CONFIG_PATH))
+        return _default_store
+
+
+def load_all_configs():
+    return get_config_store().load_all()
+
+
+def _update_configs(mutate) -> bool:
     try:
-        with open("excel_processor_configs.json", "w", encoding="utf-8") as f:
-            json.dump(all_configs, f, ensure_ascii=False, indent=2)
+        get_config_store().update(mutate)
         logger.info("配置保存成功")
         return True
     except Exception as e:
@@ -35,24 +174,50 @@ def save_all_configs(all_configs):
         return False
 
 
+def save_all_configs(all_configs):
+    logger.info("尝试保存配置: 共 %s 个", len(all_configs))
+
+    def replace(configs):
+        configs.clear()
+        configs.update(copy.deepcopy(all_configs))
+
+    return _update_configs(replace)
+
+
 def save_current_config(config_name):
     logger.info("保存当前配置: %s", config_name)
-    all_configs = load_all_configs()
-    all_configs[config_name] = {
-        "sheet_variables": st.session_state.sheet_variables,
+    entry = {
+        "sheet_variables": copy.deepcopy(st.session_state.sheet_variables),
         "saved_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
-    result = save_all_configs(all_configs)
+    result = _update_configs(lambda configs: configs.__setitem__(config_name, entry))
     if result:
         logger.info("配置 '%s' 保存成功", config_name)
     return result
 
 
+def get_sheet_variables(config_name):
+    """按名称返回已保存配置的 sheet_variables，不存在时返回 None（不依赖 session_state）"""
+    sheet_variables = get_config_store().get_sheet_variables(config_name)
+    if sheet_variables is None:
+        logger.warning("配置 '%s' 不存在", config_name)
+    return sheet_variables
+
+
+def get_compiled_rules(config_name):
+    """已保存配置的编译结果 ({工作表: {变量: [CompiledRule]}}, 错误列表)，按配置文件版本缓存"""
+    return get_config_store().compiled_rules(config_name)
+
+
 def load_config(config_name):
     logger.info("加载配置: %s", config_name)
-    all_configs = load_all_configs()
-    if config_name in all_configs:
-        st.session_state.sheet_variables = all_configs[config_name]["sheet_variables"]
+    store = get_config_store()
+    sheet_variables = store.get_sheet_variables(config_name)
+    if sheet_variables is not None:
+        st.session_state.sheet_variables = sheet_variables
+        for error in store.rule_errors(config_name):
+            logger.warning("配置 '%s' 规则无效: %s", config_name, error)
+            st.warning(f"⚠️ {error}")
         logger.info("配置 '%s' 加载成功", config_name)
         return True
     logger.warning("配置 '%s' 不存在", config_name)
@@ -61,12 +226,10 @@ def load_config(config_name):
 
 def delete_config(config_name):
     logger.info("删除配置: %s", config_name)
-    all_configs = load_all_configs()
-    if config_name in all_configs:
-        del all_configs[config_name]
-        result = save_all_configs(all_configs)
-        if result:
-            logger.info("配置 '%s' 删除成功", config_name)
-        return result
-    logger.warning("配置 '%s' 不存在，无需删除", config_name)
-    return False
+    if config_name not in load_all_configs():
+        logger.warning("配置 '%s' 不存在，无需删除", config_name)
+        return False
+    result = _update_configs(lambda configs: configs.pop(config_name, None))
+    if result:
+        logger.info("配置 '%s' 删除成功", config_name)
+    return result
@@ -0,0 +1,162 @@
+﻿import json
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 剂型后缀（按最长匹配剥离，故组合剂型需单独列出）
+DOSAGE_FORMS = [
+    "片", "片剂", "薄膜衣片", "糖衣片", "肠溶片", "缓释片", "控释片", "分散片", "咀嚼片", "泡腾片",
+    "含片", "口腔崩解片", "舌下片", "阴道片",
+    "胶囊", "软胶囊", "硬胶囊", "肠溶胶囊", "缓释胶囊", "控释胶囊",
+    "颗粒", "颗粒剂", "干混悬剂", "散", "散剂", "丸", "滴丸", "水丸", "蜜丸", "浓缩丸",
+    "注射液", "注射剂", "混合注射液", "粉针", "输液", "大输液",
+    "口服液", "口服溶液", "合剂", "糖浆", "糖浆剂", "酊", "酊剂", "液", "溶液", "混悬液", "乳剂", "乳膏",
+    "软膏", "凝胶", "乳膏剂", "眼膏", "眼用凝胶", "滴眼液", "滴耳液", "滴鼻液", "喷鼻剂", "鼻喷雾剂",
+    "滴剂", "喷雾剂", "气雾剂", "吸入剂", "粉雾剂", "吸入粉雾剂", "吸入气雾剂",
+    "搽剂", "涂剂", "洗剂", "贴剂", "贴膏", "膏剂", "栓", "栓剂", "膜剂", "锭",
+]
+
+# 以剂型字结尾但整体是名称的一部分，不剥离（如“饮片”的“片”）
+NON_FORM_SUFFIXES = ["饮片"]
+
+# 给药途径前缀
+ROUTE_PREFIXES = ["吸入用", "注射用", "注射液用", "口服用", "外用", "静脉用"]
+
+# 可整体删除的括号内限定语
+QUALIFIERS = [
+    "Ⅰ", "Ⅱ", "Ⅲ", "Ⅳ", "Ⅴ", "I", "II", "III", "IV", "V",
+    "胶囊型", "儿童型", "成人型", "儿童", "成人", "小儿", "无糖型", "含糖型", "薄膜衣",
+]
+
+PERCENT_PREFIX = re.compile(r"^\s*\d+(?:\.\d+)?\s*[%％]\s*")
+PAREN_SUFFIX = re.compile(r"\s*[（(]([^（）()]*)[）)]\s*$")
+DOSE_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*(?:mg|g|ml|μg|ug|iu|u|万单位|单位|毫克|克|毫升|%|％)", re.IGNORECASE)
+AMBIGUOUS_PATTERN = re.compile(r"[\s/+、,，;；:：]")
+
+MIN_CORE_LENGTH = 2
+
+
+class SuffixTrie:
+    """倒序字典树：O(文本长度) 查找最长匹配后缀"""
+
+    def __init__(self, words: Iterable[str]):
+        self.root: Dict[str, dict] = {}
+        for word in words:
+            node = self.root
+            for char in reversed(word):
+                node = node.setdefault(char, {})
+            node[""] = word
+
+    def longest_suffix(self, text: str) -> Optional[str]:
+        node = self.root
+        found = None
+        for char in reversed(text):
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get("", found)
+        return found
+
+
+class DrugLexicon:
+    """本地确定性预提取：剥离剂型、给药途径、百分比浓度和括号限定语
+
+    只有在确实剥离了剂型/途径/浓度，且剩余部分不含剂量、分隔符等歧义特征时才视为可确定，
+    其余条目交给AI处理。
+    """
+
+    def __init__(
+        self,
+        dosage_forms: Iterable[str] = DOSAGE_FORMS,
+        route_prefixes: Iterable[str] = ROUTE_PREFIXES,
+        qualifiers: Iterable[str] = QUALIFIERS,
+        non_form_suffixes: Iterable[str] = NON_FORM_SUFFIXES,
+    ):
+        self.forms = SuffixTrie(dosage_forms)
+        self.non_form_suffixes = tuple(non_form_suffixes)
+        self.route_prefixes = sorted(set(route_prefixes), key=len, reverse=True)
+        self.qualifiers = set(qualifiers)
+
+    @classmethod
+    def from_file(cls, path: str) -> "DrugLexicon":
+        """从 JSON 文件加载词表：{"dosage_forms": [...], "route_prefixes": [...], "qualifiers": [...], "non_form_suffixes": [...]}
+
+        文件中的词条追加到内置词表上。
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            extra = json.load(f)
+        return cls(
+            DOSAGE_FORMS + list(extra.get("dosage_forms", [])),
+            ROUTE_PREFIXES + list(extra.get("route_prefixes", [])),
+            QUALIFIERS + list(extra.get("qualifiers", [])),
+            NON_FORM_SUFFIXES + list(extra.get("non_form_suffixes", [])),
+        )
+
+    def resolve(self, text: str) -> Optional[str]:
+        """返回可确定的核心成分；无法确定时返回 None"""
+        core = text.strip()
+        stripped = False
+
+        while True:
+            match = PAREN_SUFFIX.search(core)
+            if not match:
+                break
+            if match.group(1).strip() not in self.qualifiers:
+                return None
+            core = core[: match.start()]
+            stripped = True
+
+        percent = PERCENT_PREFIX.match(core)
+        if percent:
+            core = core[percent.end():]
+            stripped = True
+
+        for prefix in self.route_prefixes:
+            if core.startswith(prefix):
+                core = core[len(prefix):]
+                stripped = True
+                break
+
+        form = None if core.endswith(self.non_form_suffixes) else self.forms.longest_suffix(core)
+        if form and len(core) - len(form) >= MIN_CORE_LENGTH:
+            core = core[: -len(form)]
+            stripped = True
+
+        if not stripped or len(core) < MIN_CORE_LENGTH:
+            return None
+        if DOSE_PATTERN.search(core) or AMBIGUOUS_PATTERN.search(core):
+            return None
+        if self.forms.longest_suffix(core):
+            return None
+        return core
+
+    def resolve_many(self, texts: List[str]) -> Tuple[Dict[str, str], List[str]]:
+        """批量预提取，返回 ({文本: 核心成分}, 需交给AI的文本)"""
+        resolved: Dict[str, str] = {}
+        remaining: List[str] = []
+        for text in texts:
+            core = self.resolve(text)
+            if core is None:
+                remaining.append(text)
+            else:
+                resolved[text] = core
+        return resolved, remaining
+
+
+_default_lexicon: Optional[DrugLexicon] = None
+
+
+def get_lexicon() -> Optional[DrugLexicon]:
+    """按 settings 返回本地词表；LOCAL_PREEXTRACT 为 False 时返回 None"""
+    global _default_lexicon
+    if not AI_CONFIG.get("LOCAL_PREEXTRACT", True):
+        return None
+    if _default_lexicon is None:
+        path = AI_CONFIG.get("LEXICON_PATH")
+        _default_lexicon = DrugLexicon.from_file(path) if path else DrugLexicon()
+        logger.info("本地剂型词表已加载%s", f": {path}" if path else "")
+    return _default_lexicon
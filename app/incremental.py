@@ -0,0 +1,99 @@
+﻿import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .ai_cache import PROMPT_HASH
+from .ai_extractor import resolve_model
+from .rules import compile_rules
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_VARIABLES = 256
+
+
+def referenced_columns(rules) -> List[str]:
+    """变量规则引用的全部列（条件列与取值列），按名称排序"""
+    columns = set()
+    for rule in compile_rules(rules):
+        if rule.condition_column:
+            columns.add(rule.condition_column)
+        if rule.extract_value_type != "固定文本" and rule.extract_value:
+            columns.add(rule.extract_value)
+    return sorted(columns)
+
+
+def rule_fingerprint(var_config: dict, present_columns: List[str], model: Optional[str] = None) -> str:
+    """变量配置指纹：规则、分隔符、实际存在的引用列；含AI规则时再加上模型与提示词版本"""
+    rules = var_config.get("rules", [])
+    payload = {
+        "rules": rules,
+        "separator": var_config.get("separator", ";"),
+        "columns": present_columns,
+    }
+    if any(r.get("extract_type") == "AI提取" for r in rules):
+        payload["ai"] = [resolve_model(model), PROMPT_HASH]
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def row_fingerprints(df: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    """按行计算引用列内容的 64 位哈希（与行位置、索引无关）"""
+    if not columns:
+        return np.zeros(len(df), dtype=np.uint64)
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+class IncrementalStore:
+    """按 (工作表, 变量, 规则指纹) 保存派生结果：规则指纹相同时，输入未变的行直接复用
+
+    进程内多个用户的配置可能定义同名变量，指纹纳入键中使它们各自保留一份，不会互相覆盖；
+    规则完全相同的变量共用同一份（结果只由规则和引用列内容决定）。按 LRU 保留最多 max_variables 份。
+    行以引用列内容的哈希对齐，插入、删除、重排行都不影响复用。
+    """
+
+    def __init__(self, max_variables: int = DEFAULT_MAX_VARIABLES):
+        self.max_variables = max_variables
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Tuple[str, str, str], pd.Series]" = OrderedDict()
+
+    def lookup(self, sheet_name: str, var_name: str, fingerprint: str, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """返回 (复用的值, 需要重算的行掩码)"""
+        values = np.full(len(hashes), "", dtype=object)
+        key = (sheet_name, var_name, fingerprint)
+        with self.lock:
+            stored = self.entries.get(key)
+            if stored is not None:
+                self.entries.move_to_end(key)
+        if stored is None:
+            return values, np.ones(len(hashes), dtype=bool)
+
+        found = stored.index.get_indexer(hashes)
+        missing = found < 0
+        values[~missing] = stored.to_numpy()[found[~missing]]
+        return values, missing
+
+    def save(
+        self,
+        sheet_name: str,
+        var_name: str,
+        fingerprint: str,
+        hashes: np.ndarray,
+        values: np.ndarray,
+        exclude: Optional[np.ndarray] = None,
+    ) -> None:
+        """保存本次结果；exclude 为不应复用的行（如AI提取失败的行）"""
+        keep = ~exclude if exclude is not None else slice(None)
+        stored = pd.Series(values[keep], index=pd.Index(hashes[keep]), dtype=object)
+        stored = stored[~stored.index.duplicated()]
+        key = (sheet_name, var_name, fingerprint)
+        with self.lock:
+            self.entries[key] = stored
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_variables:
+                self.entries.popitem(last=False)
@@ -0,0 +1,298 @@
+﻿import io
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .metrics import RunMetrics
+from .pipeline import ProcessingCancelled, output_name, process_workbook, write_output
+from .settings import AI_CONFIG
+from .writers import FORMAT_XLSX, WRITER_STYLED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_RETENTION_SECONDS = 3600
+MAX_JOB_MESSAGES = 200
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+STATUS_LABELS = {
+    STATUS_QUEUED: "排队中",
+    STATUS_RUNNING: "处理中",
+    STATUS_DONE: "已完成",
+    STATUS_FAILED: "失败",
+    STATUS_CANCELLED: "已取消",
+}
+
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MIME = "application/zip"
+
+
+class Job:
+    """一个后台任务：状态、进度（工作表/变量/AI批次与预计剩余时间）、取消标记与结果"""
+
+    def __init__(
+        self,
+        owner: str,
+        title: str,
+        target: Callable[["Job"], Dict[str, object]],
+        on_finish: Optional[Callable[[], None]] = None,
+    ):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.title = title
+        self.target = target
+        self.on_finish = on_finish
+        self.status = STATUS_QUEUED
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.result: Optional[Dict[str, object]] = None
+        self.error = ""
+        self.lock = threading.Lock()
+        self.messages: deque = deque(maxlen=MAX_JOB_MESSAGES)
+        self.sheet = ""
+        self.variable = ""
+        # {"items"/"batch": (起始完成数, 起始时间, 完成数, 总数)}
+        self.counters: Dict[str, Tuple[int, float, int, int]] = {}
+
+    def progress(self, message: str, **fields) -> None:
+        """pipeline 的进度回调：记录消息和结构化进度"""
+        now = time.time()
+        with self.lock:
+            self.messages.append(f"{time.strftime('%H:%M:%S', time.localtime(now))} {message.strip()}")
+            if "sheet" in fields:
+                self.sheet = fields["sheet"]
+                self.variable = fields.get("variable", "")
+            for key in ("items", "batch"):
+                if key in fields:
+                    done, total = fields[key]
+                    base = self.counters.get(key)
+                    if base is None or done < base[2]:
+                        base = (done, now, done, total)
+                    self.counters[key] = (base[0], base[1], done, total)
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def finish(self) -> None:
+        """任务结束（完成、失败或取消）时调用一次：释放 target 与 on_finish 持有的资源"""
+        self.finished = time.time()
+        self.target = None
+        on_finish, self.on_finish = self.on_finish, None
+        if on_finish is not None:
+            try:
+                on_finish()
+            except Exception as e:
+                logger.error("任务结束回调失败: %s: %s", self.id, str(e), exc_info=True)
+
+    def eta(self) -> Optional[float]:
+        """按AI进度（流式逐条优先，否则按批次）线性估算剩余秒数；无法估算时为 None"""
+        with self.lock:
+            counter = self.counters.get("items") or self.counters.get("batch")
+        if counter is None:
+            return None
+        base_done, since, done, total = counter
+        if done >= total or done <= base_done:
+            return None
+        return (time.time() - since) / (done - base_done) * (total - done)
+
+    def snapshot(self) -> Dict[str, object]:
+        """供界面轮询的进度快照"""
+        with self.lock:
+            counters = {key: (value[2], value[3]) for key, value in self.counters.items()}
+            messages = list(self.messages)
+        end = self.finished or time.time()
+        return {
+            "id": self.id,
+            "title": self.title,
+            "status": self.status,
+            "sheet": self.sheet,
+            "variable": self.variable,
+            "batch": counters.get("batch"),
+            "items": counters.get("items"),
+            "eta": self.eta() if self.status == STATUS_RUNNING else None,
+            "elapsed": end - self.started if self.started else 0.0,
+            "messages": messages,
+            "error": self.error,
+        }
+
+
+class JobRunner:
+    """后台任务执行器：固定数量的工作线程，按提交者轮流取任务，一个用户排队多个任务不会饿死其他用户
+
+    已结束的任务（含结果文件）保留 retention 秒后清理。
+    """
+
+    def __init__(self, workers: int = DEFAULT_JOB_WORKERS, retention: float = DEFAULT_JOB_RETENTION_SECONDS):
+        self.workers = max(1, workers)
+        self.retention = retention
+        self.condition = threading.Condition()
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info("后台任务执行器已启动: %s 个工作线程", self.workers)
+
+    @classmethod
+    def from_settings(cls) -> "JobRunner":
+        """按 JOB_WORKERS / JOB_RETENTION_SECONDS 创建"""
+        return cls(
+            int(AI_CONFIG.get("JOB_WORKERS", DEFAULT_JOB_WORKERS)),
+            float(AI_CONFIG.get("JOB_RETENTION_SECONDS", DEFAULT_JOB_RETENTION_SECONDS)),
+        )
+
+    def submit(
+        self,
+        owner: str,
+        title: str,
+        target: Callable[[Job], Dict[str, object]],
+        on_finish: Optional[Callable[[], None]] = None,
+    ) -> Job:
+        """提交任务，target(job) 在工作线程中执行，返回值保存为 job.result
+
+        on_finish 在任务结束（含排队中被取消）时调用一次，用于释放提交时占用的资源（如固定的工作簿）。
+        """
+        job = Job(owner, title, target, on_finish)
+        with self.condition:
+            self._prune()
+            self.jobs[job.id] = job
+            self.queues.setdefault(owner, deque()).append(job)
+            self.condition.notify()
+        logger.info("任务已提交: %s (%s)", job.id, title)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self, owner: str) -> List[Job]:
+        """某个提交者的任务，最新的在前"""
+        with self.condition:
+            return [job for job in reversed(self.jobs.values()) if job.owner == owner]
+
+    def queue_position(self, job: Job) -> int:
+        """排队中的任务前面还有多少个排队任务（按轮转顺序估算）"""
+        with self.condition:
+            if job.status != STATUS_QUEUED:
+                return 0
+            queue = self.queues.get(job.owner, deque())
+            rank = list(queue).index(job) if job in queue else 0
+            return sum(min(len(other), rank + 1) for other in self.queues.values()) - 1
+
+    def cancel(self, job_id: str) -> bool:
+        """取消任务：排队中的直接移除，运行中的在下一个检查点中止"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return False
+            job.cancel()
+            if job.status == STATUS_QUEUED:
+                queue = self.queues.get(job.owner)
+                if queue is not None and job in queue:
+                    queue.remove(job)
+                    if not queue:
+                        del self.queues[job.owner]
+                job.status = STATUS_CANCELLED
+                job.finish()
+        logger.info("任务已取消: %s", job_id)
+        return True
+
+    def _next_job(self) -> Job:
+        with self.condition:
+            while not self.queues:
+                self.condition.wait()
+            owner, queue = next(iter(self.queues.items()))
+            job = queue.popleft()
+            # 取过任务的提交者排到队尾
+            del self.queues[owner]
+            if queue:
+                self.queues[owner] = queue
+            job.status = STATUS_RUNNING
+            job.started = time.time()
+            return job
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            logger.info("任务开始: %s (%s)", job.id, job.title)
+            try:
+                job.result = job.target(job)
+                job.status = STATUS_DONE
+                logger.info("任务完成: %s", job.id)
+            except ProcessingCancelled:
+                job.status = STATUS_CANCELLED
+                logger.info("任务已中止: %s", job.id)
+            except Exception as e:
+                job.error = str(e)
+                job.status = STATUS_FAILED
+                logger.error("任务失败: %s: %s", job.id, str(e), exc_info=True)
+            finally:
+                job.finish()
+
+    def _prune(self) -> None:
+        now = time.time()
+        for job_id in [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished is not None and now - job.finished > self.retention
+        ]:
+            del self.jobs[job_id]
+
+
+def export_workbook(
+    job: Job,
+    source,
+    sheet_variables: Dict[str, dict],
+    sheet_names: List[str],
+    cache,
+    file_name: str,
+    file_format: str = FORMAT_XLSX,
+    writer: str = WRITER_STYLED,
+    incremental=None,
+    pool=None,
+    checkpoints=None,
+    model: Optional[str] = None,
+) -> Dict[str, object]:
+    """后台导出任务：处理工作簿并写出到内存，返回 {data, file_name, mime, summary}
+
+    model 为提交时选择的模型；任务排队或运行期间其他会话切换模型不影响本任务。
+    """
+    metrics = RunMetrics()
+    sheet_frames, summary = process_workbook(
+        source,
+        sheet_variables,
+        sheet_names,
+        cache,
+        progress=job.progress,
+        incremental=incremental,
+        pool=pool,
+        metrics=metrics,
+        cancel=job.cancel_event,
+        checkpoints=checkpoints,
+        model=model,
+    )
+
+    job.progress("写出文件")
+    output = io.BytesIO()
+    with metrics.timer("write", f"xlsx/{writer}" if file_format == FORMAT_XLSX else file_format):
+        write_output(sheet_frames, output, file_format, writer)
+    summary["metrics"] = metrics.report()
+    return {
+        "data": output.getvalue(),
+        "file_name": output_name(file_name, file_format),
+        "mime": XLSX_MIME if file_format == FORMAT_XLSX else ZIP_MIME,
+        "summary": summary,
+    }
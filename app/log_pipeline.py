@@ -0,0 +1,82 @@
+﻿import atexit
+import html
+import logging
+import queue
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Optional
+
+DEFAULT_BUFFER_LINES = 200
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class LogBuffer:
+    """有界环形日志缓冲区：多线程追加，界面按版本号判断是否需要重绘"""
+
+    def __init__(self, max_lines: int = DEFAULT_BUFFER_LINES):
+        self.lines: deque = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+        self.version = 0
+        self.rendered_version = -1
+        self.rendered = ""
+
+    def append(self, line: str) -> None:
+        with self.lock:
+            self.lines.append(line)
+            self.version += 1
+
+    def tail(self) -> List[str]:
+        with self.lock:
+            return list(self.lines)
+
+    def html(self, empty_text: str = "暂无日志") -> str:
+        """转义并拼接后的日志文本；内容未变化时直接返回上次的结果"""
+        with self.lock:
+            if self.rendered_version != self.version:
+                self.rendered = html.escape("\n".join(self.lines)) if self.lines else empty_text
+                self.rendered_version = self.version
+            return self.rendered
+
+
+class BufferHandler(logging.Handler):
+    """将格式化后的日志行写入 LogBuffer"""
+
+    def __init__(self, buffer: LogBuffer):
+        super().__init__()
+        self.buffer = buffer
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(
+    log_path: Optional[str] = "log.log",
+    level: int = logging.INFO,
+    buffer_lines: int = DEFAULT_BUFFER_LINES,
+) -> LogBuffer:
+    """根日志只挂一个 QueueHandler，文件/控制台/环形缓冲区在 QueueListener 的后台线程中写出
+
+    记录日志的线程（界面脚本、后台任务、AI并发线程）只做入队，不再阻塞在文件 IO 上。
+    返回供界面读取的 LogBuffer。应在每个进程中只调用一次。
+    """
+    buffer = LogBuffer(buffer_lines)
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers: List[logging.Handler] = [logging.StreamHandler(), BufferHandler(buffer)]
+    if log_path:
+        handlers.insert(0, logging.FileHandler(log_path, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(QueueHandler(log_queue))
+    return buffer
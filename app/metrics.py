@@ -0,0 +1,132 @@
+﻿import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from .ai_dispatcher import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEYS = ("prompt", "completion", "cached")
+
+
+def _usage_value(obj: object, name: str) -> int:
+    value = getattr(obj, name, None)
+    if value is None and isinstance(obj, dict):
+        value = obj.get(name)
+    return int(value or 0)
+
+
+class RunMetrics:
+    """一次导出运行的分阶段指标（线程安全）：耗时、AI请求/重试/排队、token、缓存命中
+
+    report() 输出可 JSON 序列化的运行报告。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.request_latency = LatencyTracker()
+        self.queue_wait = LatencyTracker()
+        self.rate_limit_wait = LatencyTracker()
+        self.first_token = LatencyTracker()
+
+    def add_time(self, stage: str, name: str, seconds: float) -> None:
+        """累加某阶段下某项的耗时（同名多次调用时相加）"""
+        with self.lock:
+            items = self.timings.setdefault(stage, {})
+            items[name] = items.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, stage: str, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, name, time.perf_counter() - start)
+
+    def incr(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_request(self, seconds: float, usage: object = None) -> None:
+        """记录一次AI请求的耗时与 resp.usage（兼容 OpenAI 的 cached_tokens 与 DeepSeek 的 prompt_cache_hit_tokens）"""
+        self.request_latency.record(seconds)
+        self.incr("ai_requests")
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = _usage_value(details, "cached_tokens") if details is not None else 0
+        cached = cached or _usage_value(usage, "prompt_cache_hit_tokens")
+        self.incr("tokens_prompt", _usage_value(usage, "prompt_tokens"))
+        self.incr("tokens_completion", _usage_value(usage, "completion_tokens"))
+        self.incr("tokens_cached", cached)
+
+    def request_count(self) -> int:
+        """已发出的AI HTTP请求数（成功与出错之和，含重试和拆批请求）"""
+        with self.lock:
+            return self.counters.get("ai_requests", 0) + self.counters.get("ai_request_errors", 0)
+
+    def record_queue_wait(self, seconds: float) -> None:
+        """批次从提交到开始处理的等待（线程池排队）"""
+        self.queue_wait.record(seconds)
+
+    def record_rate_limit_wait(self, seconds: float) -> None:
+        """一次请求发出前等待限流令牌的时间"""
+        self.rate_limit_wait.record(seconds)
+
+    def record_first_token(self, seconds: float) -> None:
+        """流式请求从发出到收到首段内容的耗时"""
+        self.first_token.record(seconds)
+
+    def stage_rows(self) -> List[Dict[str, object]]:
+        """[{阶段, 项目, 秒}]，供界面表格展示"""
+        with self.lock:
+            return [
+                {"stage": stage, "name": name, "seconds": round(seconds, 3)}
+                for stage, items in self.timings.items()
+                for name, seconds in items.items()
+            ]
+
+    def report(self) -> Dict[str, object]:
+        with self.lock:
+            counters = dict(self.counters)
+            totals = {stage: round(sum(items.values()), 3) for stage, items in self.timings.items()}
+        latency = self.request_latency.summary()
+        queue = self.queue_wait.summary()
+        rate_limit = self.rate_limit_wait.summary()
+        first_token = self.first_token.summary()
+        lookups = counters.get("cache_lookups", 0)
+        hits = counters.get("cache_hits", 0)
+        return {
+            "elapsed": round(time.time() - self.started, 3),
+            "stage_totals": totals,
+            "stages": self.stage_rows(),
+            "ai": {
+                "requests": self.request_count(),
+                "retries": counters.get("ai_retries", 0),
+                "request_errors": counters.get("ai_request_errors", 0),
+                "request_latency_p50": round(latency["p50"], 3),
+                "request_latency_p95": round(latency["p95"], 3),
+                "request_latency_p99": round(latency["p99"], 3),
+                "request_latency_max": round(latency["max"], 3),
+                "request_latency_total": round(latency["total"], 3),
+                "queue_wait_p95": round(queue["p95"], 3),
+                "queue_wait_total": round(queue["total"], 3),
+                "rate_limit_wait_total": round(rate_limit["total"], 3),
+                "first_token_p50": round(first_token["p50"], 3),
+                "first_token_p95": round(first_token["p95"], 3),
+            },
+            "tokens": {key: counters.get(f"tokens_{key}", 0) for key in TOKEN_KEYS},
+            "cache": {
+                "lookups": lookups,
+                "hits": hits,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "local": counters.get("local_hits", 0),
+                "resumed": counters.get("checkpoint_hits", 0),
+                "shared": counters.get("shared_hits", 0),
+            },
+        }
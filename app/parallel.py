@@ -0,0 +1,116 @@
+﻿import logging
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from .rules import RuleContext, apply_variable_rules, plan_rules
+from .settings import AI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 默认不启用进程池：spawn 子进程的启动开销（每个进程需重新导入 pandas）通常超过中小工作簿的规则计算耗时
+DEFAULT_RULE_WORKERS = 1
+DEFAULT_CHUNK_ROWS = 20000
+MIN_CHUNK_ROWS = 2000
+# 启用进程池时，待计算行数少于此值的段仍在当前进程内计算（不会为小工作簿启动子进程）
+DEFAULT_PARALLEL_MIN_ROWS = 50000
+
+# 传给子进程的变量规格：(变量名, 规则列表, 分隔符)；规则为 CompiledRule（含已编译的正则，可 pickle）或规则字典
+VariableSpec = Tuple[str, list, str]
+
+
+def get_worker_settings() -> Tuple[int, int, int]:
+    """读取 (进程数, 每块最多行数, 启用进程池的最少行数)"""
+    workers = int(AI_CONFIG.get("RULE_WORKERS", DEFAULT_RULE_WORKERS))
+    chunk_rows = int(AI_CONFIG.get("RULE_CHUNK_ROWS", DEFAULT_CHUNK_ROWS))
+    min_rows = int(AI_CONFIG.get("RULE_PARALLEL_MIN_ROWS", DEFAULT_PARALLEL_MIN_ROWS))
+    return max(1, workers), max(MIN_CHUNK_ROWS, chunk_rows), max(0, min_rows)
+
+
+def evaluate_segment(frame: pd.DataFrame, specs: List[VariableSpec]) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """在一块行上按顺序计算一段非AI变量，返回 (各变量的结果列, {变量: 耗时秒数})（子进程入口）
+
+    段内各变量共享一个 RuleContext：相同的条件和提取只计算一次。
+    """
+    frame = frame.copy()
+    context = RuleContext(frame, plan_rules((rules, separator) for _, rules, separator in specs))
+    timings: Dict[str, float] = {}
+    for var_name, rules, separator in specs:
+        start = time.perf_counter()
+        frame[var_name] = apply_variable_rules(frame, rules, separator, context=context)
+        context.invalidate(var_name)
+        timings[var_name] = time.perf_counter() - start
+    return frame[[spec[0] for spec in specs]], timings
+
+
+class RulePool:
+    """非AI规则的进程池：按行分块提交，结果按原行顺序拼回
+
+    子进程用 spawn 方式启动，首次提交时才创建，之后在多次运行间复用。
+    行数少于 min_rows 的段不值得付出进程启动与数据传输的开销，由调用方在当前进程内计算（见 accepts）。
+    """
+
+    def __init__(self, workers: int, chunk_rows: int = DEFAULT_CHUNK_ROWS, min_rows: int = DEFAULT_PARALLEL_MIN_ROWS):
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.min_rows = min_rows
+        self.lock = threading.Lock()
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def from_settings(cls, workers: Optional[int] = None) -> Optional["RulePool"]:
+        """按 RULE_WORKERS（或显式传入的 workers）创建；进程数为 1 时返回 None（在当前进程内计算）"""
+        default_workers, chunk_rows, min_rows = get_worker_settings()
+        workers = workers or default_workers
+        if workers <= 1:
+            return None
+        return cls(workers, chunk_rows, min_rows)
+
+    def accepts(self, rows: int) -> bool:
+        """该行数的段是否交给进程池"""
+        return rows >= self.min_rows
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info("规则进程池已启动: %s 个进程, 每块最多 %s 行", self.workers, self.chunk_rows)
+            return self.executor
+
+    def _chunk_size(self, rows: int) -> int:
+        # 行数较少时也尽量分给所有进程，但每块不少于 MIN_CHUNK_ROWS
+        return max(MIN_CHUNK_ROWS, min(self.chunk_rows, math.ceil(rows / self.workers)))
+
+    def submit(self, frame: pd.DataFrame, specs: List[VariableSpec]) -> List[Future]:
+        """按行分块提交，返回按行顺序排列的 Future"""
+        executor = self._executor()
+        size = self._chunk_size(len(frame))
+        return [
+            executor.submit(evaluate_segment, frame.iloc[start:start + size], specs)
+            for start in range(0, max(len(frame), 1), size)
+        ]
+
+    @staticmethod
+    def collect(futures: List[Future]) -> Tuple[pd.DataFrame, Dict[str, float]]:
+        """等待全部分块并按原行顺序拼接，耗时为各分块之和"""
+        parts = []
+        timings: Dict[str, float] = {}
+        for future in futures:
+            part, part_timings = future.result()
+            parts.append(part)
+            for var_name, seconds in part_timings.items():
+                timings[var_name] = timings.get(var_name, 0.0) + seconds
+        return pd.concat(parts), timings
+
+    def shutdown(self) -> None:
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
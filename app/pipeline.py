@@ -0,0 +1,596 @@
+﻿import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .ai_cache import AICache
+from .ai_dispatcher import SharedDispatcher
+from .ai_extractor import resolve_model
+from .ai_planner import execute_texts, plan_ai_work, resolve_ai_results, task_text
+from .checkpoint import CheckpointStore
+from .incremental import IncrementalStore, referenced_columns, row_fingerprints, rule_fingerprint
+from .metrics import RunMetrics
+from .parallel import RulePool, evaluate_segment
+from .rules import (
+    RuleCompileError,
+    apply_variable_rules,
+    collect_ai_tasks,
+    missing_columns,
+    plan_rules,
+    compile_sheet_variables,
+)
+from .writers import FORMAT_XLSX, WRITER_STYLED, write_excel, write_sheet_files, write_zip
+
+logger = logging.getLogger(__name__)
+
+# progress(message, **fields)：fields 可能包含 sheet、variable、batch=(完成, 总数)、items=(已返回, 总数)
+ProgressCallback = Optional[Callable[..., None]]
+
+
+class ProcessingCancelled(Exception):
+    """处理被取消（cancel 已置位）"""
+
+
+def _notify(progress: ProgressCallback, message: str, **fields) -> None:
+    logger.info(message)
+    if progress is not None:
+        progress(message, **fields)
+
+
+def _check_cancel(cancel: Optional[threading.Event]) -> None:
+    if cancel is not None and cancel.is_set():
+        raise ProcessingCancelled("处理已取消")
+
+
+def output_name(original_name: str, file_format: str = FORMAT_XLSX) -> str:
+    """处理后文件名：原文件名加 _processed 后缀；xlsx 以外的格式打包为 zip"""
+    if file_format != FORMAT_XLSX:
+        stem = os.path.splitext(original_name)[0]
+        return f"{stem}_processed_{file_format}.zip"
+    if original_name.endswith(".xlsx"):
+        return original_name.replace(".xlsx", "_processed.xlsx")
+    if original_name.endswith(".xls"):
+        return original_name.replace(".xls", "_processed.xlsx")
+    return original_name + "_processed.xlsx"
+
+
+def read_sheets(source, sheet_names: List[str], metrics: Optional[RunMetrics] = None) -> Dict[str, pd.DataFrame]:
+    """以字符串方式读取选中的工作表；source 为 CachedWorkbook 时复用已解析的数据"""
+    sheet_frames = {}
+    for sheet_name in sheet_names:
+        logger.info("读取数据: %s", sheet_name)
+        start = time.perf_counter()
+        if hasattr(source, "get_sheet"):
+            df = source.get_sheet(sheet_name).copy()
+        else:
+            df = pd.read_excel(source, sheet_name=sheet_name, dtype=str)
+        if metrics is not None:
+            metrics.add_time("read", sheet_name, time.perf_counter() - start)
+        logger.info("  数据读取完成: 行数=%s, 列数=%s", len(df), len(df.columns))
+        sheet_frames[sheet_name] = df
+    return sheet_frames
+
+
+def _compute_variable(
+    df: pd.DataFrame,
+    var_name: str,
+    rules: List[dict],
+    separator: str,
+    text_results: Dict[str, str],
+    cache,
+    summary: Dict[str, object],
+    metrics: RunMetrics,
+    label: str,
+    progress: ProgressCallback = None,
+    cancel: Optional[threading.Event] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    model: Optional[str] = None,
+) -> Tuple[pd.Series, List[object]]:
+    """计算一个AI变量，返回 (结果列, AI提取失败的行索引)；label 为指标中的“工作表.变量”"""
+
+    ai_tasks = collect_ai_tasks(df, rules)
+    logger.info("    需要AI处理的任务数: %s", len(ai_tasks))
+
+    # 依赖本表派生列的任务不在全局计划中，此处补充提取
+    missing_texts = list(dict.fromkeys(
+        text for text in (task_text(task[3]) for task in ai_tasks)
+        if text.strip() and text not in text_results
+    ))
+    if missing_texts:
+        _notify(progress, f"    补充AI提取 {var_name}: {len(missing_texts)} 条")
+        with metrics.timer("ai", label):
+            extra_results, extra_stats = execute_texts(
+                missing_texts,
+                cache,
+                column_name=var_name,
+                metrics=metrics,
+                on_idle=lambda: _check_cancel(cancel),
+                dispatcher=dispatcher,
+                model=model,
+            )
+        text_results.update(extra_results)
+        summary["failures"].update(extra_stats["failures"])
+
+    ai_results = resolve_ai_results(ai_tasks, text_results)
+    logger.info("    AI提取完成，共处理 %s 条数据", len(ai_results))
+    failed_rows = [task[0] for task in ai_tasks if task_text(task[3]) in summary["failures"]]
+    with metrics.timer("rules", label):
+        result = apply_variable_rules(df, rules, separator, ai_results=ai_results)
+    return result, failed_rows
+
+
+def _variable_fingerprints(
+    df: pd.DataFrame, var_config: dict, model: Optional[str] = None
+) -> Tuple[str, np.ndarray]:
+    columns = [col for col in referenced_columns(var_config.get("rules", [])) if col in df.columns]
+    return rule_fingerprint(var_config, columns, model), row_fingerprints(df, columns)
+
+
+def _has_ai_rule(rules: List[dict]) -> bool:
+    return any(r.get("extract_type") == "AI提取" for r in rules)
+
+
+def split_segments(sheet_vars: Dict[str, dict]) -> List[Tuple[bool, List[Tuple[str, dict]]]]:
+    """按顺序切分变量：连续的非AI变量合为一段（可整段并行计算），每个AI变量单独成段"""
+    segments: List[Tuple[bool, List[Tuple[str, dict]]]] = []
+    for var_name, var_config in sheet_vars.items():
+        rules = var_config.get("rules", [])
+        if not rules:
+            continue
+        is_ai = _has_ai_rule(rules)
+        if not is_ai and segments and not segments[-1][0]:
+            segments[-1][1].append((var_name, var_config))
+        else:
+            segments.append((is_ai, [(var_name, var_config)]))
+    return segments
+
+
+def _variable_rules(var_name: str, var_config: dict, compiled: Optional[Dict[str, list]] = None) -> list:
+    """变量的规则：有已编译的 CompiledRule 列表时用它，否则用配置中的规则字典"""
+    if compiled is not None and var_name in compiled:
+        return compiled[var_name]
+    return var_config.get("rules", [])
+
+
+def _start_rule_segment(
+    df: pd.DataFrame,
+    segment: List[Tuple[str, dict]],
+    sheet_name: str,
+    summary: Dict[str, object],
+    incremental: Optional[IncrementalStore] = None,
+    pool: Optional[RulePool] = None,
+    compiled: Optional[Dict[str, list]] = None,
+) -> Dict[str, object]:
+    """开始计算一段非AI变量：先查增量结果，再把需要重算的行交给进程池（或在本进程计算）
+
+    compiled 为本表 {变量: [CompiledRule]}，提供时直接使用，不再重复编译。
+    """
+    specs = [(name, _variable_rules(name, config, compiled), config.get("separator", ";")) for name, config in segment]
+    plan_summary = plan_rules((rules, separator) for _, rules, separator in specs).summary()
+    if plan_summary["unique_conditions"] < plan_summary["conditions"] or plan_summary["merged_contains_columns"]:
+        logger.info(
+            "  规则计划: 条件 %s -> %s, 提取 %s -> %s, 合并扫描“包含”的列 %s",
+            plan_summary["conditions"],
+            plan_summary["unique_conditions"],
+            plan_summary["extracts"],
+            plan_summary["unique_extracts"],
+            plan_summary["merged_contains_columns"],
+        )
+    missing = np.ones(len(df), dtype=bool)
+    work = None
+
+    if incremental is not None:
+        # 在浅拷贝上按顺序回填复用值，使后续变量的行指纹与顺序计算时一致
+        work = df.copy(deep=False)
+        missing = np.zeros(len(df), dtype=bool)
+        for var_name, var_config in segment:
+            fingerprint, hashes = _variable_fingerprints(work, var_config)
+            values, var_missing = incremental.lookup(sheet_name, var_name, fingerprint, hashes)
+            missing |= var_missing
+            work[var_name] = pd.Series(values, index=df.index, dtype=object)
+        computed_rows = int(missing.sum())
+        summary["incremental"]["reused_rows"] += (len(df) - computed_rows) * len(segment)
+        summary["incremental"]["computed_rows"] += computed_rows * len(segment)
+
+    columns = sorted({col for _, config in segment for col in referenced_columns(config.get("rules", []))})
+    frame = df[[col for col in columns if col in df.columns]]
+    if not missing.all():
+        frame = frame[missing]
+
+    state: Dict[str, object] = {"specs": specs, "segment": segment, "missing": missing, "work": work}
+    if len(frame) == 0 and len(df):
+        state["result"] = (None, {})
+    elif pool is not None and pool.accepts(len(frame)):
+        state["futures"] = pool.submit(frame, specs)
+    else:
+        state["result"] = evaluate_segment(frame, specs)
+    return state
+
+
+def _finish_rule_segment(
+    df: pd.DataFrame,
+    state: Dict[str, object],
+    sheet_name: str,
+    metrics: RunMetrics,
+    incremental: Optional[IncrementalStore] = None,
+) -> None:
+    """取回一段非AI变量的结果，按原行顺序写入 df 并更新增量结果"""
+    result, timings = RulePool.collect(state["futures"]) if "futures" in state else state["result"]
+    missing = state["missing"]
+    work = state["work"]
+
+    for var_name, var_config in state["segment"]:
+        logger.info("  处理变量: %s", var_name)
+        metrics.add_time("rules", f"{sheet_name}.{var_name}", timings.get(var_name, 0.0))
+        if work is None:
+            df[var_name] = pd.Series(result[var_name].to_numpy(), index=df.index, dtype=object)
+            logger.info("    规则提取完成")
+            continue
+
+        values = work[var_name].to_numpy(copy=True)
+        if result is not None:
+            values[missing] = result[var_name].to_numpy()
+        fingerprint, hashes = _variable_fingerprints(df, var_config)
+        df[var_name] = pd.Series(values, index=df.index, dtype=object)
+        incremental.save(sheet_name, var_name, fingerprint, hashes, values)
+        logger.info("    规则提取完成: 重算 %s 行, 复用 %s 行", int(missing.sum()), int((~missing).sum()))
+
+
+def _compute_ai_variable(
+    df: pd.DataFrame,
+    var_name: str,
+    var_config: dict,
+    text_results: Dict[str, str],
+    cache,
+    summary: Dict[str, object],
+    metrics: RunMetrics,
+    progress: ProgressCallback = None,
+    sheet_name: str = "",
+    incremental: Optional[IncrementalStore] = None,
+    cancel: Optional[threading.Event] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    compiled: Optional[Dict[str, list]] = None,
+    model: Optional[str] = None,
+) -> None:
+    label = f"{sheet_name}.{var_name}"
+    _notify(progress, f"  处理变量: {var_name}", sheet=sheet_name, variable=var_name)
+    separator = var_config.get("separator", ";")
+    rules = _variable_rules(var_name, var_config, compiled)
+    logger.info("    规则数: %s, 分隔符: '%s'", len(rules), separator)
+
+    if incremental is None:
+        df[var_name], _ = _compute_variable(
+            df, var_name, rules, separator, text_results, cache, summary, metrics, label, progress, cancel,
+            dispatcher, model,
+        )
+        return
+
+    fingerprint, hashes = _variable_fingerprints(df, var_config, model)
+    values, missing = incremental.lookup(sheet_name, var_name, fingerprint, hashes)
+    computed_rows = int(missing.sum())
+    summary["incremental"]["reused_rows"] += len(df) - computed_rows
+    summary["incremental"]["computed_rows"] += computed_rows
+
+    failed = np.zeros(len(df), dtype=bool)
+    if computed_rows:
+        target = df if computed_rows == len(df) else df[missing]
+        result, failed_rows = _compute_variable(
+            target, var_name, rules, separator, text_results, cache, summary, metrics, label, progress, cancel,
+            dispatcher, model,
+        )
+        values[missing] = result.to_numpy()
+        failed = df.index.isin(failed_rows)
+        logger.info("    重算 %s 行, 复用 %s 行", computed_rows, len(df) - computed_rows)
+    else:
+        logger.info("    规则与输入均未变化，复用上次结果 (%s 行)", len(df))
+
+    df[var_name] = pd.Series(values, index=df.index, dtype=object)
+    incremental.save(sheet_name, var_name, fingerprint, hashes, values, exclude=failed)
+
+
+def compute_variables(
+    df: pd.DataFrame,
+    sheet_vars: Dict[str, dict],
+    text_results: Dict[str, str],
+    cache,
+    summary: Dict[str, object],
+    progress: ProgressCallback = None,
+    sheet_name: str = "",
+    incremental: Optional[IncrementalStore] = None,
+    pool: Optional[RulePool] = None,
+    started: Optional[Dict[str, object]] = None,
+    metrics: Optional[RunMetrics] = None,
+    cancel: Optional[threading.Event] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    compiled: Optional[Dict[str, list]] = None,
+    model: Optional[str] = None,
+) -> pd.DataFrame:
+    """按顺序计算一个工作表的全部变量，结果列直接写入 df
+
+    连续的非AI变量整段计算（提供 pool 且行数达到 RULE_PARALLEL_MIN_ROWS 时按行分块并行）；提供 incremental 时只重算规则或
+    引用列内容有变化的行。started 为已提前提交的首段非AI变量。cancel 置位后在下一个变量前中止。
+    compiled 为本表 {变量: [CompiledRule]}（见 compile_sheet_variables）；model 为AI变量使用的模型。
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    for seg_idx, (is_ai, segment) in enumerate(split_segments(sheet_vars)):
+        _check_cancel(cancel)
+        if is_ai:
+            var_name, var_config = segment[0]
+            _compute_ai_variable(
+                df, var_name, var_config, text_results, cache, summary, metrics, progress, sheet_name, incremental,
+                cancel,
+                dispatcher,
+                compiled,
+                model,
+            )
+            continue
+
+        var_names = "、".join(name for name, _ in segment)
+        _notify(progress, f"  计算规则变量: {var_names}", sheet=sheet_name, variable=var_names)
+
+        state = started if seg_idx == 0 and started is not None else None
+        if state is None:
+            state = _start_rule_segment(df, segment, sheet_name, summary, incremental, pool, compiled)
+        _finish_rule_segment(df, state, sheet_name, metrics, incremental)
+
+    return df
+
+
+def _pending_rows(
+    sheet_frames: Dict[str, pd.DataFrame],
+    sheet_variables: Dict[str, dict],
+    incremental: IncrementalStore,
+    model: Optional[str] = None,
+) -> Dict[Tuple[str, str], np.ndarray]:
+    """AI变量中需要重算的行（只处理不依赖本表派生列的变量），用于缩小全局AI计划"""
+    row_masks = {}
+    for sheet_name, df in sheet_frames.items():
+        sheet_vars = sheet_variables.get(sheet_name, {})
+        for var_name, var_config in sheet_vars.items():
+            rules = var_config.get("rules", [])
+            if not any(r.get("extract_type") == "AI提取" for r in rules):
+                continue
+            if set(referenced_columns(rules)) & set(sheet_vars):
+                continue
+            fingerprint, hashes = _variable_fingerprints(df, var_config, model)
+            _, missing = incremental.lookup(sheet_name, var_name, fingerprint, hashes)
+            row_masks[(sheet_name, var_name)] = missing
+    return row_masks
+
+
+def process_workbook(
+    source,
+    sheet_variables: Dict[str, dict],
+    sheet_names: List[str],
+    cache,
+    progress: ProgressCallback = None,
+    incremental: Optional[IncrementalStore] = None,
+    pool: Optional[RulePool] = None,
+    metrics: Optional[RunMetrics] = None,
+    cancel: Optional[threading.Event] = None,
+    checkpoints: Optional[CheckpointStore] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    compiled_rules: Optional[Dict[str, Dict[str, list]]] = None,
+    model: Optional[str] = None,
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, object]]:
+    """读取工作簿、执行规则与AI提取，返回 ({工作表: 结果DataFrame}, 运行摘要)
+
+    规则无效时在读取任何数据之前抛出 RuleCompileError；引用了不存在的列的规则见 summary["missing_columns"]。
+    提供 incremental 时复用上次运行中规则和输入都未变化的结果；提供 pool 时各工作表开头的非AI变量
+    在AI提取之前就并行开始计算。
+    分阶段指标记录到 metrics（未提供时新建），报告见 summary["metrics"]。
+    cancel 置位后在下一个检查点（变量之间、等待AI批次期间）抛出 ProcessingCancelled。
+    提供 checkpoints 时AI批次按 (输入文件, 配置) 落盘，中断后重跑从断点继续，复用情况见 summary["resume"]。
+    dispatcher 为多个工作簿同时处理时共享的 SharedDispatcher。
+    compiled_rules 为已校验通过的编译结果（如 ConfigStore 按配置版本缓存的），未提供时在此编译一次。
+    model 为本次运行的模型（界面在提交任务时确定），未提供时在开始时读取设置中的 MODEL；
+    请求、AI缓存、断点和增量指纹都使用同一个模型，运行期间不受设置变化影响。
+    """
+    model = resolve_model(model)
+    if compiled_rules is None:
+        compiled_rules, rule_errors = compile_sheet_variables(
+            {name: sheet_variables.get(name, {}) for name in sheet_names}
+        )
+        if rule_errors:
+            raise RuleCompileError("\n".join(rule_errors))
+
+    start_time = time.time()
+    summary: Dict[str, object] = {"sheets": {}, "ai": None, "failures": {}, "model": model}
+    if metrics is None:
+        metrics = RunMetrics()
+
+    if incremental is not None:
+        summary["incremental"] = {"reused_rows": 0, "computed_rows": 0}
+
+    sheet_frames = read_sheets(source, sheet_names, metrics)
+    _check_cancel(cancel)
+
+    # 引用了不存在的列的规则运行时会被跳过，先集中报告
+    summary["missing_columns"] = [
+        f"{sheet_name}.{problem}"
+        for sheet_name in sheet_names
+        for problem in missing_columns(sheet_variables.get(sheet_name, {}), sheet_frames[sheet_name].columns)
+    ]
+    for problem in summary["missing_columns"]:
+        logger.warning("规则引用的列不存在（该规则将被跳过）: %s", problem)
+
+    # 各表首段非AI变量不依赖AI结果，先提交到进程池，与AI提取同时进行
+    started: Dict[str, Dict[str, object]] = {}
+    if pool is not None:
+        for sheet_name in sheet_names:
+            segments = split_segments(sheet_variables.get(sheet_name, {}))
+            if segments and not segments[0][0]:
+                started[sheet_name] = _start_rule_segment(
+                    sheet_frames[sheet_name],
+                    segments[0][1],
+                    sheet_name,
+                    summary,
+                    incremental,
+                    pool,
+                    compiled_rules.get(sheet_name),
+                )
+
+    row_masks = _pending_rows(sheet_frames, sheet_variables, incremental, model) if incremental is not None else None
+    ai_plan = plan_ai_work(sheet_frames, sheet_variables, row_masks, compiled_rules)
+    checkpoint = None
+    if checkpoints is not None and ai_plan.texts:
+        checkpoint = checkpoints.open_run(source, sheet_variables, sheet_names, model)
+    text_results: Dict[str, str] = {}
+    if ai_plan.texts:
+        _notify(progress, f"AI提取: 全局去重后 {len(ai_plan.texts)} 条")
+        with metrics.timer("ai", "全局"):
+            text_results, ai_stats = execute_texts(
+                ai_plan.texts,
+                cache,
+                on_batch=lambda completed, total: _notify(
+                    progress, f"  AI批次完成 ({completed}/{total})", batch=(completed, total)
+                ),
+                metrics=metrics,
+                on_items=lambda done, total: _notify(progress, f"  AI已返回 {done}/{total} 条", items=(done, total)),
+                on_idle=lambda: _check_cancel(cancel),
+                checkpoint=checkpoint,
+                dispatcher=dispatcher,
+                model=model,
+            )
+        summary["failures"].update(ai_stats.pop("failures"))
+        summary["ai"] = ai_plan.summary(ai_stats)
+        if ai_stats["resumed"]:
+            summary["resume"] = {"texts": ai_stats["resumed"], "batches": ai_stats["resumed_batches"]}
+        logger.info(
+            "AI去重统计: 任务 %s, 唯一文本 %s, 缓存命中 %s, 本地预提取 %s (%.0f%%), 请求数 %s -> %s (节省 %s)",
+            summary["ai"]["tasks"],
+            summary["ai"]["unique_texts"],
+            summary["ai"]["cached"],
+            summary["ai"]["local"],
+            100 * summary["ai"]["local_ratio"],
+            summary["ai"]["requests_before"],
+            summary["ai"]["requests"],
+            summary["ai"]["requests_saved"],
+        )
+
+    for sheet_name in sheet_names:
+        _check_cancel(cancel)
+        _notify(progress, f"处理工作表: {sheet_name}", sheet=sheet_name)
+        df = sheet_frames[sheet_name]
+        sheet_vars = sheet_variables.get(sheet_name, {})
+        if sheet_vars:
+            logger.info("  该工作表有 %s 个变量需要处理", len(sheet_vars))
+            compute_variables(
+                df,
+                sheet_vars,
+                text_results,
+                cache,
+                summary,
+                progress,
+                sheet_name,
+                incremental,
+                pool,
+                started.get(sheet_name),
+                metrics,
+                cancel,
+                dispatcher,
+                compiled_rules.get(sheet_name),
+                model,
+            )
+        summary["sheets"][sheet_name] = {
+            "rows": len(df),
+            "columns": len(df.columns),
+            "variables": list(sheet_vars),
+        }
+
+    if incremental is not None:
+        logger.info(
+            "增量处理: 复用 %s 行, 重算 %s 行",
+            summary["incremental"]["reused_rows"],
+            summary["incremental"]["computed_rows"],
+        )
+    if checkpoint is not None and not summary["failures"]:
+        checkpoint.complete()
+    summary["elapsed"] = round(time.time() - start_time, 3)
+    summary["metrics"] = metrics.report()
+    return sheet_frames, summary
+
+
+def write_output(sheet_frames: Dict[str, pd.DataFrame], output, file_format: str, writer: str = WRITER_STYLED) -> None:
+    """按输出格式写出；output 可以是路径或二进制缓冲区（非 xlsx 格式的缓冲区写为 zip）"""
+    if file_format == FORMAT_XLSX:
+        write_excel(sheet_frames, output, writer)
+    elif isinstance(output, str) and not output.endswith(".zip"):
+        write_sheet_files(sheet_frames, output, file_format)
+    else:
+        write_zip(sheet_frames, output, file_format)
+
+
+def run_pipeline(
+    input_path: str,
+    sheet_variables: Dict[str, dict],
+    output_path: str,
+    sheet_names: Optional[List[str]] = None,
+    cache=None,
+    writer: str = WRITER_STYLED,
+    file_format: str = FORMAT_XLSX,
+    workers: Optional[int] = None,
+    resume: bool = True,
+    pool: Optional[RulePool] = None,
+    checkpoints: Optional[CheckpointStore] = None,
+    dispatcher: Optional[SharedDispatcher] = None,
+    compiled_rules: Optional[Dict[str, Dict[str, list]]] = None,
+    model: Optional[str] = None,
+) -> Dict[str, object]:
+    """无界面运行：处理 input_path 并写出到 output_path，返回 JSON 可序列化的运行摘要
+
+    sheet_names 为空时处理工作簿中的全部工作表。xlsx 以外的格式按工作表分别写出：
+    output_path 以 .zip 结尾时打包为 zip，否则视为输出目录。workers 覆盖 RULE_WORKERS 设置。
+    resume 为 True 时按 CHECKPOINT_PATH 记录AI断点，同一输入和配置重跑时从断点继续。
+    pool / checkpoints / dispatcher 为批量处理时多个工作簿共享的资源，由调用方负责关闭；
+    未提供时按设置创建并在本次运行结束时关闭。compiled_rules / model 见 process_workbook。
+    """
+    if cache is None:
+        cache = AICache.from_settings()
+
+    if not sheet_names:
+        with pd.ExcelFile(input_path) as excel_file:
+            sheet_names = list(excel_file.sheet_names)
+
+    metrics = RunMetrics()
+    own_pool = pool is None
+    if own_pool:
+        pool = RulePool.from_settings(workers)
+    own_checkpoints = checkpoints is None and resume
+    if own_checkpoints:
+        checkpoints = CheckpointStore.from_settings()
+    try:
+        sheet_frames, summary = process_workbook(
+            input_path,
+            sheet_variables,
+            sheet_names,
+            cache,
+            pool=pool,
+            metrics=metrics,
+            checkpoints=checkpoints if resume else None,
+            dispatcher=dispatcher,
+            compiled_rules=compiled_rules,
+            model=model,
+        )
+    finally:
+        if own_pool and pool is not None:
+            pool.shutdown()
+        if own_checkpoints and checkpoints is not None:
+            checkpoints.close()
+
+    write_start = time.time()
+    with metrics.timer("write", file_format if file_format != FORMAT_XLSX else f"xlsx/{writer}"):
+        write_output(sheet_frames, output_path, file_format, writer)
+    summary["write_elapsed"] = round(time.time() - write_start, 3)
+    summary["metrics"] = metrics.report()
+
+    summary["input"] = input_path
+    summary["output"] = output_path
+    summary["failures"] = sorted(summary["failures"])
+    logger.info("文件处理完成: %s", output_path)
+    return summary
@@ -1,11 +1,26 @@
 ﻿import logging
 import re
+from collections import deque
+from dataclasses import dataclass, field
+from operator import ge, gt, le, lt
+from typing import Dict, Iterable, List, Optional, Pattern, Set, Tuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
 logger = logging.getLogger(__name__)
 
+NUMERIC_OPERATORS = {">": gt, "<": lt, ">=": ge, "<=": le}
+
+CONTAINS_OPERATORS = ("包含", "不包含")
+# 同一列上的“包含”模式数达到此值才用多模式自动机扫描；模式较少时逐个子串判断（C 实现）更快
+AUTOMATON_MIN_PATTERNS = 64
+
+
+class RuleCompileError(ValueError):
+    """规则配置无效（如正则表达式无法编译、捕获组越界）"""
+
 
 def evaluate_condition(row_value, operator, compare_value):
     """评估条件是否满足"""
@@ -118,3 +133,442 @@ def process_variable_rules(row, rules, separator):
     unique_sorted = sorted(set(split_values))
 
     return separator.join(unique_sorted)
+
+
+# ==================== 列式规则引擎 ====================
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    """预处理后的单条规则（字段默认值与逐行版本一致）"""
+
+    condition_column: str
+    condition_operator: str
+    condition_value: str
+    extract_type: str
+    extract_value_type: str
+    extract_value: str
+    regex_pattern: str
+    capture_group: int
+    regex: Optional[Pattern] = None
+
+
+def _compile_regex(pattern, capture_group):
+    try:
+        regex = re.compile(pattern)
+    except re.error as e:
+        raise RuleCompileError(f"正则表达式错误: {str(e)} (模式: {pattern})") from e
+
+    if not isinstance(capture_group, int) or capture_group < 1 or capture_group > regex.groups:
+        raise RuleCompileError(
+            f"捕获组序号越界: {capture_group} (模式 {pattern} 共 {regex.groups} 个捕获组)"
+        )
+    return regex
+
+
+def compile_rule(rule):
+    """将配置中的规则字典转换为 CompiledRule，正则规则在此编译并校验捕获组"""
+    condition_value = rule.get("condition_value", "")
+    extract_type = rule.get("extract_type", "直接提取")
+    regex_pattern = rule.get("regex_pattern", "")
+    capture_group = rule.get("capture_group", 1)
+
+    regex = None
+    if extract_type == "正则提取" and regex_pattern:
+        regex = _compile_regex(regex_pattern, capture_group)
+
+    return CompiledRule(
+        condition_column=rule.get("condition_column", ""),
+        condition_operator=rule.get("condition_operator", "="),
+        condition_value=str(condition_value) if condition_value is not None else "",
+        extract_type=extract_type,
+        extract_value_type=rule.get("extract_value_type", "从列提取"),
+        extract_value=rule.get("extract_value", ""),
+        regex_pattern=regex_pattern,
+        capture_group=capture_group,
+        regex=regex,
+    )
+
+
+def compile_rules(rules):
+    """编译一个变量的全部规则"""
+    return [rule if isinstance(rule, CompiledRule) else compile_rule(rule) for rule in rules]
+
+
+def compile_sheet_variables(sheet_variables):
+    """编译全部规则，返回 ({工作表: {变量: [CompiledRule]}}, 错误描述列表)；含无效规则的变量不出现在编译结果中"""
+    compiled = {}
+    errors = []
+    for sheet_name, sheet_vars in sheet_variables.items():
+        sheet_compiled = compiled.setdefault(sheet_name, {})
+        for var_name, var_config in sheet_vars.items():
+            rules = []
+            valid = True
+            for idx, rule in enumerate(var_config.get("rules", [])):
+                try:
+                    rules.append(compile_rule(rule))
+                except RuleCompileError as e:
+                    errors.append(f"{sheet_name}.{var_name} 规则{idx + 1}: {str(e)}")
+                    valid = False
+            if valid:
+                sheet_compiled[var_name] = rules
+    return compiled, errors
+
+
+def validate_sheet_variables(sheet_variables):
+    """在运行前编译全部规则，返回错误描述列表（为空表示全部有效）"""
+    return compile_sheet_variables(sheet_variables)[1]
+
+
+def _text_column(df, column):
+    """将列转换为 object 字符串列，空值为空字符串（等价于逐行的 str()）"""
+    return df[column].fillna("").astype(str).astype(object)
+
+
+def _map_unique(text, func, dtype=object):
+    """对列中的唯一值调用 func，再按位置广播回整列"""
+    codes, uniques = pd.factorize(text)
+    mapped = np.array([func(value) for value in uniques], dtype=dtype)
+    if len(mapped) == 0:
+        return np.empty(len(text), dtype=dtype)
+    return mapped[codes]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except Exception:
+        return np.nan
+
+
+def condition_mask(df, rule, text=None):
+    """将规则条件计算为整列布尔掩码，结果与 evaluate_condition 逐行一致；text 为已转换的条件列"""
+    if text is None:
+        text = _text_column(df, rule.condition_column)
+    operator = rule.condition_operator
+    compare_value = rule.condition_value
+
+    if operator == "=":
+        mask = text.values == compare_value
+    elif operator == "<>":
+        mask = text.values != compare_value
+    elif operator in ("包含", "不包含"):
+        mask = text.str.contains(compare_value, regex=False).values.astype(bool)
+        if operator == "不包含":
+            mask = ~mask
+    elif operator in NUMERIC_OPERATORS:
+        threshold = _to_float(compare_value)
+        numbers = _map_unique(text, _to_float, dtype=float)
+        mask = NUMERIC_OPERATORS[operator](numbers, threshold)
+    else:
+        mask = np.zeros(len(df), dtype=bool)
+
+    return np.asarray(mask, dtype=bool)
+
+
+def _regex_column(source, rule, separator):
+    """对整列执行 extractall，每个唯一值只匹配一次，多个匹配以分隔符连接"""
+    codes, uniques = pd.factorize(source)
+    joined = np.full(len(uniques), "", dtype=object)
+
+    if len(uniques):
+        matches = pd.Series(uniques, dtype=object).str.extractall(rule.regex)
+        values = matches.iloc[:, rule.capture_group - 1].dropna().str.strip()
+        values = values[values != ""]
+        if len(values):
+            grouped = values.groupby(level=0, sort=False).agg(separator.join)
+            joined[grouped.index.to_numpy()] = grouped.to_numpy()
+
+    return joined[codes]
+
+
+def extract_column(df, rule, separator, context=None):
+    """按规则提取整列的值，多值以分隔符连接；返回 None 表示该规则不产生任何值"""
+    if rule.extract_value_type == "固定文本":
+        source = pd.Series(rule.extract_value, index=df.index, dtype=object)
+    else:
+        if rule.extract_value not in df.columns:
+            return None
+        source = context.text(rule.extract_value) if context is not None else _text_column(df, rule.extract_value)
+
+    if rule.extract_type in ("直接提取", "AI提取"):
+        return source.values
+
+    if rule.extract_type == "正则提取":
+        if rule.regex is None:
+            return None
+        return _regex_column(source, rule, separator)
+
+    return None
+
+
+def _ai_column(df, ai_results):
+    values = df.index.map(ai_results)
+    return np.asarray(pd.Series(values, dtype=object).fillna(""), dtype=object)
+
+
+def _merge_text(separator):
+    def merge(combined):
+        split_values = [v.strip() for v in combined.split(separator) if v.strip()]
+        return separator.join(sorted(set(split_values)))
+
+    return merge
+
+
+def merge_values(combined, separator):
+    """对整列执行 拆分/去空/去重/排序/连接，与 process_variable_rules 的合并逻辑一致"""
+    return _map_unique(pd.Series(combined, dtype=object), _merge_text(separator))
+
+
+# ==================== 规则计划：跨变量共享条件与提取 ====================
+
+
+def condition_key(rule):
+    return rule.condition_column, rule.condition_operator, rule.condition_value
+
+
+def extract_key(rule, separator):
+    # AI提取在没有AI结果时与直接提取取值相同
+    extract_type = "直接提取" if rule.extract_type == "AI提取" else rule.extract_type
+    regex_key = (rule.regex_pattern, rule.capture_group, separator) if extract_type == "正则提取" else None
+    return extract_type, rule.extract_value_type, rule.extract_value, regex_key
+
+
+class PatternAutomaton:
+    """Aho-Corasick 多模式子串自动机：一次扫描文本得到其中出现的全部模式
+
+    空模式与 `"" in text` 一致，对任何文本（包括空文本）都算出现；它不进入自动机，在 search 中直接加入结果。
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        self.output: List[Tuple[int, ...]] = [()]
+        self.empty = tuple(idx for idx, pattern in enumerate(patterns) if not pattern)
+        for idx, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            node = 0
+            for char in pattern:
+                nxt = self.goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[node][char] = nxt
+                node = nxt
+            self.output[node] += (idx,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(char, 0) if node else 0
+                self.output[nxt] += self.output[self.fail[nxt]]
+
+    def search(self, text: str) -> Set[int]:
+        """text 中出现的模式序号"""
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        found: Set[int] = set(self.empty)
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+@dataclass
+class RulePlan:
+    """一组变量规则的计算计划：统计重复的条件与提取，按列汇总“包含”模式以便合并扫描"""
+
+    condition_uses: Dict[tuple, int] = field(default_factory=dict)
+    extract_uses: Dict[tuple, int] = field(default_factory=dict)
+    contains_patterns: Dict[str, List[str]] = field(default_factory=dict)
+
+    def summary(self):
+        return {
+            "conditions": sum(self.condition_uses.values()),
+            "unique_conditions": len(self.condition_uses),
+            "extracts": sum(self.extract_uses.values()),
+            "unique_extracts": len(self.extract_uses),
+            "merged_contains_columns": sum(1 for patterns in self.contains_patterns.values() if len(patterns) > 1),
+        }
+
+
+def plan_rules(variables: Iterable[Tuple[List[dict], str]]):
+    """扫描 [(规则列表, 分隔符)]，生成 RulePlan"""
+    plan = RulePlan()
+    for rules, separator in variables:
+        for rule in compile_rules(rules):
+            if not rule.condition_column:
+                continue
+            key = condition_key(rule)
+            plan.condition_uses[key] = plan.condition_uses.get(key, 0) + 1
+            if rule.condition_operator in CONTAINS_OPERATORS:
+                patterns = plan.contains_patterns.setdefault(rule.condition_column, [])
+                if rule.condition_value not in patterns:
+                    patterns.append(rule.condition_value)
+            if rule.extract_type != "AI提取":
+                key = extract_key(rule, separator)
+                plan.extract_uses[key] = plan.extract_uses.get(key, 0) + 1
+    return plan
+
+
+class RuleContext:
+    """一块数据上的共享计算缓存：相同条件的掩码、相同提取的结果只计算一次，
+    同一列上的全部“包含”条件在列的唯一值上一次扫描完成
+
+    写入新列（如前一个变量的结果）后需调用 invalidate 使该列相关缓存失效。
+    """
+
+    def __init__(self, df, plan: Optional[RulePlan] = None):
+        self.df = df
+        self.plan = plan or RulePlan()
+        self.texts = {}
+        self.factorized = {}
+        self.masks = {}
+        self.extracts = {}
+
+    def text(self, column):
+        if column not in self.texts:
+            self.texts[column] = _text_column(self.df, column)
+        return self.texts[column]
+
+    def _factorize(self, column):
+        if column not in self.factorized:
+            self.factorized[column] = pd.factorize(self.text(column))
+        return self.factorized[column]
+
+    def _scan_contains(self, column, patterns):
+        """在列的唯一值上一次计算多个“包含”模式的掩码"""
+        codes, uniques = self._factorize(column)
+        if len(patterns) >= AUTOMATON_MIN_PATTERNS:
+            automaton = PatternAutomaton(patterns)
+            found = [automaton.search(value) for value in uniques]
+            hits = {idx: np.array([idx in matched for matched in found], dtype=bool) for idx in range(len(patterns))}
+        else:
+            hits = {idx: np.array([pattern in value for value in uniques], dtype=bool) for idx, pattern in enumerate(patterns)}
+
+        for idx, pattern in enumerate(patterns):
+            mask = hits[idx][codes] if len(uniques) else np.zeros(len(codes), dtype=bool)
+            self.masks[(column, "包含", pattern)] = mask
+            self.masks[(column, "不包含", pattern)] = ~mask
+
+    def mask(self, rule):
+        key = condition_key(rule)
+        if key not in self.masks:
+            if rule.condition_operator in CONTAINS_OPERATORS:
+                patterns = self.plan.contains_patterns.get(rule.condition_column, [])
+                if rule.condition_value not in patterns:
+                    patterns = [rule.condition_value]
+                self._scan_contains(rule.condition_column, patterns)
+            else:
+                self.masks[key] = condition_mask(self.df, rule, self.text(rule.condition_column))
+        return self.masks[key]
+
+    def extract(self, rule, separator):
+        key = extract_key(rule, separator)
+        if key not in self.extracts:
+            self.extracts[key] = extract_column(self.df, rule, separator, self)
+        return self.extracts[key]
+
+    def invalidate(self, column):
+        self.texts.pop(column, None)
+        self.factorized.pop(column, None)
+        for key in [key for key in self.masks if key[0] == column]:
+            del self.masks[key]
+        for key in [key for key in self.extracts if key[1] == "从列提取" and key[2] == column]:
+            del self.extracts[key]
+
+
+def missing_columns(sheet_vars, columns):
+    """规则引用了工作表中不存在（且不是前面变量生成）的列时返回说明列表，这些规则运行时会被跳过"""
+    available = set(str(col) for col in columns)
+    problems = []
+    for var_name, var_config in sheet_vars.items():
+        for idx, rule in enumerate(var_config.get("rules", [])):
+            condition_column = rule.get("condition_column", "")
+            if condition_column and condition_column not in available:
+                problems.append(f"{var_name} 规则{idx + 1}: 判断列 {condition_column} 不存在")
+            extract_value = rule.get("extract_value", "")
+            if rule.get("extract_value_type", "从列提取") != "固定文本" and extract_value and extract_value not in available:
+                problems.append(f"{var_name} 规则{idx + 1}: 取值列 {extract_value} 不存在")
+        available.add(var_name)
+    return problems
+
+
+def apply_variable_rules(df, rules, separator, ai_results=None, context=None):
+    """列式计算一个变量；ai_results 为 {行索引: AI结果}，为 None 时与 process_variable_rules 一致
+
+    context 为同一 df 上的 RuleContext 时复用其中已计算的条件掩码和提取结果。
+    """
+    if context is None:
+        context = RuleContext(df)
+    combined = np.full(len(df), "", dtype=object)
+
+    for rule in compile_rules(rules):
+        if not rule.condition_column or rule.condition_column not in df.columns:
+            continue
+
+        mask = context.mask(rule)
+        if not mask.any():
+            continue
+
+        if rule.extract_type == "AI提取" and ai_results is not None:
+            values = _ai_column(df, ai_results)
+        else:
+            values = context.extract(rule, separator)
+        if values is None:
+            continue
+
+        piece = np.where(mask, values, "")
+        has_piece = piece != ""
+        has_combined = combined != ""
+        both = has_piece & has_combined
+        combined = np.where(has_piece & ~has_combined, piece, combined)
+        if both.any():
+            combined[both] = combined[both] + separator + piece[both]
+
+    return pd.Series(merge_values(combined, separator), index=df.index, dtype=object)
+
+
+def collect_ai_tasks(df, rules):
+    """收集AI提取任务 [(行索引, 规则序号, 源列, 原始值)]，顺序与逐行遍历一致"""
+    positions = []
+    rule_indices = []
+    rule_to_column = {}
+
+    for rule_idx, rule in enumerate(compile_rules(rules)):
+        if rule.extract_type != "AI提取":
+            continue
+        if not rule.condition_column or rule.condition_column not in df.columns:
+            continue
+        source_col = rule.extract_value
+        if not source_col or source_col not in df.columns:
+            continue
+
+        hits = np.flatnonzero(condition_mask(df, rule))
+        positions.append(hits)
+        rule_indices.append(np.full(len(hits), rule_idx))
+        rule_to_column[rule_idx] = source_col
+
+    if not positions:
+        return []
+
+    all_positions = np.concatenate(positions)
+    all_rules = np.concatenate(rule_indices)
+    order = np.lexsort((all_rules, all_positions))
+
+    tasks = []
+    for pos, rule_idx in zip(all_positions[order], all_rules[order]):
+        source_col = rule_to_column[rule_idx]
+        tasks.append((df.index[pos], int(rule_idx), source_col, df[source_col].iat[pos]))
+    return tasks
@@ -0,0 +1,162 @@
+﻿import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_WORKBOOKS = 8
+
+
+class CachedWorkbook:
+    """已登记工作簿的句柄：提供工作表名，按需从缓存取工作表"""
+
+    def __init__(self, cache: "WorkbookCache", key: str, name: str, sheet_names: List[str]):
+        self.cache = cache
+        self.key = key
+        self.name = name
+        self.sheet_names = sheet_names
+
+    def get_sheet(self, sheet_name: str) -> pd.DataFrame:
+        """返回缓存中的 DataFrame（只读，修改前请先 copy）"""
+        return self.cache.get_sheet(self.key, sheet_name)
+
+    def columns(self, sheet_name: str) -> List[str]:
+        return [str(col) for col in self.get_sheet(sheet_name).columns]
+
+    def pin(self) -> None:
+        """后台任务引用期间固定工作簿，不被 LRU 淘汰；与 unpin 成对调用"""
+        self.cache.pin(self.key)
+
+    def unpin(self) -> None:
+        self.cache.unpin(self.key)
+
+
+class WorkbookCache:
+    """按上传内容哈希缓存工作簿：每个工作表最多解析一次，按需加载，超出内存上限时 LRU 淘汰
+
+    全局锁只保护字典读写；解析在锁外进行，每个工作簿一把解析锁（同一 ExcelFile 不能并发读取），
+    不同工作簿的解析互不等待，同一工作表的重复请求等待首个解析完成后直接取缓存。
+    被排队/运行中任务引用的工作簿（pin 计数大于 0）不参与工作簿数量上限的淘汰。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, max_workbooks: int = DEFAULT_MAX_WORKBOOKS):
+        self.max_bytes = max_bytes
+        self.max_workbooks = max_workbooks
+        self.lock = threading.RLock()
+        self.workbooks: "OrderedDict[str, pd.ExcelFile]" = OrderedDict()
+        self.parse_locks: Dict[str, threading.Lock] = {}
+        self.pins: Dict[str, int] = {}
+        self.frames: "OrderedDict[Tuple[str, str], pd.DataFrame]" = OrderedDict()
+        self.sizes: dict = {}
+        self.total_bytes = 0
+
+    def register(self, data: bytes, name: str = "") -> CachedWorkbook:
+        """登记上传内容，相同内容只打开一次"""
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            excel_file = self.workbooks.get(key)
+            if excel_file is None:
+                excel_file = pd.ExcelFile(io.BytesIO(data))
+                self.workbooks[key] = excel_file
+                self.parse_locks[key] = threading.Lock()
+                logger.info("工作簿已缓存: %s (%s 个工作表)", name or key[:12], len(excel_file.sheet_names))
+                self._evict_workbooks(keep=key)
+            else:
+                self.workbooks.move_to_end(key)
+            return CachedWorkbook(self, key, name, list(excel_file.sheet_names))
+
+    def __contains__(self, key: object) -> bool:
+        with self.lock:
+            return key in self.workbooks
+
+    def pin(self, key: str) -> None:
+        with self.lock:
+            if key not in self.workbooks:
+                raise KeyError(f"工作簿未登记或已被淘汰: {key[:12]}")
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key: str) -> None:
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+                return
+            self.pins.pop(key, None)
+            self._evict_workbooks()
+
+    def _evict_workbooks(self, keep: str = "") -> None:
+        """超出工作簿数量上限时按 LRU 淘汰未被固定的工作簿"""
+        while len(self.workbooks) > self.max_workbooks:
+            old_key = next((k for k in self.workbooks if k != keep and not self.pins.get(k)), None)
+            if old_key is None:
+                break
+            self._drop_workbook(old_key, self.workbooks.pop(old_key))
+
+    def _cached_frame(self, frame_key: Tuple[str, str]):
+        df = self.frames.get(frame_key)
+        if df is not None:
+            self.frames.move_to_end(frame_key)
+        return df
+
+    def get_sheet(self, key: str, sheet_name: str) -> pd.DataFrame:
+        frame_key = (key, sheet_name)
+        with self.lock:
+            df = self._cached_frame(frame_key)
+            if df is not None:
+                return df
+            excel_file = self.workbooks.get(key)
+            if excel_file is None:
+                raise KeyError(f"工作簿未登记或已被淘汰: {key[:12]}")
+            parse_lock = self.parse_locks[key]
+
+        with parse_lock:
+            with self.lock:
+                df = self._cached_frame(frame_key)
+            if df is not None:
+                return df
+
+            logger.info("解析工作表: %s", sheet_name)
+            df = excel_file.parse(sheet_name=sheet_name, dtype=str)
+            size = int(df.memory_usage(deep=True).sum())
+
+            with self.lock:
+                if self.workbooks.get(key) is not excel_file:
+                    # 解析期间工作簿已被淘汰：结果照常返回，但不再缓存
+                    excel_file.close()
+                    return df
+                self.frames[frame_key] = df
+                self.sizes[frame_key] = size
+                self.total_bytes += size
+                self._evict(keep=frame_key)
+            return df
+
+    def _evict(self, keep: Tuple[str, str]) -> None:
+        while self.total_bytes > self.max_bytes and len(self.frames) > 1:
+            frame_key = next(iter(self.frames))
+            if frame_key == keep:
+                self.frames.move_to_end(frame_key)
+                continue
+            self._drop_frame(frame_key)
+
+    def _drop_frame(self, frame_key: Tuple[str, str]) -> None:
+        self.frames.pop(frame_key, None)
+        self.total_bytes -= self.sizes.pop(frame_key, 0)
+        logger.info("工作表缓存淘汰: %s", frame_key[1])
+
+    def _drop_workbook(self, key: str, excel_file: pd.ExcelFile) -> None:
+        for frame_key in [k for k in self.frames if k[0] == key]:
+            self._drop_frame(frame_key)
+        parse_lock = self.parse_locks.pop(key)
+        # 正在解析时由解析线程在结束后关闭
+        if parse_lock.acquire(blocking=False):
+            try:
+                excel_file.close()
+            finally:
+                parse_lock.release()
+        logger.info("工作簿缓存淘汰: %s", key[:12])
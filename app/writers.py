@@ -0,0 +1,204 @@
+﻿import io
+import logging
+import os
+import re
+import zipfile
+from copy import copy
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils import get_column_letter
+
+try:
+    import xlsxwriter
+except ImportError:  # pragma: no cover - 可选依赖
+    xlsxwriter = None
+
+logger = logging.getLogger(__name__)
+
+HEADER_COLOR = "B4C7E7"
+
+WRITER_STYLED = "styled"
+WRITER_OPENPYXL = "openpyxl"
+WRITER_PLAIN = "plain"
+
+WRITER_LABELS = {
+    WRITER_STYLED: "带样式 (xlsxwriter)",
+    WRITER_OPENPYXL: "带样式 (openpyxl 只写模式)",
+    WRITER_PLAIN: "无样式 (最快)",
+}
+
+FORMAT_XLSX = "xlsx"
+FORMAT_PARQUET = "parquet"
+FORMAT_PARQUET_DATASET = "parquet_dataset"
+FORMAT_FEATHER = "feather"
+FORMAT_CSV = "csv"
+
+FORMAT_LABELS = {
+    FORMAT_XLSX: "Excel (.xlsx)",
+    FORMAT_PARQUET: "Parquet (每个工作表一个文件)",
+    FORMAT_PARQUET_DATASET: "Parquet 数据集 (按 sheet 分区)",
+    FORMAT_FEATHER: "Feather / Arrow IPC",
+    FORMAT_CSV: "CSV (UTF-8 BOM)",
+}
+
+CSV_CHUNK_ROWS = 50000
+
+
+def _rows(df: pd.DataFrame):
+    """逐行产出单元格值，空值为 None"""
+    values = df.astype(object).where(df.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def _write_xlsxwriter(sheet_frames: Dict[str, pd.DataFrame], output, styled: bool) -> None:
+    workbook = xlsxwriter.Workbook(
+        output,
+        {"constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False, "strings_to_numbers": False},
+    )
+    header_format = border_format = None
+    if styled:
+        border_format = workbook.add_format({"border": 1})
+        header_format = workbook.add_format({
+            "bold": True,
+            "bg_color": f"#{HEADER_COLOR}",
+            "pattern": 1,
+            "align": "center",
+            "valign": "vcenter",
+            "border": 1,
+        })
+
+    for sheet_name, df in sheet_frames.items():
+        logger.info("  写入Excel: %s", sheet_name)
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+        for row_idx, row in enumerate(_rows(df), 1):
+            worksheet.write_row(row_idx, 0, row, border_format)
+
+        if styled:
+            worksheet.freeze_panes(1, 0)
+            worksheet.autofilter(0, 0, len(df), max(len(df.columns) - 1, 0))
+            logger.info("  工作表 %s 格式化完成", sheet_name)
+
+    workbook.close()
+
+
+def _write_openpyxl(sheet_frames: Dict[str, pd.DataFrame], output, styled: bool) -> None:
+    workbook = Workbook(write_only=True)
+    thin = Side(style="thin")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    header_fill = PatternFill(start_color=HEADER_COLOR, end_color=HEADER_COLOR, fill_type="solid")
+    header_font = Font(bold=True)
+    header_alignment = Alignment(horizontal="center", vertical="center")
+
+    for sheet_name, df in sheet_frames.items():
+        logger.info("  写入Excel: %s", sheet_name)
+        worksheet = workbook.create_sheet(sheet_name)
+
+        if styled:
+            worksheet.freeze_panes = "A2"
+            if len(df.columns):
+                worksheet.auto_filter.ref = f"A1:{get_column_letter(len(df.columns))}{len(df) + 1}"
+
+            header = []
+            for col in df.columns:
+                cell = WriteOnlyCell(worksheet, value=str(col))
+                cell.fill = header_fill
+                cell.font = header_font
+                cell.alignment = header_alignment
+                cell.border = border
+                header.append(cell)
+            worksheet.append(header)
+
+            # 行级样式：所有数据单元格共享同一个样式数组，避免逐单元格查找/登记样式
+            template = WriteOnlyCell(worksheet)
+            template.border = border
+            data_style = template._style
+            for row in _rows(df):
+                cells = []
+                for value in row:
+                    cell = WriteOnlyCell(worksheet, value=value)
+                    cell._style = copy(data_style)
+                    cells.append(cell)
+                worksheet.append(cells)
+            logger.info("  工作表 %s 格式化完成", sheet_name)
+        else:
+            worksheet.append([str(col) for col in df.columns])
+            for row in _rows(df):
+                worksheet.append(row)
+
+    workbook.save(output)
+
+
+def write_excel(sheet_frames: Dict[str, pd.DataFrame], output, writer: str = WRITER_STYLED) -> None:
+    """写出 xlsx：表头填充色、加粗、边框、冻结首行和筛选；writer 为 plain 时不加样式
+
+    未安装 xlsxwriter 时自动改用 openpyxl 只写模式。
+    """
+    if writer not in WRITER_LABELS:
+        raise ValueError(f"不支持的写出方式: {writer}")
+
+    styled = writer != WRITER_PLAIN
+    if writer == WRITER_OPENPYXL or xlsxwriter is None:
+        if writer != WRITER_OPENPYXL:
+            logger.warning("未安装 xlsxwriter，改用 openpyxl 只写模式")
+        _write_openpyxl(sheet_frames, output, styled)
+    else:
+        _write_xlsxwriter(sheet_frames, output, styled)
+
+
+def _safe_name(sheet_name: str) -> str:
+    return re.sub(r'[\\/:*?"<>|]+', "_", sheet_name).strip() or "sheet"
+
+
+def _sheet_files(
+    sheet_frames: Dict[str, pd.DataFrame], file_format: str
+) -> Iterator[Tuple[str, Callable[[object], None]]]:
+    """按格式产出 (相对路径, 写入函数)，写入函数接收二进制文件对象"""
+    for sheet_name, df in sheet_frames.items():
+        name = _safe_name(sheet_name)
+        frame = df.reset_index(drop=True)
+        frame.columns = [str(col) for col in frame.columns]
+
+        if file_format == FORMAT_PARQUET:
+            yield f"{name}.parquet", lambda f, frame=frame: frame.to_parquet(f, index=False)
+        elif file_format == FORMAT_PARQUET_DATASET:
+            yield f"sheet={name}/part-0.parquet", lambda f, frame=frame: frame.to_parquet(f, index=False)
+        elif file_format == FORMAT_FEATHER:
+            yield f"{name}.feather", lambda f, frame=frame: frame.to_feather(f)
+        elif file_format == FORMAT_CSV:
+            yield f"{name}.csv", lambda f, frame=frame: frame.to_csv(
+                f, index=False, encoding="utf-8-sig", chunksize=CSV_CHUNK_ROWS
+            )
+        else:
+            raise ValueError(f"不支持的输出格式: {file_format}")
+
+
+def write_sheet_files(sheet_frames: Dict[str, pd.DataFrame], output_dir: str, file_format: str) -> List[str]:
+    """将每个工作表写为列式/文本文件到 output_dir，返回写出的文件路径"""
+    paths = []
+    for relative_path, write in _sheet_files(sheet_frames, file_format):
+        path = os.path.join(output_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger.info("  写出 %s: %s", file_format, path)
+        with open(path, "wb") as f:
+            write(f)
+        paths.append(path)
+    return paths
+
+
+def write_zip(sheet_frames: Dict[str, pd.DataFrame], output, file_format: str) -> None:
+    """将每个工作表按格式写入 zip（供界面下载）；CSV 直接流式写入压缩包"""
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for relative_path, write in _sheet_files(sheet_frames, file_format):
+            logger.info("  写出 %s: %s", file_format, relative_path)
+            if file_format == FORMAT_CSV:
+                with archive.open(relative_path, "w") as f:
+                    write(f)
+            else:
+                buffer = io.BytesIO()
+                write(buffer)
+                archive.writestr(relative_path, buffer.getvalue())
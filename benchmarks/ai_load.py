@@ -0,0 +1,141 @@
+﻿"""AI提取链路压测：对本地替身服务（或任意 OpenAI 兼容地址）运行全局去重后的提取流程
+
+依次执行冷缓存、热缓存两轮（--runs 可调），报告每轮的请求/秒、条目/秒、服务端 p50/p95/p99 延迟、
+批次延迟、缓存命中与本地预提取数量。
+
+用法:
+    python -m benchmarks.ai_load [--rows 20000] [--duplicate-ratio 0.8] [--max-in-flight 8] [--rpm 0]
+        [--latency 0.3 --rate-429 0.05 --truncate-rate 0.05 ...]   # 替身服务参数，见 fake_ai_server
+    python -m benchmarks.ai_load --base-url http://127.0.0.1:8765   # 使用已启动的替身服务
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List
+
+from app.ai_cache import AICache
+from app.ai_planner import execute_texts, plan_ai_work
+from app.settings import AI_CONFIG
+
+from .fake_ai_server import add_config_arguments, config_from_args, start_server
+from .run import SHEET_VARIABLES
+from .workbook import generate_sheets
+
+
+def _server_call(base_url: str, path: str, method: str = "GET") -> Dict[str, object]:
+    request = urllib.request.Request(base_url.rstrip("/") + path, data=b"" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def apply_settings(args: argparse.Namespace, base_url: str) -> None:
+    """把压测参数写入运行时的 AI_CONFIG（不修改 settings 文件）"""
+    AI_CONFIG["BASE_URL"] = base_url
+    AI_CONFIG["API_KEY"] = AI_CONFIG.get("API_KEY") or "fake-key"
+    AI_CONFIG["MAX_IN_FLIGHT"] = args.max_in_flight
+    AI_CONFIG["REQUESTS_PER_MINUTE"] = args.rpm
+    AI_CONFIG["LOCAL_PREEXTRACT"] = not args.no_local
+    AI_CONFIG["STREAM"] = args.stream
+    if args.token_budget:
+        AI_CONFIG["TOKEN_BUDGET"] = args.token_budget
+    if args.max_batch_items:
+        AI_CONFIG["MAX_BATCH_ITEMS"] = args.max_batch_items
+    if args.max_retries is not None:
+        AI_CONFIG["MAX_RETRIES"] = args.max_retries
+    if args.retry_backoff is not None:
+        AI_CONFIG["RETRY_BACKOFF"] = args.retry_backoff
+
+
+def load_texts(rows: int, duplicate_ratio: float, seed: int) -> List[str]:
+    """按基准配置中的 CM.CMTRT 规划AI任务，返回全局唯一文本"""
+    sheets = generate_sheets(rows, duplicate_ratio, seed)
+    plan = plan_ai_work({"CM": sheets["CM"]}, {"CM": {"CMTRT": SHEET_VARIABLES["CM"]["CMTRT"]}})
+    return plan.texts
+
+
+def run_load(texts: List[str], cache, base_url: str, runs: int) -> List[Dict[str, object]]:
+    reports = []
+    for run_idx in range(runs):
+        _server_call(base_url, "/stats/reset", "POST")
+        start = time.perf_counter()
+        _, stats = execute_texts(texts, cache, column_name="压测")
+        wall = time.perf_counter() - start
+        server = _server_call(base_url, "/stats")
+
+        reports.append({
+            "run": "cold" if run_idx == 0 else f"warm{run_idx}",
+            "texts": len(texts),
+            "wall": round(wall, 3),
+            "items_per_s": round(len(texts) / wall, 1) if wall else None,
+            "requests": server["requests"],
+            "requests_per_s": round(server["requests"] / wall, 2) if wall else None,
+            "items_sent": server["items"],
+            "cached": stats["cached"],
+            "local": stats["local"],
+            "failed": stats["failed"],
+            "batches": stats["batches"],
+            "batch_latency_p50": round(stats["latency_p50"], 3),
+            "batch_latency_p95": round(stats["latency_p95"], 3),
+            "batch_latency_p99": round(stats["latency_p99"], 3),
+            "server_latency_p50": round(server["latency_p50"], 3),
+            "server_latency_p95": round(server["latency_p95"], 3),
+            "server_latency_p99": round(server["latency_p99"], 3),
+            "statuses": server["statuses"],
+            "faults": server["faults"],
+            "peak_in_flight": server["peak_in_flight"],
+        })
+        print(
+            f"{reports[-1]['run']}: {wall:.2f}s, {reports[-1]['items_per_s']} 条/秒, "
+            f"{server['requests']} 次请求, 缓存命中 {stats['cached']}, 失败 {stats['failed']}",
+            file=sys.stderr,
+        )
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI提取链路压测")
+    parser.add_argument("--rows", type=int, default=20000, help="合成 CM 表行数")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.8, help="药名列的重复率 (0~1)")
+    parser.add_argument("--data-seed", type=int, default=0, help="合成数据随机种子")
+    parser.add_argument("--runs", type=int, default=2, help="轮数：第一轮冷缓存，之后为热缓存")
+    parser.add_argument("--base-url", help="使用已启动的替身服务；不指定时在进程内启动")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="MAX_IN_FLIGHT")
+    parser.add_argument("--rpm", type=float, default=0, help="REQUESTS_PER_MINUTE，0 为不限")
+    parser.add_argument("--token-budget", type=int, help="TOKEN_BUDGET")
+    parser.add_argument("--max-batch-items", type=int, help="MAX_BATCH_ITEMS")
+    parser.add_argument("--max-retries", type=int, help="MAX_RETRIES")
+    parser.add_argument("--retry-backoff", type=float, help="RETRY_BACKOFF")
+    parser.add_argument("--no-local", action="store_true", help="关闭本地剂型词表预提取")
+    parser.add_argument("--stream", action="store_true", help="开启流式请求 (STREAM)")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server, base_url = start_server(config_from_args(args))
+    apply_settings(args, base_url)
+
+    texts = load_texts(args.rows, args.duplicate_ratio, args.data_seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = AICache(os.path.join(tmp_dir, "load_cache.sqlite3"))
+        try:
+            reports = run_load(texts, cache, base_url, args.runs)
+        finally:
+            cache.close()
+            if server is not None:
+                server.shutdown()
+
+    settings = {key: AI_CONFIG.get(key) for key in (
+        "MAX_IN_FLIGHT", "REQUESTS_PER_MINUTE", "TOKEN_BUDGET", "MAX_BATCH_ITEMS",
+        "MAX_RETRIES", "RETRY_BACKOFF", "LOCAL_PREEXTRACT", "STREAM",
+    )}
+    print(json.dumps({"base_url": base_url, "settings": settings, "runs": reports}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+﻿"""本地 OpenAI 兼容的替身服务：实现 /chat/completions（JSON 输出），用于离线压测AI提取链路
+
+可配置延迟分布、429/500 注入、截断或格式错误的 JSON、丢弃部分 id 以及并发上限。
+结果取本地剂型词表的预提取结果，无法确定时原样返回。
+
+用法:
+    python -m benchmarks.fake_ai_server [--port 8765] [--latency 0.5] [--distribution lognormal]
+        [--rate-429 0.05] [--rate-500 0.02] [--truncate-rate 0.05] [--malformed-rate 0.02]
+        [--drop-rate 0.01] [--max-concurrency 8]
+然后将 settings 中 BASE_URL 设为 http://127.0.0.1:8765 。GET /stats 查看统计，POST /stats/reset 清零。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from app.ai_batching import estimate_tokens
+from app.ai_dispatcher import LatencyTracker
+from app.drug_lexicon import DrugLexicon
+
+DEFAULT_PORT = 8765
+
+DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+# 流式响应：首个数据块前的延迟占总延迟的比例，以及每个数据块的字符数
+FIRST_CHUNK_SHARE = 0.1
+STREAM_CHUNK_CHARS = 16
+
+
+@dataclass
+class FakeAIConfig:
+    """替身服务的行为参数；各 *_rate 为按请求（drop_rate 为按条目）的概率"""
+
+    latency: float = 0.5
+    per_item_latency: float = 0.0
+    distribution: str = "lognormal"
+    jitter: float = 0.5
+    rate_429: float = 0.0
+    rate_500: float = 0.0
+    truncate_rate: float = 0.0
+    malformed_rate: float = 0.0
+    drop_rate: float = 0.0
+    max_concurrency: int = 0
+    seed: Optional[int] = None
+
+
+class FakeAIState:
+    """服务端共享状态：随机数、并发计数与统计"""
+
+    def __init__(self, config: FakeAIConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lexicon = DrugLexicon()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.requests = 0
+            self.items = 0
+            self.statuses: Dict[str, int] = {}
+            self.faults: Dict[str, int] = {}
+            self.latency = LatencyTracker()
+
+    def roll(self) -> float:
+        with self.lock:
+            return self.random.random()
+
+    def delay(self, item_count: int) -> float:
+        config = self.config
+        with self.lock:
+            if config.distribution == "fixed":
+                base = config.latency
+            elif config.distribution == "uniform":
+                base = self.random.uniform(config.latency * (1 - config.jitter), config.latency * (1 + config.jitter))
+            else:
+                # 中位数为 latency 的对数正态分布，jitter 为 sigma
+                base = config.latency * self.random.lognormvariate(0, config.jitter)
+        return max(0.0, base) + config.per_item_latency * item_count
+
+    def enter(self) -> bool:
+        """登记一个进行中的请求；超过并发上限时返回 False"""
+        with self.lock:
+            if self.config.max_concurrency and self.in_flight >= self.config.max_concurrency:
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def leave(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, status: int, items: int, seconds: float, fault: Optional[str] = None) -> None:
+        self.latency.record(seconds)
+        with self.lock:
+            self.requests += 1
+            self.items += items
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            if fault:
+                self.faults[fault] = self.faults.get(fault, 0) + 1
+
+    def stats(self) -> Dict[str, object]:
+        latency = self.latency.summary()
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "items": self.items,
+                "statuses": dict(self.statuses),
+                "faults": dict(self.faults),
+                "peak_in_flight": self.peak_in_flight,
+                "latency_p50": latency["p50"],
+                "latency_p95": latency["p95"],
+                "latency_p99": latency["p99"],
+                "latency_max": latency["max"],
+            }
+
+
+def _parse_items(body: Dict[str, object]) -> List[Tuple[object, str]]:
+    """从最后一条 user 消息中取出 [(id, text)]"""
+    for message in reversed(body.get("messages") or []):
+        if message.get("role") != "user":
+            continue
+        try:
+            payload = json.loads(message.get("content") or "")
+        except (TypeError, ValueError):
+            return []
+        return [(item.get("id"), str(item.get("text", ""))) for item in payload.get("items", [])]
+    return []
+
+
+def _completion(body: Dict[str, object], content: str, finish_reason: str, prompt_tokens: int) -> Dict[str, object]:
+    completion_tokens = estimate_tokens(content)
+    return {
+        "id": f"chatcmpl-fake-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class FakeAIHandler(BaseHTTPRequestHandler):
+    server_version = "FakeAI/1.0"
+    state: FakeAIState
+
+    def log_message(self, format, *args):  # noqa: A002 - 与基类签名一致
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, object]) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body: Dict[str, object], content: str, finish_reason: str, prompt_tokens: int, spread: float) -> None:
+        """以 SSE 分块发送 chat.completion.chunk，最后一块携带 usage"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        completion = _completion(body, content, finish_reason, prompt_tokens)
+        base = {key: completion[key] for key in ("id", "created", "model")}
+        pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)] or [""]
+
+        def send(payload: Dict[str, object]) -> None:
+            self.wfile.write(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+        for idx, piece in enumerate(pieces):
+            if idx:
+                time.sleep(spread / len(pieces))
+            send({**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": piece}, "finish_reason": None},
+            ]})
+        send({**base, "object": "chat.completion.chunk", "choices": [
+            {"index": 0, "delta": {}, "finish_reason": finish_reason},
+        ]})
+        send({**base, "object": "chat.completion.chunk", "choices": [], "usage": completion["usage"]})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _error(self, status: int, message: str, items: int, start: float, fault: str) -> None:
+        self._send_json(status, {"error": {"message": message, "type": fault, "code": status}})
+        self.state.record(status, items, time.time() - start, fault)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, {"config": asdict(self.state.config), **self.state.stats()})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        start = time.time()
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+
+        if self.path.rstrip("/") == "/stats/reset":
+            self.state.reset()
+            self._send_json(200, {"reset": True})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        try:
+            body = json.loads(raw.decode("utf-8"))
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON body"}})
+            return
+
+        items = _parse_items(body)
+        state = self.state
+        config = state.config
+
+        if not state.enter():
+            self._error(429, "too many concurrent requests", len(items), start, "concurrency")
+            return
+        try:
+            stream = bool(body.get("stream"))
+            delay = state.delay(len(items))
+            # 流式请求先等待首段延迟，其余延迟均摊到各个数据块之间
+            time.sleep(delay * FIRST_CHUNK_SHARE if stream else delay)
+
+            if state.roll() < config.rate_429:
+                self._error(429, "rate limit exceeded", len(items), start, "rate_429")
+                return
+            if state.roll() < config.rate_500:
+                self._error(500, "internal server error", len(items), start, "rate_500")
+                return
+
+            results = []
+            for item_id, text in items:
+                if config.drop_rate and state.roll() < config.drop_rate:
+                    continue
+                results.append({"id": item_id, "value": state.lexicon.resolve(text) or text})
+            content = json.dumps({"results": results}, ensure_ascii=False)
+
+            fault = None
+            finish_reason = "stop"
+            if len(results) < len(items):
+                fault = "dropped_ids"
+            if state.roll() < config.truncate_rate:
+                content = content[: max(1, int(len(content) * state.roll()))]
+                finish_reason = "length"
+                fault = "truncated"
+            elif state.roll() < config.malformed_rate:
+                content = "```json\n" + content.replace('"value"', "value", 1) + "\n```"
+                fault = "malformed"
+
+            prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in body.get("messages") or [])
+            if stream:
+                self._send_stream(body, content, finish_reason, prompt_tokens, delay * (1 - FIRST_CHUNK_SHARE))
+            else:
+                self._send_json(200, _completion(body, content, finish_reason, prompt_tokens))
+            state.record(200, len(items), time.time() - start, fault)
+        finally:
+            state.leave()
+
+
+def start_server(config: FakeAIConfig, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """在后台线程中启动服务，返回 (server, base_url)；port 为 0 时自动分配"""
+    handler = type("BoundFakeAIHandler", (FakeAIHandler,), {"state": FakeAIState(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="fake-ai-server", daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeAIConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="单次请求基础延迟（秒，对数正态时为中位数）")
+    parser.add_argument("--per-item-latency", type=float, default=defaults.per_item_latency, help="每个条目追加的延迟（秒）")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default=defaults.distribution, help="延迟分布")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="uniform 为相对波动幅度，lognormal 为 sigma")
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429, help="返回 429 的概率")
+    parser.add_argument("--rate-500", type=float, default=defaults.rate_500, help="返回 500 的概率")
+    parser.add_argument("--truncate-rate", type=float, default=defaults.truncate_rate, help="截断响应 JSON 的概率")
+    parser.add_argument("--malformed-rate", type=float, default=defaults.malformed_rate, help="返回格式错误 JSON 的概率")
+    parser.add_argument("--drop-rate", type=float, default=defaults.drop_rate, help="每个条目被丢弃的概率")
+    parser.add_argument("--max-concurrency", type=int, default=defaults.max_concurrency, help="并发上限，超出返回 429；0 为不限")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+
+
+def config_from_args(args: argparse.Namespace) -> FakeAIConfig:
+    return FakeAIConfig(
+        latency=args.latency,
+        per_item_latency=args.per_item_latency,
+        distribution=args.distribution,
+        jitter=args.jitter,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        truncate_rate=args.truncate_rate,
+        malformed_rate=args.malformed_rate,
+        drop_rate=args.drop_rate,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server, base_url = start_server(config_from_args(args), args.host, args.port)
+    print(f"替身服务已启动: {base_url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+﻿"""基准测试：分阶段计时（读取、逐行规则函数、列式规则、AI编排、写出），并与已保存的基线比较
+
+用法:
+    python -m benchmarks.run [--rows 1000,10000] [--duplicate-ratio 0.8] [--repeat 3]
+    python -m benchmarks.run --save-baseline      # 记录基线
+    python -m benchmarks.run --check              # 任一阶段比基线慢超过容差，或结果校验不一致时退出码为 1
+
+AI编排阶段只计本地部分（全局去重、本地预提取、按 token 分批、结果回填），不发起网络请求。
+基线比较的是相对耗时：各阶段耗时除以同一次运行中旧版逐行规则引擎三个阶段（REFERENCE_STAGES）的耗时之和，
+机器快慢对两者的影响相同而被抵消，因此基线文件可以在不同机器间共用；绝对耗时只作参考。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from app.ai_batching import pack_batches
+from app.ai_planner import plan_ai_work, resolve_ai_results
+from app.drug_lexicon import DrugLexicon
+from app.pipeline import read_sheets
+from app.rules import (
+    PatternAutomaton,
+    apply_variable_rules,
+    collect_ai_tasks,
+    compile_rules,
+    evaluate_condition,
+    extract_value,
+    process_variable_rules,
+)
+from app.writers import WRITER_STYLED, write_excel
+
+from .workbook import write_workbook
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_ROWS = [1000, 10000]
+DEFAULT_TOLERANCE = 0.5
+# 低于此秒数的差异视为噪声，不判定为退化
+MIN_REGRESSION_SECONDS = 0.1
+# 相对耗时的参照：旧版逐行规则引擎的各阶段，代码不再变化，其耗时之和用作衡量机器快慢的标尺
+REFERENCE_STAGES = ("evaluate_condition", "extract_value", "process_variable_rules")
+# 逐行版本很慢，只在前 LEGACY_MAX_ROWS 行上计时
+LEGACY_MAX_ROWS = 20000
+
+# 本地预提取的回归用例：{原文: 预期核心成分}，None 表示无法确定、应交给AI
+LEXICON_CASES = {
+    "注射用水": None,
+    "灭菌注射用水": None,
+    "中药饮片": None,
+    "黄芪饮片": None,
+    "阿司匹林": None,
+    "阿莫西林胶囊": "阿莫西林",
+    "硫酸氨基葡萄糖片": "硫酸氨基葡萄糖",
+    "复方氨酚烷胶囊": "复方氨酚烷",
+    "康复新液": "康复新",
+    "吸入用布地奈德混悬液": "布地奈德",
+    "注射用头孢曲松钠": "头孢曲松钠",
+    "0.9%氯化钠注射液": "氯化钠",
+    "碳酸钙D3颗粒（Ⅱ）": "碳酸钙D3",
+    "维生素D滴剂（胶囊型）": "维生素D",
+}
+
+STAGES = [
+    "read",
+    "evaluate_condition",
+    "extract_value",
+    "process_variable_rules",
+    "apply_variable_rules",
+    "ai_orchestration",
+    "write",
+]
+
+
+def _rule(condition_column, operator, extract_type, extract_value, value="", pattern="", group=1, value_type="从列提取"):
+    return {
+        "condition_column": condition_column,
+        "condition_operator": operator,
+        "condition_value": value,
+        "extract_type": extract_type,
+        "extract_value_type": value_type,
+        "extract_value": extract_value,
+        "regex_pattern": pattern,
+        "capture_group": group,
+    }
+
+
+TERM_PATTERN = r"\d+;(.+?);(\d{4}|uk|UK)-(\d{2}|uk|UK)-(\d{2}|uk|UK)"
+
+# CM 与“测试1”配置一致，AE/MH 补充数值比较、包含、固定文本等规则
+SHEET_VARIABLES = {
+    "CM": {
+        "CMTRT": {"separator": ";", "rules": [_rule("CMDECOD", "<>", "AI提取", "CMDECOD")]},
+        "ROUTE": {"separator": ";", "rules": [
+            _rule("CMROUTEO", "<>", "直接提取", "CMROUTEO"),
+            _rule("CMROUTEO", "=", "直接提取", "CMROUTE_DEC"),
+        ]},
+        "INDICATION": {"separator": ";", "rules": [
+            _rule("AENO", "<>", "正则提取", "AENO", pattern=TERM_PATTERN),
+            _rule("MHNO", "<>", "正则提取", "MHNO", pattern=TERM_PATTERN),
+            _rule("CMRES_3_DEC", "<>", "直接提取", "CMRES_3_DEC"),
+            _rule("CMRES_4_DEC", "<>", "直接提取", "CMRES_4_DEC"),
+            _rule("RESOT", "<>", "直接提取", "RESOT"),
+        ]},
+        "HIGHDOSE": {"separator": ";", "rules": [
+            _rule("CMDOSE", ">=", "直接提取", "是", value="10", value_type="固定文本"),
+        ]},
+    },
+    "AE": {
+        "AESERFL": {"separator": ";", "rules": [_rule("AESER", "=", "直接提取", "Y", value="是", value_type="固定文本")]},
+        "AEDESC": {"separator": ";", "rules": [
+            _rule("AETERM", "<>", "正则提取", "AETERM", pattern=r"^([^（(]+)"),
+            _rule("AETOXGR", ">", "直接提取", "AETOXGR", value="2"),
+        ]},
+    },
+    "MH": {
+        "MHCAT": {"separator": ";", "rules": [
+            _rule("MHTERM", "包含", "直接提取", "慢性", value="高", value_type="固定文本"),
+            _rule("MHTERM", "包含", "直接提取", "代谢", value="糖尿病", value_type="固定文本"),
+            _rule("MHONGO", "=", "直接提取", "MHTERM", value="是"),
+        ]},
+    },
+}
+
+
+def _best(func: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _legacy_rows(sheet_frames: Dict[str, pd.DataFrame]) -> Dict[str, List[pd.Series]]:
+    return {
+        sheet_name: [row for _, row in df.head(LEGACY_MAX_ROWS).iterrows()]
+        for sheet_name, df in sheet_frames.items()
+    }
+
+
+def _run_evaluate_condition(rows_by_sheet: Dict[str, List[pd.Series]]) -> None:
+    for sheet_name, rows in rows_by_sheet.items():
+        for var_config in SHEET_VARIABLES[sheet_name].values():
+            for rule in var_config["rules"]:
+                column = rule["condition_column"]
+                for row in rows:
+                    evaluate_condition(row[column], rule["condition_operator"], rule["condition_value"])
+
+
+def _run_extract_value(rows_by_sheet: Dict[str, List[pd.Series]]) -> None:
+    for sheet_name, rows in rows_by_sheet.items():
+        for var_config in SHEET_VARIABLES[sheet_name].values():
+            for rule in var_config["rules"]:
+                for row in rows:
+                    extract_value(
+                        row,
+                        rule["extract_type"],
+                        rule["extract_value_type"],
+                        rule["extract_value"],
+                        rule["regex_pattern"],
+                        rule["capture_group"],
+                    )
+
+
+def _run_process_variable_rules(rows_by_sheet: Dict[str, List[pd.Series]]) -> None:
+    for sheet_name, rows in rows_by_sheet.items():
+        for var_config in SHEET_VARIABLES[sheet_name].values():
+            for row in rows:
+                process_variable_rules(row, var_config["rules"], var_config["separator"])
+
+
+def _run_apply_variable_rules(sheet_frames: Dict[str, pd.DataFrame]) -> None:
+    for sheet_name, df in sheet_frames.items():
+        df = df.copy()
+        for var_name, var_config in SHEET_VARIABLES[sheet_name].items():
+            df[var_name] = apply_variable_rules(df, var_config["rules"], var_config["separator"])
+
+
+def _run_ai_orchestration(sheet_frames: Dict[str, pd.DataFrame]) -> None:
+    """本地编排部分：全局去重 -> 本地预提取 -> 按 token 分批 -> 结果回填"""
+    plan = plan_ai_work(sheet_frames, SHEET_VARIABLES)
+    local_results, pending = DrugLexicon().resolve_many(plan.texts)
+    pack_batches(pending)
+    text_results = dict(local_results)
+    text_results.update((text, text) for text in pending)
+    for sheet_name, df in sheet_frames.items():
+        for var_config in SHEET_VARIABLES[sheet_name].values():
+            rules = var_config["rules"]
+            if any(rule.extract_type == "AI提取" for rule in compile_rules(rules)):
+                resolve_ai_results(collect_ai_tasks(df, rules), text_results)
+
+
+def _run_write(sheet_frames: Dict[str, pd.DataFrame]) -> None:
+    write_excel(sheet_frames, io.BytesIO(), WRITER_STYLED)
+
+
+def run_benchmarks(rows_list: List[int], duplicate_ratio: float, repeat: int, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """返回 {行数: {阶段: 最佳耗时秒数}}"""
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for rows in rows_list:
+            path = os.path.join(tmp_dir, f"bench_{rows}.xlsx")
+            write_workbook(path, rows, duplicate_ratio, seed)
+            sheet_names = list(SHEET_VARIABLES)
+
+            timings: Dict[str, float] = {}
+            timings["read"] = _best(lambda: read_sheets(path, sheet_names), repeat)
+            sheet_frames = read_sheets(path, sheet_names)
+            rows_by_sheet = _legacy_rows(sheet_frames)
+
+            timings["evaluate_condition"] = _best(lambda: _run_evaluate_condition(rows_by_sheet), repeat)
+            timings["extract_value"] = _best(lambda: _run_extract_value(rows_by_sheet), repeat)
+            timings["process_variable_rules"] = _best(lambda: _run_process_variable_rules(rows_by_sheet), repeat)
+            timings["apply_variable_rules"] = _best(lambda: _run_apply_variable_rules(sheet_frames), repeat)
+            timings["ai_orchestration"] = _best(lambda: _run_ai_orchestration(sheet_frames), repeat)
+            timings["write"] = _best(lambda: _run_write(sheet_frames), repeat)
+
+            results[str(rows)] = {stage: round(timings[stage], 4) for stage in STAGES}
+            print(f"{rows} 行: " + ", ".join(f"{stage} {timings[stage]:.3f}s" for stage in STAGES), file=sys.stderr)
+    return results
+
+
+def verify_pattern_automaton(cases: int = 20000, seed: int = 0) -> List[str]:
+    """多模式自动机与逐个 `pattern in text` 对比（含空模式、空文本、重复模式），返回不一致的用例说明"""
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(cases):
+        patterns = ["".join(rng.choice("ab") for _ in range(rng.randint(0, 3))) for _ in range(rng.randint(1, 6))]
+        text = "".join(rng.choice("abc") for _ in range(rng.randint(0, 8)))
+        expected = {idx for idx, pattern in enumerate(patterns) if pattern in text}
+        if PatternAutomaton(patterns).search(text) != expected:
+            mismatches.append(f"PatternAutomaton({patterns!r}).search({text!r})")
+    return mismatches
+
+
+def verify_drug_lexicon() -> List[str]:
+    """内置词表按 LEXICON_CASES 预提取，返回与预期不一致的用例说明"""
+    lexicon = DrugLexicon()
+    mismatches = []
+    for text, expected in LEXICON_CASES.items():
+        got = lexicon.resolve(text)
+        if got != expected:
+            mismatches.append(f"DrugLexicon().resolve({text!r}) = {got!r}，预期 {expected!r}")
+    return mismatches
+
+
+def _reference_seconds(timings: Dict[str, float]) -> float:
+    return sum(timings.get(stage, 0.0) for stage in REFERENCE_STAGES)
+
+
+def relative_timings(results: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """{行数: {阶段: 耗时 / 同一次运行中参照阶段的耗时之和}}（不含参照阶段本身）"""
+    relative: Dict[str, Dict[str, float]] = {}
+    for rows, timings in results.items():
+        reference = _reference_seconds(timings)
+        if not reference:
+            continue
+        relative[rows] = {
+            stage: round(seconds / reference, 4) for stage, seconds in timings.items() if stage not in REFERENCE_STAGES
+        }
+    return relative
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """按相对耗时返回退化的阶段说明；baseline 为基线的 results，其中没有的行数/阶段跳过
+
+    阶段相对耗时超过基线的 (1 + tolerance) 倍，且按本机参照阶段换算的差值超过 MIN_REGRESSION_SECONDS 时判定为退化。
+    """
+    current = relative_timings(results)
+    expected = relative_timings(baseline)
+    regressions = []
+    for rows, ratios in current.items():
+        reference_seconds = _reference_seconds(results[rows])
+        for stage, ratio in ratios.items():
+            baseline_ratio = expected.get(rows, {}).get(stage)
+            if not baseline_ratio:
+                continue
+            excess = (ratio - baseline_ratio) * reference_seconds
+            if ratio > baseline_ratio * (1 + tolerance) and excess > MIN_REGRESSION_SECONDS:
+                regressions.append(
+                    f"{rows} 行 {stage}: 相对耗时 {ratio:.3f} > 基线 {baseline_ratio:.3f} "
+                    f"(+{ratio / baseline_ratio - 1:.0%}，本机约多 {excess:.3f}s)"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="医学编码数据预处理器 - 基准测试")
+    parser.add_argument("--rows", default=",".join(map(str, DEFAULT_ROWS)), help="逗号分隔的每表行数")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.8, help="文本列的重复率 (0~1)")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段重复次数，取最快一次")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--check", action="store_true", help="与基线比较相对耗时，有退化时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的相对变慢比例")
+    args = parser.parse_args(argv)
+
+    rows_list = [int(value) for value in args.rows.split(",") if value.strip()]
+    results = run_benchmarks(rows_list, args.duplicate_ratio, args.repeat)
+    report = {
+        "duplicate_ratio": args.duplicate_ratio,
+        "machine": f"{platform.system()} {platform.machine()} / Python {platform.python_version()} / {os.cpu_count()} CPU",
+        "reference_stages": list(REFERENCE_STAGES),
+        "results": results,
+        "relative": relative_timings(results),
+    }
+
+    exit_code = 0
+    if args.check:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        report["regressions"] = regressions
+        if regressions:
+            exit_code = 1
+            for line in regressions:
+                print(f"退化: {line}", file=sys.stderr)
+        mismatches = verify_drug_lexicon() + verify_pattern_automaton()
+        report["mismatches"] = mismatches[:20]
+        if mismatches:
+            exit_code = 1
+            print(f"结果不一致: {len(mismatches)} 个用例，例如 {mismatches[0]}", file=sys.stderr)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+﻿"""合成临床数据工作簿：CM/AE/MH 结构，可调行数与重复率
+
+用法:
+    python -m benchmarks.workbook 输出.xlsx --rows 10000 [--duplicate-ratio 0.8] [--seed 0]
+"""
+import argparse
+import random
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from app.drug_lexicon import DOSAGE_FORMS, ROUTE_PREFIXES
+
+DRUG_CORES = [
+    "阿司匹林", "布洛芬", "对乙酰氨基酚", "头孢克肟", "阿莫西林", "左氧氟沙星", "奥美拉唑", "雷贝拉唑",
+    "氨氯地平", "缬沙坦", "厄贝沙坦", "美托洛尔", "阿托伐他汀", "瑞舒伐他汀", "二甲双胍", "格列美脲",
+    "胰岛素", "氯化钠", "葡萄糖", "地塞米松", "甲泼尼龙", "氯雷他定", "孟鲁司特", "沙丁胺醇",
+    "布地奈德", "氨溴索", "蒙脱石", "多潘立酮", "铝碳酸镁", "复方甘草", "维生素C", "碳酸钙",
+]
+ROUTES = ["口服", "静脉注射", "静脉滴注", "皮下注射", "肌肉注射", "外用", "吸入", ""]
+TERMS = [
+    "头痛", "发热", "恶心", "呕吐", "腹泻", "皮疹", "咳嗽", "失眠", "高血压", "2型糖尿病",
+    "高脂血症", "上呼吸道感染", "胃炎", "便秘", "乏力", "头晕", "关节痛", "过敏性鼻炎",
+]
+OUTCOMES = ["痊愈", "好转", "未好转", "痊愈伴后遗症", "死亡", "未知"]
+
+
+def _date(rng: random.Random) -> str:
+    if rng.random() < 0.05:
+        return "uk-uk-uk"
+    return f"20{rng.randint(18, 24):02d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def _drug_name(rng: random.Random) -> str:
+    """中文药名：核心成分 + 剂型，部分带给药途径前缀、浓度、规格或括号限定语"""
+    name = rng.choice(DRUG_CORES) + rng.choice(DOSAGE_FORMS)
+    roll = rng.random()
+    if roll < 0.1:
+        name = rng.choice(ROUTE_PREFIXES) + name
+    elif roll < 0.2:
+        name = f"{rng.choice(['0.9', '5', '10'])}%{name}"
+    elif roll < 0.3:
+        name = f"{name} {rng.choice([5, 10, 20, 100, 250, 500])}mg"
+    elif roll < 0.35:
+        name = f"{name}（{rng.choice(['儿童型', '薄膜衣', 'Ⅱ'])}）"
+    return name
+
+
+def _term_ref(rng: random.Random) -> str:
+    """AENO/MHNO 风格的关联记录：序号;名称;日期"""
+    return f"{rng.randint(1, 20)};{rng.choice(TERMS)};{_date(rng)}"
+
+
+def _pooled(
+    rng: random.Random,
+    rows: int,
+    duplicate_ratio: float,
+    make: Callable[[random.Random], str],
+    blank_ratio: float = 0.0,
+) -> List[str]:
+    """从约 rows*(1-duplicate_ratio) 个不同取值的池中抽样，得到目标重复率；blank_ratio 为空值比例"""
+    pool_size = max(1, int(round(rows * (1 - duplicate_ratio))))
+    pool = list(dict.fromkeys(make(rng) for _ in range(pool_size)))
+    # 组合空间不够大时用编号补足不同取值
+    while len(pool) < pool_size:
+        pool.append(f"{make(rng)} {len(pool)}")
+    return ["" if rng.random() < blank_ratio else rng.choice(pool) for _ in range(rows)]
+
+
+def generate_sheets(rows: int, duplicate_ratio: float = 0.8, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """生成 {工作表: DataFrame}，所有单元格为字符串"""
+    rng = random.Random(seed)
+
+    cm = pd.DataFrame({
+        "SUBJID": [f"S{rng.randint(1, max(1, rows // 20)):05d}" for _ in range(rows)],
+        "CMDECOD": _pooled(rng, rows, duplicate_ratio, _drug_name),
+        "CMROUTEO": [rng.choice(ROUTES) for _ in range(rows)],
+        "CMROUTE_DEC": [rng.choice(ROUTES[:-1]) for _ in range(rows)],
+        "CMDOSE": [str(rng.choice([0.5, 1, 2, 5, 10, 20, 100])) for _ in range(rows)],
+        "AENO": _pooled(rng, rows, duplicate_ratio, _term_ref, blank_ratio=0.5),
+        "MHNO": _pooled(rng, rows, duplicate_ratio, _term_ref, blank_ratio=0.7),
+        "CMRES_3_DEC": [rng.choice(TERMS) if rng.random() < 0.1 else "" for _ in range(rows)],
+        "CMRES_4_DEC": [rng.choice(TERMS) if rng.random() < 0.05 else "" for _ in range(rows)],
+        "RESOT": [rng.choice(["预防用药", "其他"]) if rng.random() < 0.05 else "" for _ in range(rows)],
+        "CMSTDAT": [_date(rng) for _ in range(rows)],
+    })
+    ae = pd.DataFrame({
+        "SUBJID": [f"S{rng.randint(1, max(1, rows // 20)):05d}" for _ in range(rows)],
+        "AETERM": _pooled(rng, rows, duplicate_ratio, lambda r: r.choice(TERMS) + r.choice(["", "加重", "（轻度）"])),
+        "AESTDAT": [_date(rng) for _ in range(rows)],
+        "AESER": [rng.choice(["是", "否", "否", "否"]) for _ in range(rows)],
+        "AETOXGR": [str(rng.randint(1, 5)) for _ in range(rows)],
+        "AEOUT": [rng.choice(OUTCOMES) for _ in range(rows)],
+    })
+    mh = pd.DataFrame({
+        "SUBJID": [f"S{rng.randint(1, max(1, rows // 20)):05d}" for _ in range(rows)],
+        "MHTERM": _pooled(rng, rows, duplicate_ratio, lambda r: r.choice(TERMS) + r.choice(["", "史", " 10年"])),
+        "MHSTDAT": [_date(rng) for _ in range(rows)],
+        "MHONGO": [rng.choice(["是", "否"]) for _ in range(rows)],
+    })
+    return {"CM": cm, "AE": ae, "MH": mh}
+
+
+def write_workbook(path: str, rows: int, duplicate_ratio: float = 0.8, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """生成并写出工作簿，返回生成的数据"""
+    sheets = generate_sheets(rows, duplicate_ratio, seed)
+    with pd.ExcelWriter(path) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return sheets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成临床数据工作簿")
+    parser.add_argument("output", help="输出 xlsx 路径")
+    parser.add_argument("--rows", type=int, default=10000, help="每个工作表的行数")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.8, help="文本列的重复率 (0~1)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    write_workbook(args.output, args.rows, args.duplicate_ratio, args.seed)
+    print(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,38 @@
 import streamlit as st
 import pandas as pd
+import copy
+import functools
 import html
-import io
-import time
+import json
 import logging
-from openpyxl.styles import PatternFill, Border, Side, Alignment, Font
+import uuid
 
-from app.ai_extractor import ai_extract_batch
+from app.ai_cache import AICache
+from app.checkpoint import CheckpointStore
 from app.config_store import load_all_configs, save_current_config, load_config, delete_config
-from app.rules import evaluate_condition, extract_value, process_variable_rules
+from app.incremental import IncrementalStore
+from app.log_pipeline import setup_logging
+from app.jobs import FINISHED_STATUSES, STATUS_DONE, STATUS_FAILED, STATUS_LABELS, STATUS_QUEUED, JobRunner, export_workbook
+from app.parallel import RulePool
+from app.rules import missing_columns, validate_sheet_variables
+from app.workbook_cache import WorkbookCache
+from app.writers import FORMAT_LABELS, FORMAT_XLSX, WRITER_LABELS
 from app.settings import AI_CONFIG
 
 # ==================== 日志配置 ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('log.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
 MAX_UI_LOG_LINES = 200
+LOG_REFRESH_SECONDS = 2.0
+JOB_POLL_SECONDS = 1.0
 
 
-class UILogHandler(logging.Handler):
-    def emit(self, record):
-        try:
-            message = self.format(record)
-            logs = st.session_state.get("ui_logs")
-            if logs is None:
-                st.session_state.ui_logs = []
-                logs = st.session_state.ui_logs
-            logs.append(message)
-            if len(logs) > MAX_UI_LOG_LINES:
-                del logs[: len(logs) - MAX_UI_LOG_LINES]
-        except Exception:
-            pass
-
-
-root_logger = logging.getLogger()
-if not any(getattr(h, "name", "") == "ui_log_handler" for h in root_logger.handlers):
-    ui_handler = UILogHandler()
-    ui_handler.name = "ui_log_handler"
-    ui_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    root_logger.addHandler(ui_handler)
+@st.cache_resource(show_spinner=False)
+def get_log_buffer():
+    """进程内只配置一次日志：写文件/控制台/环形缓冲区都在后台监听线程中完成，任何线程记录日志都只是入队"""
+    return setup_logging("log.log", buffer_lines=MAX_UI_LOG_LINES)
+
+
+log_buffer = get_log_buffer()
+logger = logging.getLogger(__name__)
 
 logger.info("=" * 80)
 logger.info("程序启动")
@@ -140,6 +127,42 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def get_ai_cache():
+    """进程内共享同一个持久化AI缓存（跨会话、跨用户）"""
+    return AICache.from_settings()
+
+
+@st.cache_resource
+def get_workbook_cache():
+    """进程内共享的工作簿解析缓存（按内容哈希）"""
+    return WorkbookCache()
+
+
+@st.cache_resource
+def get_rule_pool():
+    """进程内共享的非AI规则进程池（RULE_WORKERS 为 1 时为 None）"""
+    return RulePool.from_settings()
+
+
+@st.cache_resource
+def get_incremental_store():
+    """进程内共享的派生结果缓存：再次导出时只重算规则或输入有变化的部分"""
+    return IncrementalStore()
+
+
+@st.cache_resource
+def get_checkpoint_store():
+    """进程内共享的AI断点：中断或失败的导出再次提交时从已完成的批次继续（CHECKPOINT_PATH 为空时为 None）"""
+    return CheckpointStore.from_settings()
+
+
+@st.cache_resource
+def get_job_runner():
+    """进程内共享的后台任务执行器：导出在后台线程中运行，页面刷新或交互不会中断"""
+    return JobRunner.from_settings()
+
+
 # 初始化session state
 if 'uploaded_file' not in st.session_state:
     st.session_state.uploaded_file = None
@@ -154,25 +177,240 @@ if 'sheet_variables' not in st.session_state:
     st.session_state.sheet_variables = {}
     logger.info("初始化 session_state: sheet_variables")
 if 'ai_cache' not in st.session_state:
-    st.session_state.ai_cache = {}
+    st.session_state.ai_cache = get_ai_cache()
     logger.info("初始化 session_state: ai_cache")
-if 'ui_logs' not in st.session_state:
-    st.session_state.ui_logs = []
-    logger.info("初始化 session_state: ui_logs")
+if 'job_owner' not in st.session_state:
+    # 提交者标识保存在 URL 中，刷新页面后仍能看到自己的任务
+    st.session_state.job_owner = st.query_params.get("sid") or uuid.uuid4().hex[:12]
+    st.query_params["sid"] = st.session_state.job_owner
+    logger.info("初始化 session_state: job_owner")
+
+
+def render_log_panel():
+    """从环形缓冲区渲染最近的日志；内容未变化时复用已转义的文本"""
+    st.markdown(f"<div class='log-panel'>{log_buffer.html()}</div>", unsafe_allow_html=True)
+
+
+# 有后台任务运行时按固定频率刷新日志面板，与任务产生的日志条数无关
+render_live_log_panel = st.fragment(run_every=LOG_REFRESH_SECONDS)(render_log_panel)
+
+
+RULES_PER_PAGE = 10
+
+
+def rule_page_count(rules):
+    return max(1, -(-len(rules) // RULES_PER_PAGE))
 
 
-def render_log_panel(placeholder):
-    logs = st.session_state.get("ui_logs", [])
-    if logs:
-        content = "\n".join(logs[-MAX_UI_LOG_LINES:])
+def rule_summary_text(idx, rule, last):
+    cond_col = rule.get('condition_column', '')
+    cond_op = rule.get('condition_operator', '=')
+    cond_val = rule.get('condition_value', '')
+    ext_type = rule.get('extract_type', '直接提取')
+    ext_val_type = rule.get('extract_value_type', '从列提取')
+    ext_val = rule.get('extract_value', '')
+    
+    rule_text = f"{'└─' if last else '├─'} 规则{idx+1}: "
+    rule_text += f"当 {cond_col} {cond_op} "
+    rule_text += f'"{cond_val}"' if cond_val else '(空)'
+    rule_text += f" 时，{ext_type} "
+    
+    if ext_type == "AI提取":
+        rule_text += f"🤖 从 {ext_val} 提取成分"
+    elif ext_val_type == "固定文本":
+        rule_text += f'"{ext_val}"'
     else:
-        content = "暂无日志"
-    placeholder.markdown(
-        f"<div class='log-panel'>{html.escape(content)}</div>",
+        rule_text += f'{ext_val}'
+    
+    if ext_type == "正则提取":
+        regex = rule.get('regex_pattern', '')
+        cap_grp = rule.get('capture_group', 1)
+        rule_text += f" (模式: {regex}, 组{cap_grp})"
+    return rule_text
+
+
+@functools.lru_cache(maxsize=4096)
+def _rules_summary_html(rules_json):
+    rules = json.loads(rules_json)
+    return "".join(
+        f"<div class='rule-summary'>{html.escape(rule_summary_text(idx, rule, idx == len(rules) - 1))}</div>"
+        for idx, rule in enumerate(rules)
+    )
+
+
+def variable_summary_html(rules):
+    """一个变量全部规则的只读摘要（一段 HTML），按规则内容缓存，规则不变时不重新生成"""
+    return _rules_summary_html(json.dumps(rules, ensure_ascii=False, sort_keys=True, default=str))
+
+
+def render_rule_overview(sheet_vars):
+    """工作表全部变量的规则摘要，合并为一次渲染"""
+    if not sheet_vars:
+        st.caption("暂无变量")
+        return
+    st.markdown(
+        "".join(
+            f"<div class='variable-header'>📋 {html.escape(var_name)}（{len(var_config.get('rules', []))} 条规则）</div>"
+            + variable_summary_html(var_config.get('rules', []))
+            for var_name, var_config in sheet_vars.items()
+        ),
         unsafe_allow_html=True,
     )
 
 
+STAGE_LABELS = {"read": "读取", "rules": "规则计算", "ai": "AI提取", "write": "写出"}
+
+
+def render_run_report(run_summary, key="run_report_download"):
+    """导出后的运行报告：分阶段耗时表、AI/token/缓存指标，以及 JSON 报告下载"""
+    report = run_summary["metrics"]
+    ai = report["ai"]
+    tokens = report["tokens"]
+    cache = report["cache"]
+
+    with st.expander("📊 运行报告", expanded=False):
+        totals = " | ".join(
+            f"{STAGE_LABELS.get(stage, stage)} {seconds:.2f}秒" for stage, seconds in report["stage_totals"].items()
+        )
+        st.caption(f"总耗时 {report['elapsed']:.2f}秒 — {totals}")
+        if report["stages"]:
+            stage_df = pd.DataFrame(report["stages"])
+            stage_df["stage"] = stage_df["stage"].map(lambda stage: STAGE_LABELS.get(stage, stage))
+            stage_df = stage_df.rename(columns={"stage": "阶段", "name": "项目", "seconds": "耗时(秒)"})
+            st.dataframe(stage_df, hide_index=True, use_container_width=True)
+        st.caption(
+            f"AI请求 {ai['requests']} 次（重试 {ai['retries']}，出错 {ai['request_errors']}），"
+            f"请求耗时 p50/p95/p99 {ai['request_latency_p50']:.2f}/{ai['request_latency_p95']:.2f}/"
+            f"{ai['request_latency_p99']:.2f}秒，排队等待合计 {ai['queue_wait_total']:.2f}秒，"
+            f"限流等待合计 {ai['rate_limit_wait_total']:.2f}秒"
+            + (f"，流式首字节 p50 {ai['first_token_p50']:.2f}秒" if ai["first_token_p50"] else "")
+        )
+        st.caption(
+            f"token: 输入 {tokens['prompt']}（缓存命中 {tokens['cached']}），输出 {tokens['completion']}；"
+            f"文本缓存命中 {cache['hits']}/{cache['lookups']} ({cache['hit_rate']:.0%})，本地预提取 {cache['local']}，"
+            f"断点复用 {cache['resumed']}"
+        )
+        st.download_button(
+            label="下载运行报告 (JSON)",
+            data=json.dumps(run_summary, ensure_ascii=False, indent=2, default=str).encode("utf-8"),
+            file_name="run_report.json",
+            mime="application/json",
+            key=key,
+        )
+
+
+def render_job_result(job):
+    """已完成任务：AI去重/增量/失败提示、结果下载和运行报告"""
+    result = job.result
+    run_summary = result["summary"]
+    plan_summary = run_summary["ai"]
+    if plan_summary:
+        st.info(
+            f"🤖 AI去重: {plan_summary['tasks']} 个任务 → {plan_summary['unique_texts']} 个唯一文本，"
+            f"本地预提取 {plan_summary['local_ratio']:.0%}，"
+            f"节省 {plan_summary['requests_saved']} 次请求；批次耗时 p95 {plan_summary['latency_p95']:.2f}秒"
+        )
+    resume_summary = run_summary.get("resume")
+    if resume_summary:
+        st.info(
+            f"⏯️ 断点续跑: 复用上次中断运行的 {resume_summary['texts']} 条AI结果"
+            f"（{resume_summary['batches']} 个已完成批次）"
+        )
+    reuse_summary = run_summary.get("incremental")
+    if reuse_summary and reuse_summary["reused_rows"]:
+        st.info(
+            f"♻️ 增量处理: 复用 {reuse_summary['reused_rows']} 行结果，"
+            f"重算 {reuse_summary['computed_rows']} 行"
+        )
+    if run_summary.get("missing_columns"):
+        st.warning(
+            "⚠️ 以下规则引用的列不存在，已跳过: " + "；".join(run_summary["missing_columns"])
+        )
+    if run_summary["failures"]:
+        failed_texts = list(run_summary["failures"])
+        st.warning(
+            f"⚠️ {len(failed_texts)} 条AI提取失败，已保留原文（未写入缓存，下次导出会重试）: "
+            + "、".join(failed_texts[:20])
+            + (" ..." if len(failed_texts) > 20 else "")
+        )
+
+    st.download_button(
+        label="⬇️ 下载处理后的文件",
+        data=result["data"],
+        file_name=result["file_name"],
+        mime=result["mime"],
+        use_container_width=True,
+        key=f"job_download_{job.id}",
+    )
+    st.success("✅ 文件处理完成!")
+    render_run_report(run_summary, key=f"run_report_download_{job.id}")
+
+
+def render_job(job, runner):
+    """一个任务的状态：排队位置或实时进度（工作表、变量、AI批次、预计剩余时间）、取消按钮、结果"""
+    state = job.snapshot()
+    status_label = STATUS_LABELS[state["status"]]
+    st.markdown(f"**{state['title']}** · {status_label} · `{state['id']}` · 已用时 {state['elapsed']:.0f}秒")
+
+    if state["status"] not in FINISHED_STATUSES:
+        if state["status"] == STATUS_QUEUED:
+            st.caption(f"前面还有 {runner.queue_position(job)} 个任务")
+        else:
+            counter = state["items"] or state["batch"]
+            if counter and counter[1]:
+                unit = "条" if state["items"] else "批"
+                st.progress(min(counter[0] / counter[1], 1.0), text=f"AI提取 {counter[0]}/{counter[1]} {unit}")
+            position = " / ".join(part for part in (state["sheet"], state["variable"]) if part)
+            eta = f"，预计剩余 {state['eta']:.0f}秒" if state["eta"] is not None else ""
+            st.caption(f"当前: {position or '准备中'}{eta}")
+        st.button(
+            "⏹️ 取消任务",
+            key=f"cancel_job_{job.id}",
+            on_click=runner.cancel,
+            args=(job.id,),
+            disabled=job.cancel_event.is_set(),
+        )
+    elif state["status"] == STATUS_DONE:
+        render_job_result(job)
+    elif state["status"] == STATUS_FAILED:
+        st.error(f"❌ 处理失败: {state['error']}")
+
+    if state["messages"]:
+        with st.expander("任务日志", expanded=state["status"] not in FINISHED_STATUSES):
+            st.markdown(
+                f"<div class='log-panel'>{html.escape(chr(10).join(state['messages']))}</div>",
+                unsafe_allow_html=True,
+            )
+
+
+def render_jobs(runner, jobs):
+    for job in jobs:
+        with st.container(border=True):
+            render_job(job, runner)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_active_jobs():
+    """有未结束任务时每秒只重绘任务面板；全部结束后整页重绘一次以停止轮询"""
+    runner = get_job_runner()
+    jobs = runner.list_jobs(st.session_state.job_owner)
+    if all(job.status in FINISHED_STATUSES for job in jobs):
+        st.rerun()
+    render_jobs(runner, jobs)
+
+
+def render_job_panel():
+    runner = get_job_runner()
+    jobs = runner.list_jobs(st.session_state.job_owner)
+    if not jobs:
+        return
+    st.markdown("#### 📋 我的导出任务")
+    if any(job.status not in FINISHED_STATUSES for job in jobs):
+        render_active_jobs()
+    else:
+        render_jobs(runner, jobs)
+
+
 # ==================== 侧边栏：配置管理 ====================
 
 with st.sidebar:
@@ -187,9 +425,38 @@ with st.sidebar:
         index=model_options.index(st.session_state.ai_model),
         key="ai_model",
     )
-    if selected_model != AI_CONFIG["MODEL"]:
-        AI_CONFIG["MODEL"] = selected_model
-        logger.info("AI模型切换为: %s", selected_model)
+    # 模型只保存在本会话中，提交任务时随任务传入；不修改进程共享的 AI_CONFIG，以免影响其他用户的任务
+
+    with st.expander("AI缓存", expanded=False):
+        ai_cache = st.session_state.ai_cache
+        st.caption(f"🗄️ 已缓存 {len(ai_cache)} 条")
+        cache_format = st.radio("格式", options=["csv", "jsonl"], horizontal=True, key="ai_cache_format")
+        cache_upload = st.file_uploader(
+            "导入映射",
+            type=["csv", "jsonl"],
+            help="CSV 两列 text,value；JSONL 每行 {\"text\": ..., \"value\": ...}",
+            key="ai_cache_upload",
+        )
+        if cache_upload is not None and st.button("📤 导入", key="ai_cache_import_btn", use_container_width=True):
+            try:
+                imported = ai_cache.import_mappings(
+                    cache_upload.getvalue(), cache_upload.name.rsplit(".", 1)[-1].lower(), model=selected_model
+                )
+                st.success(f"✅ 已导入 {imported} 条")
+            except Exception as e:
+                logger.error(f"AI缓存导入失败: {str(e)}", exc_info=True)
+                st.error(f"❌ 导入失败: {str(e)}")
+        if st.button("📦 生成导出文件", key="ai_cache_prepare_btn", use_container_width=True):
+            st.session_state.ai_cache_export = (cache_format, ai_cache.export_mappings(cache_format, model=selected_model))
+        if st.session_state.get("ai_cache_export"):
+            export_format, export_data = st.session_state.ai_cache_export
+            st.download_button(
+                "📥 下载映射",
+                data=export_data,
+                file_name=f"ai_cache.{export_format}",
+                key="ai_cache_export_btn",
+                use_container_width=True,
+            )
 
     st.markdown("### 💾 配置管理")
     
@@ -257,12 +524,19 @@ with col_upload:
     if uploaded_file is not None:
         logger.info(f"用户上传文件: {uploaded_file.name}")
         try:
-            excel_file = pd.ExcelFile(uploaded_file)
+            file_id = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+            if (
+                st.session_state.get("workbook_file_id") != file_id
+                or st.session_state.excel_data is None
+                or st.session_state.excel_data.key not in get_workbook_cache()
+            ):
+                excel_file = get_workbook_cache().register(uploaded_file.getvalue(), uploaded_file.name)
+                st.session_state.excel_data = excel_file
+                st.session_state.workbook_file_id = file_id
+                logger.info(f"Excel文件读取成功: {len(excel_file.sheet_names)} 个工作表")
+                logger.info(f"工作表列表: {excel_file.sheet_names}")
+            excel_file = st.session_state.excel_data
             st.session_state.uploaded_file = uploaded_file
-            st.session_state.excel_data = excel_file
-
-            logger.info(f"Excel文件读取成功: {len(excel_file.sheet_names)} 个工作表")
-            logger.info(f"工作表列表: {excel_file.sheet_names}")
 
             if not st.session_state.selected_sheets:
                 st.session_state.selected_sheets = {
@@ -278,8 +552,11 @@ with col_upload:
 
 with col_log:
     st.markdown("<div class='section-header'>🧾 实时日志</div>", unsafe_allow_html=True)
-    log_panel_placeholder = st.empty()
-    render_log_panel(log_panel_placeholder)
+    owner_jobs = get_job_runner().list_jobs(st.session_state.job_owner)
+    if any(job.status not in FINISHED_STATUSES for job in owner_jobs):
+        render_live_log_panel()
+    else:
+        render_log_panel()
 
 st.markdown("---")
 
@@ -330,212 +607,224 @@ if st.session_state.excel_data is not None:
         if not selected_sheets:
             st.warning("⚠️ 请先选择至少一个工作表")
         else:
-            for sheet_name in selected_sheets:
-                with st.expander(f"📊 {sheet_name}", expanded=True):
-                    
-                    if sheet_name not in st.session_state.sheet_variables:
-                        st.session_state.sheet_variables[sheet_name] = {}
-                        logger.info(f"初始化工作表配置: {sheet_name}")
-                    
-                    sheet_vars = st.session_state.sheet_variables[sheet_name]
-                    
-                    col1, col2 = st.columns([3, 1])
-                    with col1:
-                        new_var_name = st.text_input(
-                            "新变量名",
-                            placeholder="例如: ROUTE, INDICATION",
-                            key=f"new_var_{sheet_name}"
-                        )
-                    with col2:
-                        st.markdown("<br>", unsafe_allow_html=True)
-                        if st.button("➕ 添加变量", key=f"add_var_{sheet_name}"):
-                            if new_var_name and new_var_name not in sheet_vars:
-                                sheet_vars[new_var_name] = {
-                                    'separator': ';',
-                                    'rules': []
-                                }
-                                logger.info(f"添加新变量: {sheet_name}.{new_var_name}")
-                                st.rerun()
-                            elif new_var_name in sheet_vars:
-                                st.warning("⚠️ 变量名已存在")
-                            else:
-                                st.warning("⚠️ 请输入变量名")
-                    
-                    st.markdown("---")
-                    
-                    for var_name in list(sheet_vars.keys()):
-                        var_config = sheet_vars[var_name]
+            # 只渲染当前编辑的工作表和变量，其余变量以预先生成的规则摘要展示
+            sheet_labels = {
+                name: f"📊 {name}（{len(st.session_state.sheet_variables.get(name, {}))} 个变量）"
+                for name in selected_sheets
+            }
+            sheet_name = st.selectbox(
+                "编辑工作表",
+                options=selected_sheets,
+                format_func=sheet_labels.get,
+                key="edit_sheet",
+            )
+            
+            if sheet_name not in st.session_state.sheet_variables:
+                st.session_state.sheet_variables[sheet_name] = {}
+                logger.info(f"初始化工作表配置: {sheet_name}")
+            
+            sheet_vars = st.session_state.sheet_variables[sheet_name]
+            var_select_key = f"edit_var_{sheet_name}"
+            
+            try:
+                st.caption("可用列: " + ", ".join(st.session_state.excel_data.columns(sheet_name)))
+            except Exception as e:
+                logger.warning(f"读取列名失败: {sheet_name}: {str(e)}")
+            
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                new_var_name = st.text_input(
+                    "新变量名",
+                    placeholder="例如: ROUTE, INDICATION",
+                    key=f"new_var_{sheet_name}"
+                )
+            with col2:
+                st.markdown("<br>", unsafe_allow_html=True)
+                if st.button("➕ 添加变量", key=f"add_var_{sheet_name}"):
+                    if new_var_name and new_var_name not in sheet_vars:
+                        sheet_vars[new_var_name] = {
+                            'separator': ';',
+                            'rules': []
+                        }
+                        st.session_state[var_select_key] = new_var_name
+                        logger.info(f"添加新变量: {sheet_name}.{new_var_name}")
+                        st.rerun()
+                    elif new_var_name in sheet_vars:
+                        st.warning("⚠️ 变量名已存在")
+                    else:
+                        st.warning("⚠️ 请输入变量名")
+            
+            with st.expander(f"📑 规则总览（{len(sheet_vars)} 个变量）", expanded=False):
+                render_rule_overview(sheet_vars)
+            
+            st.markdown("---")
+            
+            if sheet_vars:
+                var_name = st.selectbox("编辑变量", options=list(sheet_vars), key=var_select_key)
+                var_config = sheet_vars[var_name]
+                
+                st.markdown(f"<div class='variable-header'>📋 {html.escape(var_name)}</div>", unsafe_allow_html=True)
+                
+                rule_page_key = f"rule_page_{sheet_name}_{var_name}"
+                col1, col2, col3 = st.columns([2, 2, 1])
+                with col1:
+                    var_config['separator'] = st.text_input(
+                        "分隔符",
+                        value=var_config.get('separator', ';'),
+                        key=f"sep_{sheet_name}_{var_name}"
+                    )
+                with col2:
+                    st.markdown("<br>", unsafe_allow_html=True)
+                    if st.button(f"➕ 添加规则", key=f"add_rule_{sheet_name}_{var_name}"):
+                        var_config['rules'].append({
+                            'condition_column': '',
+                            'condition_operator': '=',
+                            'condition_value': '',
+                            'extract_type': '直接提取',
+                            'extract_value_type': '从列提取',
+                            'extract_value': '',
+                            'regex_pattern': '',
+                            'capture_group': 1
+                        })
+                        st.session_state[rule_page_key] = rule_page_count(var_config['rules'])
+                        logger.info(f"添加规则: {sheet_name}.{var_name}")
+                        st.rerun()
+                with col3:
+                    st.markdown("<br>", unsafe_allow_html=True)
+                    if st.button("🗑️", key=f"del_var_{sheet_name}_{var_name}"):
+                        logger.info(f"删除变量: {sheet_name}.{var_name}")
+                        del sheet_vars[var_name]
+                        st.session_state.pop(var_select_key, None)
+                        st.rerun()
+                
+                st.markdown(variable_summary_html(var_config.get('rules', [])), unsafe_allow_html=True)
+                
+                page_count = rule_page_count(var_config['rules'])
+                page = 1
+                if page_count > 1:
+                    if st.session_state.get(rule_page_key, 1) > page_count:
+                        st.session_state[rule_page_key] = page_count
+                    page = int(st.number_input(
+                        f"规则页（共 {page_count} 页，每页 {RULES_PER_PAGE} 条）",
+                        min_value=1,
+                        max_value=page_count,
+                        step=1,
+                        key=rule_page_key,
+                    ))
+                first_rule = (page - 1) * RULES_PER_PAGE
+                
+                # 编辑规则（仅当前页）
+                page_rules = var_config['rules'][first_rule:first_rule + RULES_PER_PAGE]
+                for idx, rule in enumerate(page_rules, first_rule):
+                    with st.expander(f"🔧 规则 {idx + 1}", expanded=False):
                         
-                        st.markdown(f"<div class='variable-header'>📋 {var_name}</div>", unsafe_allow_html=True)
+                        if st.button("🗑️ 删除此规则", key=f"del_rule_{sheet_name}_{var_name}_{idx}"):
+                            var_config['rules'].pop(idx)
+                            logger.info(f"删除规则: {sheet_name}.{var_name}.规则{idx+1}")
+                            st.rerun()
+                        
+                        st.markdown("**条件设置**")
+                        col1, col2, col3 = st.columns(3)
                         
-                        col1, col2, col3 = st.columns([2, 2, 1])
                         with col1:
-                            var_config['separator'] = st.text_input(
-                                "分隔符",
-                                value=var_config.get('separator', ';'),
-                                key=f"sep_{sheet_name}_{var_name}"
+                            rule['condition_column'] = st.text_input(
+                                "判断变量(列名)",
+                                value=rule.get('condition_column', ''),
+                                placeholder="例如: CMROUTE",
+                                key=f"cond_col_{sheet_name}_{var_name}_{idx}"
                             )
+                        
                         with col2:
-                            st.markdown("<br>", unsafe_allow_html=True)
-                            if st.button(f"➕ 添加规则", key=f"add_rule_{sheet_name}_{var_name}"):
-                                var_config['rules'].append({
-                                    'condition_column': '',
-                                    'condition_operator': '=',
-                                    'condition_value': '',
-                                    'extract_type': '直接提取',
-                                    'extract_value_type': '从列提取',
-                                    'extract_value': '',
-                                    'regex_pattern': '',
-                                    'capture_group': 1
-                                })
-                                logger.info(f"添加规则: {sheet_name}.{var_name}")
-                                st.rerun()
+                            operators = ["=", "<>", "包含", "不包含", ">", "<", ">=", "<="]
+                            current_op = rule.get('condition_operator', '=')
+                            rule['condition_operator'] = st.selectbox(
+                                "逻辑比较符",
+                                options=operators,
+                                index=operators.index(current_op) if current_op in operators else 0,
+                                key=f"cond_op_{sheet_name}_{var_name}_{idx}"
+                            )
+                        
                         with col3:
-                            st.markdown("<br>", unsafe_allow_html=True)
-                            if st.button("🗑️", key=f"del_var_{sheet_name}_{var_name}"):
-                                logger.info(f"删除变量: {sheet_name}.{var_name}")
-                                del sheet_vars[var_name]
-                                st.rerun()
+                            rule['condition_value'] = st.text_input(
+                                "判断值",
+                                value=rule.get('condition_value', ''),
+                                placeholder="留空表示空值",
+                                key=f"cond_val_{sheet_name}_{var_name}_{idx}"
+                            )
+                        
+                        st.markdown("---")
+                        
+                        st.markdown("**提取设置**")
+                        
+                        col1, col2 = st.columns(2)
                         
-                        if var_config['rules']:
-                            for idx, rule in enumerate(var_config['rules']):
-                                cond_col = rule.get('condition_column', '')
-                                cond_op = rule.get('condition_operator', '=')
-                                cond_val = rule.get('condition_value', '')
-                                ext_type = rule.get('extract_type', '直接提取')
-                                ext_val_type = rule.get('extract_value_type', '从列提取')
-                                ext_val = rule.get('extract_value', '')
-                                
-                                rule_text = f"{'├─' if idx < len(var_config['rules'])-1 else '└─'} 规则{idx+1}: "
-                                rule_text += f"当 {cond_col} {cond_op} "
-                                rule_text += f'"{cond_val}"' if cond_val else '(空)'
-                                rule_text += f" 时，{ext_type} "
-                                
-                                if ext_type == "AI提取":
-                                    rule_text += f"🤖 从 {ext_val} 提取成分"
-                                elif ext_val_type == "固定文本":
-                                    rule_text += f'"{ext_val}"'
-                                else:
-                                    rule_text += f'{ext_val}'
-                                
-                                if ext_type == "正则提取":
-                                    regex = rule.get('regex_pattern', '')
-                                    cap_grp = rule.get('capture_group', 1)
-                                    rule_text += f" (模式: {regex}, 组{cap_grp})"
-                                
-                                st.markdown(f"<div class='rule-summary'>{rule_text}</div>", unsafe_allow_html=True)
+                        with col1:
+                            extract_types = ["直接提取", "正则提取", "AI提取"]
+                            current_ext = rule.get('extract_type', '直接提取')
+                            rule['extract_type'] = st.selectbox(
+                                "提取方式",
+                                options=extract_types,
+                                index=extract_types.index(current_ext) if current_ext in extract_types else 0,
+                                key=f"ext_type_{sheet_name}_{var_name}_{idx}",
+                                help="AI提取：使用DeepSeek AI从药物名称中提取核心成分"
+                            )
                         
-                        # 编辑规则
-                        for idx, rule in enumerate(var_config['rules']):
-                            with st.expander(f"🔧 规则 {idx + 1}", expanded=False):
-                                
-                                if st.button("🗑️ 删除此规则", key=f"del_rule_{sheet_name}_{var_name}_{idx}"):
-                                    var_config['rules'].pop(idx)
-                                    logger.info(f"删除规则: {sheet_name}.{var_name}.规则{idx+1}")
-                                    st.rerun()
-                                
-                                st.markdown("**条件设置**")
-                                col1, col2, col3 = st.columns(3)
-                                
-                                with col1:
-                                    rule['condition_column'] = st.text_input(
-                                        "判断变量(列名)",
-                                        value=rule.get('condition_column', ''),
-                                        placeholder="例如: CMROUTE",
-                                        key=f"cond_col_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                
-                                with col2:
-                                    operators = ["=", "<>", "包含", "不包含", ">", "<", ">=", "<="]
-                                    current_op = rule.get('condition_operator', '=')
-                                    rule['condition_operator'] = st.selectbox(
-                                        "逻辑比较符",
-                                        options=operators,
-                                        index=operators.index(current_op) if current_op in operators else 0,
-                                        key=f"cond_op_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                
-                                with col3:
-                                    rule['condition_value'] = st.text_input(
-                                        "判断值",
-                                        value=rule.get('condition_value', ''),
-                                        placeholder="留空表示空值",
-                                        key=f"cond_val_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                
-                                st.markdown("---")
-                                
-                                st.markdown("**提取设置**")
-                                
-                                col1, col2 = st.columns(2)
-                                
-                                with col1:
-                                    extract_types = ["直接提取", "正则提取", "AI提取"]
-                                    current_ext = rule.get('extract_type', '直接提取')
-                                    rule['extract_type'] = st.selectbox(
-                                        "提取方式",
-                                        options=extract_types,
-                                        index=extract_types.index(current_ext) if current_ext in extract_types else 0,
-                                        key=f"ext_type_{sheet_name}_{var_name}_{idx}",
-                                        help="AI提取：使用DeepSeek AI从药物名称中提取核心成分"
-                                    )
-                                
-                                with col2:
-                                    value_types = ["从列提取", "固定文本"]
-                                    current_val_type = rule.get('extract_value_type', '从列提取')
-                                    rule['extract_value_type'] = st.selectbox(
-                                        "提取值类型",
-                                        options=value_types,
-                                        index=value_types.index(current_val_type) if current_val_type in value_types else 0,
-                                        key=f"ext_val_type_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                
-                                if rule['extract_type'] == "AI提取":
-                                    rule['extract_value_type'] = "从列提取"
-                                    rule['extract_value'] = st.text_input(
-                                        "源数据列名 (AI将从此列提取药物成分)",
-                                        value=rule.get('extract_value', ''),
-                                        placeholder="例如: CMDECOD",
-                                        key=f"ext_val_{sheet_name}_{var_name}_{idx}",
-                                        help="AI会分析该列的药物名称并提取核心成分"
-                                    )
-                                    st.info("💡 AI提取会自动识别药物成分，无需正则表达式")
-                                
-                                elif rule['extract_value_type'] == "从列提取":
-                                    rule['extract_value'] = st.text_input(
-                                        "提取值(列名)",
-                                        value=rule.get('extract_value', ''),
-                                        placeholder="例如: CMROUTE",
-                                        key=f"ext_val_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                else:
-                                    rule['extract_value'] = st.text_input(
-                                        "提取值(固定文本)",
-                                        value=rule.get('extract_value', ''),
-                                        placeholder="例如: 预防感冒",
-                                        key=f"ext_val_{sheet_name}_{var_name}_{idx}"
-                                    )
-                                
-                                if rule['extract_type'] == "正则提取":
-                                    col1, col2 = st.columns([3, 1])
-                                    with col1:
-                                        rule['regex_pattern'] = st.text_input(
-                                            "正则表达式",
-                                            value=rule.get('regex_pattern', ''),
-                                            placeholder=r"例如: (\d+)#(.+?)[;,]",
-                                            key=f"regex_{sheet_name}_{var_name}_{idx}",
-                                            help="使用 .+? 进行非贪婪匹配"
-                                        )
-                                    with col2:
-                                        rule['capture_group'] = st.number_input(
-                                            "捕获组序号",
-                                            value=rule.get('capture_group', 1),
-                                            min_value=1,
-                                            step=1,
-                                            key=f"cap_grp_{sheet_name}_{var_name}_{idx}"
-                                        )
+                        with col2:
+                            value_types = ["从列提取", "固定文本"]
+                            current_val_type = rule.get('extract_value_type', '从列提取')
+                            rule['extract_value_type'] = st.selectbox(
+                                "提取值类型",
+                                options=value_types,
+                                index=value_types.index(current_val_type) if current_val_type in value_types else 0,
+                                key=f"ext_val_type_{sheet_name}_{var_name}_{idx}"
+                            )
                         
-                        st.markdown("<br>", unsafe_allow_html=True)
+                        if rule['extract_type'] == "AI提取":
+                            rule['extract_value_type'] = "从列提取"
+                            rule['extract_value'] = st.text_input(
+                                "源数据列名 (AI将从此列提取药物成分)",
+                                value=rule.get('extract_value', ''),
+                                placeholder="例如: CMDECOD",
+                                key=f"ext_val_{sheet_name}_{var_name}_{idx}",
+                                help="AI会分析该列的药物名称并提取核心成分"
+                            )
+                            st.info("💡 AI提取会自动识别药物成分，无需正则表达式")
+                        
+                        elif rule['extract_value_type'] == "从列提取":
+                            rule['extract_value'] = st.text_input(
+                                "提取值(列名)",
+                                value=rule.get('extract_value', ''),
+                                placeholder="例如: CMROUTE",
+                                key=f"ext_val_{sheet_name}_{var_name}_{idx}"
+                            )
+                        else:
+                            rule['extract_value'] = st.text_input(
+                                "提取值(固定文本)",
+                                value=rule.get('extract_value', ''),
+                                placeholder="例如: 预防感冒",
+                                key=f"ext_val_{sheet_name}_{var_name}_{idx}"
+                            )
+                        
+                        if rule['extract_type'] == "正则提取":
+                            col1, col2 = st.columns([3, 1])
+                            with col1:
+                                rule['regex_pattern'] = st.text_input(
+                                    "正则表达式",
+                                    value=rule.get('regex_pattern', ''),
+                                    placeholder=r"例如: (\d+)#(.+?)[;,]",
+                                    key=f"regex_{sheet_name}_{var_name}_{idx}",
+                                    help="使用 .+? 进行非贪婪匹配"
+                                )
+                            with col2:
+                                rule['capture_group'] = st.number_input(
+                                    "捕获组序号",
+                                    value=rule.get('capture_group', 1),
+                                    min_value=1,
+                                    step=1,
+                                    key=f"cap_grp_{sheet_name}_{var_name}_{idx}"
+                                )
+            else:
+                st.info("ℹ️ 该工作表暂无变量，请先添加变量")
     
     # ==================== 导出区域 ====================
     st.markdown("---")
@@ -543,214 +832,74 @@ if st.session_state.excel_data is not None:
     
     col1, col2, col3 = st.columns([1, 1, 1])
     
+    with col1:
+        format_choice = st.selectbox(
+            "输出格式",
+            options=list(FORMAT_LABELS),
+            format_func=FORMAT_LABELS.get,
+            key="output_format",
+        )
+        writer_choice = st.selectbox(
+            "写出方式",
+            options=list(WRITER_LABELS),
+            format_func=WRITER_LABELS.get,
+            key="excel_writer",
+            disabled=format_choice != FORMAT_XLSX,
+        )
+    
     with col2:
         if st.button("🚀 处理并导出", type="primary", use_container_width=True):
             logger.info("=" * 80)
             logger.info("开始处理并导出")
             logger.info("=" * 80)
-            render_log_panel(log_panel_placeholder)
             
-            try:
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    
-                    for sheet_name in selected_sheets:
-                        logger.info(f"处理工作表: {sheet_name}")
-                        
-                        logger.info(f"  读取数据: {sheet_name}")
-                        df = pd.read_excel(
-                            st.session_state.uploaded_file,
-                            sheet_name=sheet_name,
-                            dtype=str
-                        )
-                        logger.info(f"  数据读取完成: 行数={len(df)}, 列数={len(df.columns)}")
-                        
-                        if sheet_name in st.session_state.sheet_variables:
-                            sheet_vars = st.session_state.sheet_variables[sheet_name]
-                            logger.info(f"  该工作表有 {len(sheet_vars)} 个变量需要处理")
-                            
-                            for var_name, var_config in sheet_vars.items():
-                                logger.info(f"  处理变量: {var_name}")
-                                
-                                separator = var_config.get('separator', ';')
-                                rules = var_config.get('rules', [])
-                                logger.info(f"    规则数: {len(rules)}, 分隔符: '{separator}'")
-                                
-                                has_ai_rules = any(r.get('extract_type') == 'AI提取' for r in rules)
-                                
-                                if has_ai_rules:
-                                    logger.info(f"    检测到AI提取规则")
-                                    
-                                    ai_tasks = []
-                                    
-                                    for row_idx, row in df.iterrows():
-                                        for rule_idx, rule in enumerate(rules):
-                                            if rule.get('extract_type') == 'AI提取':
-                                                cond_col = rule.get('condition_column', '')
-                                                cond_op = rule.get('condition_operator', '=')
-                                                cond_val = rule.get('condition_value', '')
-                                                
-                                                if cond_col and cond_col in df.columns:
-                                                    if evaluate_condition(row[cond_col], cond_op, cond_val):
-                                                        source_col = rule.get('extract_value', '')
-                                                        if source_col and source_col in df.columns:
-                                                            ai_tasks.append((row_idx, rule_idx, source_col, row[source_col]))
-                                    
-                                    logger.info(f"    需要AI处理的任务数: {len(ai_tasks)}")
-                                    
-                                    from collections import defaultdict
-                                    col_groups = defaultdict(list)
-                                    for task in ai_tasks:
-                                        row_idx, rule_idx, source_col, value = task
-                                        col_groups[source_col].append((row_idx, value))
-                                    
-                                    ai_results = {}
-                                    
-                                    for source_col, tasks in col_groups.items():
-                                        logger.info(f"    AI批量处理列 '{source_col}': {len(tasks)} 条数据")
-                                        
-                                        values = [v for _, v in tasks]
-                                        row_indices = [idx for idx, _ in tasks]
-                                        
-                                        batch_size = AI_CONFIG["BATCH_SIZE"]
-                                        total_batches = (len(values) + batch_size - 1) // batch_size
-                                        
-                                        with st.spinner(f"正在使用AI提取 {var_name} (列: {source_col}, 共{len(values)}条)..."):
-                                            for batch_idx in range(total_batches):
-                                                start_idx = batch_idx * batch_size
-                                                end_idx = min((batch_idx + 1) * batch_size, len(values))
-                                                
-                                                batch_values = values[start_idx:end_idx]
-                                                batch_row_indices = row_indices[start_idx:end_idx]
-                                                
-                                                logger.info(f"      批次 {batch_idx + 1}/{total_batches}")
-                                                render_log_panel(log_panel_placeholder)
-                                                
-                                                extracted = ai_extract_batch(
-                                                    batch_values,
-                                                    f"{var_name}.{source_col}",
-                                                    cache=st.session_state.ai_cache,
-                                                )
-                                                render_log_panel(log_panel_placeholder)
-                                                
-                                                for row_idx, result in zip(batch_row_indices, extracted):
-                                                    ai_results[row_idx] = result
-                                                
-                                                if batch_idx < total_batches - 1:
-                                                    time.sleep(AI_CONFIG["SLEEP_TIME"])
-                                    
-                                    logger.info(f"    AI提取完成，共处理 {len(ai_results)} 条数据")
-                                    
-                                    def apply_rules_with_ai(row):
-                                        all_values = []
-                                        
-                                        for rule_idx, rule in enumerate(rules):
-                                            cond_col = rule.get('condition_column', '')
-                                            cond_op = rule.get('condition_operator', '=')
-                                            cond_val = rule.get('condition_value', '')
-                                            
-                                            if not cond_col or cond_col not in row.index:
-                                                continue
-                                            
-                                            if evaluate_condition(row[cond_col], cond_op, cond_val):
-                                                if rule.get('extract_type') == 'AI提取':
-                                                    if row.name in ai_results:
-                                                        result = ai_results[row.name]
-                                                        if result:
-                                                            all_values.append(result)
-                                                else:
-                                                    extracted = extract_value(
-                                                        row,
-                                                        rule.get('extract_type', '直接提取'),
-                                                        rule.get('extract_value_type', '从列提取'),
-                                                        rule.get('extract_value', ''),
-                                                        rule.get('regex_pattern', ''),
-                                                        rule.get('capture_group', 1)
-                                                    )
-                                                    all_values.extend(extracted)
-                                        
-                                        if not all_values:
-                                            return ''
-                                        
-                                        combined = separator.join(all_values)
-                                        split_values = [v.strip() for v in combined.split(separator) if v.strip()]
-                                        unique_sorted = sorted(set(split_values))
-                                        
-                                        return separator.join(unique_sorted)
-                                    
-                                    df[var_name] = df.apply(apply_rules_with_ai, axis=1)
-                                    
-                                else:
-                                    if rules:
-                                        logger.info(f"    使用规则提取")
-                                        df[var_name] = df.apply(
-                                            lambda row: process_variable_rules(row, rules, separator),
-                                            axis=1
-                                        )
-                                        logger.info(f"    规则提取完成")
-                        
-                        logger.info(f"  写入Excel: {sheet_name}")
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
-                        
-                        worksheet = writer.sheets[sheet_name]
-                        
-                        thin_border = Border(
-                            left=Side(style='thin'),
-                            right=Side(style='thin'),
-                            top=Side(style='thin'),
-                            bottom=Side(style='thin')
-                        )
-                        
-                        header_fill = PatternFill(start_color='B4C7E7', end_color='B4C7E7', fill_type='solid')
-                        header_font = Font(bold=True)
-                        header_alignment = Alignment(horizontal='center', vertical='center')
-                        
-                        for col_idx, col in enumerate(df.columns, 1):
-                            cell = worksheet.cell(row=1, column=col_idx)
-                            cell.fill = header_fill
-                            cell.font = header_font
-                            cell.alignment = header_alignment
-                            cell.border = thin_border
-                        
-                        for row_idx in range(2, len(df) + 2):
-                            for col_idx in range(1, len(df.columns) + 1):
-                                cell = worksheet.cell(row=row_idx, column=col_idx)
-                                cell.border = thin_border
-                        
-                        worksheet.freeze_panes = 'A2'
-                        worksheet.auto_filter.ref = worksheet.dimensions
-                        
-                        logger.info(f"  工作表 {sheet_name} 格式化完成")
-                
-                output.seek(0)
-                
-                original_name = st.session_state.uploaded_file.name
-                if original_name.endswith('.xlsx'):
-                    new_name = original_name.replace('.xlsx', '_processed.xlsx')
-                elif original_name.endswith('.xls'):
-                    new_name = original_name.replace('.xls', '_processed.xlsx')
-                else:
-                    new_name = original_name + '_processed.xlsx'
-                
-                logger.info(f"文件处理完成: {new_name}")
-                
-                st.download_button(
-                    label="⬇️ 下载处理后的文件",
-                    data=output,
-                    file_name=new_name,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True
-                )
-                
-                st.success("✅ 文件处理完成!")
-                logger.info("=" * 80)
-                logger.info("导出流程结束")
-                logger.info("=" * 80)
-                
-            except Exception as e:
-                logger.error(f"处理失败: {str(e)}", exc_info=True)
-                st.error(f"❌ 处理失败: {str(e)}")
-                st.exception(e)
+            rule_errors = validate_sheet_variables({
+                name: st.session_state.sheet_variables.get(name, {}) for name in selected_sheets
+            })
+            
+            if rule_errors:
+                for error in rule_errors:
+                    logger.error(f"规则配置错误: {error}")
+                st.error("❌ 规则配置有误，请修正后再导出:\n\n" + "\n".join(f"- {e}" for e in rule_errors))
+                st.stop()
+            
+            for sheet_name in selected_sheets:
+                for problem in missing_columns(
+                    st.session_state.sheet_variables.get(sheet_name, {}),
+                    st.session_state.excel_data.columns(sheet_name),
+                ):
+                    logger.warning(f"规则引用的列不存在: {sheet_name}.{problem}")
+                    st.warning(f"⚠️ {sheet_name}.{problem}（该规则将被跳过）")
+            
+            file_name = st.session_state.uploaded_file.name
+            # 任务结束前固定工作簿，避免排队期间被其他上传挤出缓存
+            workbook = st.session_state.excel_data
+            workbook.pin()
+            # 提交时复制规则配置，之后在界面上的修改不影响已提交的任务
+            job = get_job_runner().submit(
+                st.session_state.job_owner,
+                f"{file_name} → {FORMAT_LABELS[format_choice]}",
+                functools.partial(
+                    export_workbook,
+                    source=workbook,
+                    sheet_variables=copy.deepcopy(st.session_state.sheet_variables),
+                    sheet_names=list(selected_sheets),
+                    cache=st.session_state.ai_cache,
+                    file_name=file_name,
+                    file_format=format_choice,
+                    writer=writer_choice,
+                    incremental=get_incremental_store(),
+                    pool=get_rule_pool(),
+                    checkpoints=get_checkpoint_store(),
+                    model=st.session_state.ai_model,
+                ),
+                on_finish=workbook.unpin,
+            )
+            logger.info(f"导出任务已提交: {job.id}")
+            st.toast(f"导出任务已提交: {job.id}")
+    
+# 任务面板不依赖当前上传的文件：刷新页面后仍显示本会话提交的任务
+render_job_panel()
 
 # 页脚
 st.markdown("---")